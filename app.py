@@ -1,20 +1,37 @@
-from flask import Flask, render_template, request, redirect, url_for
+from flask import Flask, render_template, request, redirect, url_for, session, make_response, Response
 from flask_bootstrap import Bootstrap
 from flask_wtf import FlaskForm
-from flask_wtf.file import FileField, FileRequired, FileAllowed
+from flask_wtf.file import FileField, FileAllowed
 from flask_login import LoginManager, current_user, login_required, login_user, logout_user, UserMixin
+from werkzeug.datastructures import FileStorage
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from wtforms import IntegerField, FloatField, DateField, SelectField, RadioField, HiddenField, \
     SelectMultipleField, FieldList, FormField, StringField, PasswordField, validators
+from collections import OrderedDict
 from datetime import datetime
 from urlparse import urlparse, urljoin
 import os.path
 import json
-import redis
-import re
 import pprint
+import threading
 import uuid
+import time
+
+from catalog import ModelCatalog
+from series_store import SeriesStore, values_to_list
+import compare
+import downsample
+import export
+import resample
+import engine
+import jobs
+import history
+import model_compiler
+import instrumentation
+import redis_db
+import results_summary
+import uploads
 
 pp = pprint.PrettyPrinter(indent=4)
 
@@ -24,7 +41,63 @@ app.config['UPLOAD_FOLDER'] = '/static/upload'
 app.jinja_env.filters['json_pretty'] = lambda value: json.dumps(value, sort_keys=True, indent=4)
 Bootstrap(app)
 
-db = redis.Redis('localhost')
+app.config['REDIS_URL'] = os.environ.get('REDIS_URL', redis_db.REDIS_URL)
+app.config['REDIS_MAX_CONNECTIONS'] = int(os.environ.get('REDIS_MAX_CONNECTIONS', redis_db.REDIS_MAX_CONNECTIONS))
+
+# request timings, Redis counts, sampled profiles of slow requests and /metrics, see instrumentation.py
+app.config['INSTRUMENTATION'] = os.environ.get('INSTRUMENTATION', '') == '1'
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', instrumentation.PROFILE_SAMPLE_RATE))
+app.config['PROFILE_SLOW_SECONDS'] = float(os.environ.get('PROFILE_SLOW_SECONDS', instrumentation.PROFILE_SLOW_SECONDS))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', instrumentation.PROFILE_DIR)
+
+# created on first use, importing the app does not touch Redis
+db = redis_db.create_lazy_client(
+    app.config['REDIS_URL'], app.config['REDIS_MAX_CONNECTIONS'],
+    on_create=instrumentation.instrument_redis if app.config['INSTRUMENTATION'] else None
+)
+if app.config['INSTRUMENTATION']:
+    instrumentation.init_app(app)
+
+# method prefixes of password hashes made by werkzeug
+PASSWORD_HASH_METHODS = ('pbkdf2:', 'scrypt:')
+# seconds a loaded user stays in the per-process cache, and the most users it keeps
+USER_CACHE_TTL = 60
+USER_CACHE_SIZE = 1000
+DEFAULT_USER_EMAIL = 'gleb.kondratenko@skybonds.com'
+DEFAULT_USER_PASSWORD = 'pwd'
+# user id -> (expiry time, user) in least recently used first order
+user_cache = OrderedDict()
+user_cache_lock = threading.Lock()
+
+TS_ENTITY_TYPES = [('companies', 'Company'), ('goods', 'Goods & Resources')]
+ENTITIES_SEARCH_LIMIT = 20
+LINEAGE_DIRECTIONS = ('upstream', 'downstream')
+MODEL_EXTENSIONS = ['xlsx']
+TIMESERIES_EXTENSIONS = ['xls', 'xlsx']
+
+RUN_HISTORY_PER_PAGE = 10
+# seconds between checks for new variant results of a streamed batch job
+BATCH_POLL_INTERVAL = 0.5
+# seconds a variants stream holds a worker before it ends and the client reconnects
+BATCH_STREAM_TIMEOUT = 30
+
+RESULTS_PER_PAGE = 20
+RESULTS_MAX_PER_PAGE = 100
+# target number of points of a chart on the results page
+RESULTS_CHART_POINTS = 500
+# frequency of /results/series picking a rollup per series
+RESULTS_AUTO_FREQUENCY = 'auto'
+# export format -> (mimetype, file extension)
+RESULTS_EXPORT_TYPES = {
+    'long': ('text/csv', 'csv'),
+    'wide': ('text/csv', 'csv'),
+    'columnar': ('application/octet-stream', 'bin')
+}
+
+model_catalog = ModelCatalog(os.path.join(app.static_folder, 'models.json'))
+series_store = SeriesStore(os.path.join(app.static_folder, 'series'))
+upload_folder = os.path.join(app.static_folder, 'upload')
+compiled_folder = os.path.join(app.static_folder, model_compiler.CACHE_FOLDER)
 
 
 class User(UserMixin):
@@ -36,41 +109,115 @@ class User(UserMixin):
         return self.user_id
 
 
-def db_init():
-    db.flushdb()
-    auth_init()
-    entities_init()
-    auth_add_user('gleb.kondratenko@skybonds.com', 'pwd')
-
-
-def auth_init():
-    db.set('user:ids', '0')
-
-
-def entities_init():
-    db.lpush('countries', 'USA', 'China', 'Russia')
-    db.lpush('entities:goods', 'Aluminium', 'Gold', 'Oil', 'Rubber')
-    db.lpush('entities:companies', 'Exxon', 'Goodyear', 'Rusal')
-    db.lpush('indexes', 'Price', 'Profit')
+# Seeds shared state, run once per deployment by bootstrap.py rather than on app import.
+# Safe to run again: only missing data is added, unless reset wipes the whole database first.
+def db_init(reset=False):
+    if reset:
+        db.flushdb()
+    db_migrate()
+    pipe = db.pipeline()
+    auth_init(pipe)
+    entities_init(pipe)
+    pipe.execute()
+    series_store_init()
+    if not auth_get_user_by_email(DEFAULT_USER_EMAIL):
+        auth_add_user(DEFAULT_USER_EMAIL, DEFAULT_USER_PASSWORD)
+
+
+# Upgrades data written by earlier versions in place: registries kept as lists become sorted sets,
+# plaintext passwords are replaced by their hashes. Running it again changes nothing.
+def db_migrate():
+    for key in ['countries', 'indexes'] + list(db.scan_iter('entities:*')):
+        if db.type(key) == 'list':
+            values = db.lrange(key, 0, -1)
+            pipe = db.pipeline()
+            pipe.delete(key)
+            if values:
+                registry_add(pipe, key, *values)
+            pipe.execute()
+    for user_id in db.hvals('user:emails'):
+        password_hash = db.hget('user:%s' % user_id, 'password_hash')
+        if password_hash is not None and not auth_is_password_hash(password_hash):
+            db.hset('user:%s' % user_id, 'password_hash', auth_hash_password(password_hash))
+
+
+def auth_init(pipe):
+    pipe.setnx('user:ids', '0')
+
+
+# Entities and indexes are kept in sorted sets with equal scores,
+# so members are unique and ordered lexicographically for range and prefix queries
+def entities_init(pipe):
+    registry_add(pipe, 'countries', 'USA', 'China', 'Russia')
+    registry_add(pipe, 'entities:goods', 'Aluminium', 'Gold', 'Oil', 'Rubber')
+    registry_add(pipe, 'entities:companies', 'Exxon', 'Goodyear', 'Rusal')
+    registry_add(pipe, 'indexes', 'Price', 'Profit')
+
+
+def registry_add(client, key, *values):
+    args = []
+    for value in values:
+        args += [value, 0]
+    client.zadd(key, *args)
+
+
+# returns up to limit members of registry starting with prefix, in lexicographical order
+def registry_search(key, prefix='', limit=None):
+    if isinstance(prefix, unicode):
+        prefix = prefix.encode('utf-8')
+    if prefix:
+        start, end = '[' + prefix, '[' + prefix + '\xff'
+    else:
+        start, end = '-', '+'
+    if limit:
+        return db.zrangebylex(key, start, end, start=0, num=limit)
+    return db.zrangebylex(key, start, end)
+
+
+def registry_contains(key, value):
+    return db.zscore(key, value) is not None
+
+
+# seeds series store with results.json on first start and summarizes stored series
+def series_store_init():
+    if series_store.is_empty():
+        series_store.import_results(json.load(open(os.path.join(app.static_folder, 'results.json'))))
+    results_summary.rebuild(db, series_store)
 
 
 def entities_add(ts_type, value):
-    db.lpush('entities:%s' % ts_type, value)
+    registry_add(db, 'entities:%s' % ts_type, value)
 
 
 def indexes_add(value):
-    db.lpush('indexes', value)
+    registry_add(db, 'indexes', value)
 
 
 def auth_add_user(email, password):
     user_id = db.incr('user:ids')
-    db.hset('user:emails', email, user_id)
-    db.hmset('user:%s' % user_id, {
-        'user_id': user_id,
+    user_data = {
+        'user_id': str(user_id),
         'email': email,
-        'password_hash': password
-    })
-    return auth_get_user_by_id(user_id)
+        'password_hash': auth_hash_password(password)
+    }
+    pipe = db.pipeline()
+    pipe.hset('user:emails', email, user_id)
+    pipe.hmset('user:%s' % user_id, user_data)
+    pipe.execute()
+    return auth_cache_user(user_data)
+
+
+def auth_cache_user(user_data):
+    user = User()
+    user.user_id = user_data['user_id']
+    user.email = user_data['email']
+    user.password_hash = user_data['password_hash']
+    with user_cache_lock:
+        user_cache.pop(user.user_id, None)
+        user_cache[user.user_id] = (time.time() + USER_CACHE_TTL, user)
+        while len(user_cache) > USER_CACHE_SIZE:
+            user_cache.popitem(last=False)
+    return user
 
 
 def auth_get_user_by_email(email):
@@ -80,23 +227,36 @@ def auth_get_user_by_email(email):
     return auth_get_user_by_id(user_id)
 
 
+# password_hash is stored already derived, so loading a user does no key derivation
 def auth_get_user_by_id(user_id):
-    key = 'user:%s' % user_id
-    if db.hlen(key) == 0:
+    with user_cache_lock:
+        # expired entries are dropped, fresh ones become the most recently used
+        cached = user_cache.pop(str(user_id), None)
+        if cached and cached[0] > time.time():
+            user_cache[str(user_id)] = cached
+            return cached[1]
+
+    user_data = db.hgetall('user:%s' % user_id)
+    if not user_data:
         return None
-    user_data = db.hgetall(key)
-    user = User()
-    user.user_id = user_data['user_id']
-    user.email = user_data['email']
-    user.password_hash = generate_password_hash(user_data['password_hash'])
-    return user
+    return auth_cache_user(user_data)
 
 
-def auth_check_password(user, password):
-    return check_password_hash(user.password_hash, password)
+def auth_hash_password(password):
+    with instrumentation.phase('password_hash'):
+        return generate_password_hash(password)
+
 
+# werkzeug hashes are method$salt$hash, methods of key derivation functions start with their name
+def auth_is_password_hash(value):
+    parts = value.split('$')
+    return len(parts) == 3 and parts[0].startswith(PASSWORD_HASH_METHODS) and all(parts[1:])
+
+
+def auth_check_password(user, password):
+    with instrumentation.phase('password_hash'):
+        return check_password_hash(user.password_hash, password)
 
-db_init()
 
 login_manager = LoginManager(app)
 login_manager.login_view = 'view_login'
@@ -107,11 +267,6 @@ def load_user(user_id):
     return auth_get_user_by_id(user_id)
 
 
-def load_json(name):
-    filename = os.path.join(app.static_folder, name)
-    return json.load(open(filename))
-
-
 @app.route('/')
 def view_home():
     return render_template('home.html')
@@ -119,23 +274,182 @@ def view_home():
 
 @app.route('/models')
 def view_models():
-    models = load_json('models.json')
+    models = model_catalog.get_models()
     return render_template('models.html', models=models)
 
 
+# models of {model name: distance} ordered by distance
+def get_lineage_models(related):
+    return [{
+        'model_system_name': name,
+        'model_name_user': model_catalog.models_by_name[name]['model_name_user'],
+        'distance': distance
+    } for name, distance in sorted(related.items(), key=lambda item: (item[1], item[0]))]
+
+
+# models a model depends on (upstream) or models depending on it (downstream), with their distance
+@app.route('/lineage/models/<name>/<direction>')
+def view_lineage_model(name, direction):
+    if direction not in LINEAGE_DIRECTIONS:
+        return json.dumps({'error': 'Unknown direction %s' % direction}), 404
+    if name not in model_catalog.refresh().models_by_name:
+        return json.dumps({'error': 'Unknown model %s' % name}), 404
+    if direction == 'upstream':
+        related = model_catalog.get_upstream_models(name)
+    else:
+        related = model_catalog.get_downstream_models(name)
+    return json.dumps({'model': name, 'direction': direction, 'models': get_lineage_models(related)})
+
+
+# Lineage of an output or timeseries by its series_name_system: the producing model and its upstream models,
+# or inputs reading the series and all models affected by its change
+@app.route('/lineage/series/<series_name_system>/<direction>')
+def view_lineage_series(series_name_system, direction):
+    if direction not in LINEAGE_DIRECTIONS:
+        return json.dumps({'error': 'Unknown direction %s' % direction}), 404
+    producer = model_catalog.get_series_producer(series_name_system)
+    consumers = model_catalog.get_series_consumers(series_name_system)
+    if not producer and not consumers:
+        return json.dumps({'error': 'Unknown series %s' % series_name_system}), 404
+    lineage = {'series': series_name_system, 'direction': direction}
+    if direction == 'upstream':
+        lineage['producer'] = producer['model_system_name'] if producer else None
+        lineage['models'] = get_lineage_models(model_catalog.get_series_upstream_models(series_name_system))
+    else:
+        lineage['consumers'] = [{'model_system_name': name, 'input': input_name} for name, input_name in consumers]
+        lineage['models'] = get_lineage_models(model_catalog.get_series_downstream_models(series_name_system))
+    return json.dumps(lineage)
+
+
+# Chunked upload session: JSON body {"filename": name, "size": bytes}.
+# Chunks are then PUT to /uploads/<upload_id>?offset=<bytes received so far> as raw request bodies,
+# optionally with &checksum=<CRC32 of the chunk as hex digits> to reject chunks corrupted on the way,
+# the complete upload is submitted by its upload_id instead of a file field.
+@app.route('/uploads', methods=['POST'])
+@login_required
+def view_upload_create():
+    body = request.get_json(silent=True) or {}
+    try:
+        upload = uploads.create(db, upload_folder, current_user.user_id, body.get('filename'), int(body.get('size')))
+    except (TypeError, ValueError, uploads.UploadError) as e:
+        return json.dumps({'error': str(e)}), 400
+    return json.dumps(uploads.describe(upload))
+
+
+# state of an upload, an interrupted client resumes from its offset
+@app.route('/uploads/<upload_id>')
+@login_required
+def view_upload(upload_id):
+    upload = uploads.get(db, upload_id)
+    if not upload or upload['owner'] != current_user.user_id:
+        return json.dumps({'error': 'Upload not found'}), 404
+    return json.dumps(uploads.describe(upload))
+
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def view_upload_chunk(upload_id):
+    upload = uploads.get(db, upload_id)
+    if not upload or upload['owner'] != current_user.user_id:
+        return json.dumps({'error': 'Upload not found'}), 404
+    offset = request.args.get('offset', type=int)
+    if offset is None or request.content_length is None:
+        return json.dumps({'error': 'offset and Content-Length are required'}), 400
+    checksum = request.args.get('checksum')
+    try:
+        checksum = int(checksum, 16) if checksum else None
+    except ValueError:
+        return json.dumps({'error': 'checksum should be CRC32 of the chunk as hex digits'}), 400
+    try:
+        upload = uploads.append(db, upload_id, offset, request.stream, request.content_length, checksum)
+    except uploads.UploadConflict as e:
+        upload = uploads.get(db, upload_id)
+        if not upload:
+            return json.dumps({'error': 'Upload not found'}), 404
+        return json.dumps({'error': str(e), 'offset': upload['offset']}), 409
+    except uploads.UploadError as e:
+        return json.dumps({'error': str(e)}), 400
+    return json.dumps(uploads.describe(upload))
+
+
+# file field is required unless a complete chunked upload of the user is given instead
+def validate_file_or_upload(file_field, upload_field, extensions):
+    if upload_field.data:
+        try:
+            uploads.check(db, upload_field.data, current_user.user_id, extensions)
+        except uploads.UploadError as e:
+            file_field.errors.append(str(e))
+            return False
+        return True
+    if not isinstance(file_field.data, FileStorage) or not file_field.data:
+        file_field.errors.append('This field is required.')
+        return False
+    return True
+
+
+# returns path of the submitted file under upload folder, an upload is used in place without copying
+def save_file_or_upload(file_field, upload_field, extensions):
+    if upload_field.data:
+        return uploads.claim(db, upload_field.data, current_user.user_id, extensions)
+    form_file = file_field.data
+    if not os.path.isdir(upload_folder):
+        os.makedirs(upload_folder)
+    path = os.path.join(upload_folder, '%s_%s' % (str(uuid.uuid4()), secure_filename(form_file.filename)))
+    form_file.save(path)
+    return path
+
+
+# Sources of inputs of a new model: an input takes the output or the registered timeseries of the same name,
+# inputs matching none keep their workbook values. Raises ValueError when an input matches more than one.
+def get_input_sources(names):
+    model_catalog.refresh()
+    sources = {}
+    for name in names:
+        candidates = [
+            {
+                'source_type': 'output',
+                'source_author': model['author'],
+                'source_series_name_system': output['series_name_system'],
+                'source_model_name_user': model['model_name_user']
+            }
+            for model, output in model_catalog.producers.values() if output['series_name_user'] == name
+        ] + [
+            {
+                'source_type': 'timeseries',
+                'source_author': timeseries['ts_author'],
+                'source_series_name_system': timeseries['series_name_system'],
+                'source_model_name_user': 'None'
+            }
+            for timeseries in model_catalog.timeseries.values() if timeseries['ts_name'] == name
+        ]
+        if not candidates:
+            continue
+        if len(candidates) > 1:
+            raise ValueError('Input %s matches %s model outputs and timeseries' % (name, len(candidates)))
+        sources[name] = candidates[0]
+    return sources
+
+
 @app.route('/models/add', methods=['GET', 'POST'])
 @login_required
 def view_models_add():
     model_add_form = ModelAddForm()
     if model_add_form.validate_on_submit():
-        def get_path(form_file):
-            safe_filename = secure_filename(form_file.filename)
-            unique_filename = '%s_%s' % (str(uuid.uuid4()), safe_filename)
-            return os.path.join(app.static_folder, 'upload', unique_filename)
-
-        form_file = model_add_form.original_file_name.data
-        path = get_path(form_file)
-        form_file.save(path)
+        path = save_file_or_upload(model_add_form.original_file_name, model_add_form.upload_id, MODEL_EXTENSIONS)
+        # formulas are compiled once on upload, runs load the cached evaluator
+        try:
+            evaluator = model_compiler.load(path, compiled_folder)
+            model_catalog.add_model(
+                model_add_form.model_user_name.data, current_user.email,
+                os.path.relpath(path, os.path.dirname(model_catalog.path)),
+                get_input_sources(evaluator.inputs), evaluator.outputs
+            )
+        except (model_compiler.CompileError, ValueError) as e:
+            os.remove(path)
+            model_add_form.original_file_name.errors.append(str(e))
+            # a chunked upload is claimed by now, the file has to be uploaded again
+            model_add_form.upload_id.data = ''
+            return render_template('models_add.html', form=model_add_form)
         return redirect(url_for('view_models'))
     return render_template('models_add.html', form=model_add_form)
 
@@ -146,14 +460,14 @@ def view_timeseries_add():
     class TimeseriesAddStep1Form(FlaskForm):
         ts_step = HiddenField('Step', default='1')
         ts_name = StringField('Timeseries name', [validators.required()])
-        ts_type = SelectField('Entity type', choices=[('companies', 'Company'), ('goods', 'Goods & Resources')])
+        ts_type = SelectField('Entity type', choices=TS_ENTITY_TYPES)
 
     class TimeseriesAddStep2Form(FlaskForm):
         ts_step = HiddenField('Step')
         ts_name = HiddenField('Timeseries name')
         ts_type = HiddenField('Timeseries type')
-        ts_entity = SelectField('Entity', choices=[])
-        ts_entity_new = StringField('Entity new')
+        ts_entity = StringField('Entity', [validators.required()])
+        ts_entity_new = HiddenField('Entity new')
         ts_index = SelectField('Index', choices=[])
         ts_index_new = StringField('Index new')
 
@@ -162,9 +476,10 @@ def view_timeseries_add():
             if not rv:
                 return False
 
-            if self.ts_entity.data == 'new' and not self.ts_entity_new.data:
-                self.ts_entity_new.errors.append('New entity name cannot be empty')
-                return False
+            # entity is typed with autocomplete, an unknown one is added as new
+            if not registry_contains('entities:%s' % self.ts_type.data, self.ts_entity.data):
+                self.ts_entity_new.data = self.ts_entity.data
+                self.ts_entity.data = 'new'
 
             if self.ts_index.data == 'new' and not self.ts_index_new.data:
                 self.ts_index_new.errors.append('New index name cannot be empty')
@@ -181,19 +496,16 @@ def view_timeseries_add():
         ts_index = HiddenField('Index')
         ts_index_new = HiddenField('Index new')
         ts_file = FileField('Timeseries file', validators=[
-            FileRequired(),
-            FileAllowed(['xls', 'xlsx'], 'Only .xls and .xlsx files are allowed as model input')
+            FileAllowed(TIMESERIES_EXTENSIONS, 'Only .xls and .xlsx files are allowed as model input')
         ])
+        ts_upload_id = HiddenField('Upload')
 
-    def get_ts_entity_choices(ts_type):
-        result = [(entity, entity) for entity in db.lrange('entities:%s' % ts_type, 0, -1)]
-        result.sort()
-        return result + [('new', 'New value...')]
+        def validate(self):
+            return FlaskForm.validate(self) and \
+                validate_file_or_upload(self.ts_file, self.ts_upload_id, TIMESERIES_EXTENSIONS)
 
     def get_ts_index_choices():
-        result = [(entity, entity) for entity in db.lrange('indexes', 0, -1)]
-        result.sort()
-        return result + [('new', 'New value...')]
+        return [(item, item) for item in registry_search('indexes')] + [('new', 'New value...')]
 
     if request.method == 'POST':
         print('request.form.step.data', request.form['ts_step'])
@@ -206,14 +518,12 @@ def view_timeseries_add():
                     ts_type=f_step_1.ts_type.data
                 )
                 f_step_2.ts_step.data = '2'
-                f_step_2.ts_entity.choices = get_ts_entity_choices(f_step_1.ts_type.data)
                 f_step_2.ts_index.choices = get_ts_index_choices()
                 return render_template('timeseries_add_2.html', form=f_step_2)
             return render_template('timeseries_add_1.html', form=f_step_1)
 
         if request.form['ts_step'] == '2':
             f_step_2 = TimeseriesAddStep2Form()
-            f_step_2.ts_entity.choices = get_ts_entity_choices(f_step_2.ts_type.data)
             f_step_2.ts_index.choices = get_ts_index_choices()
             if f_step_2.validate_on_submit():
                 f_step_3 = TimeseriesAddStep3Form(
@@ -225,26 +535,21 @@ def view_timeseries_add():
                     ts_index_new=f_step_2.ts_index_new.data
                 )
                 f_step_3.ts_step.data = '3'
+                f_step_3.ts_entity.data = f_step_2.ts_entity.data
+                f_step_3.ts_entity_new.data = f_step_2.ts_entity_new.data
                 return render_template('timeseries_add_3.html', form=f_step_3)
             return render_template('timeseries_add_2.html', form=f_step_2)
 
         if request.form['ts_step'] == '3':
             f_step_3 = TimeseriesAddStep3Form()
             if f_step_3.validate_on_submit():
-                def get_path(form_file):
-                    safe_filename = secure_filename(form_file.filename)
-                    unique_filename = '%s_%s' % (str(uuid.uuid4()), safe_filename)
-                    return os.path.join(app.static_folder, 'upload', unique_filename)
-
-                form_file = f_step_3.ts_file.data
-                path = get_path(form_file)
-
                 if f_step_3.ts_entity.data == 'new':
                     entities_add(f_step_3.ts_type.data, f_step_3.ts_entity_new.data)
                 if f_step_3.ts_index.data == 'new':
                     indexes_add(f_step_3.ts_index_new.data)
 
-                form_file.save(path)
+                path = save_file_or_upload(f_step_3.ts_file, f_step_3.ts_upload_id, TIMESERIES_EXTENSIONS)
+                jobs.enqueue_ingestion(db, path, f_step_3.ts_name.data, current_user.email)
                 return redirect(url_for('view_models'))
             return render_template('timeseries_add_3.html', form=f_step_3)
 
@@ -252,73 +557,156 @@ def view_timeseries_add():
     return render_template('timeseries_add_1.html', form=f_step_1)
 
 
+# series metadata and stats sorted for grouping by result type, prepared when series are written
+def get_results_meta():
+    return results_summary.get(db)
+
+
+def get_results_meta_by_name():
+    return results_summary.get_by_name(db)
+
+
+# entities of given type starting with prefix, used for autocomplete
+@app.route('/timeseries/entities/<ts_type>')
+def view_timeseries_entities(ts_type):
+    if ts_type not in dict(TS_ENTITY_TYPES):
+        return json.dumps({'error': 'Unknown entity type'}), 404
+    try:
+        limit = max(1, min(int(request.args.get('limit', ENTITIES_SEARCH_LIMIT)), ENTITIES_SEARCH_LIMIT))
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400
+    return json.dumps(registry_search('entities:%s' % ts_type, request.args.get('prefix', ''), limit))
+
+
 @app.route('/results')
 def view_results():
-    results = load_json('results.json')
+    page = max(request.args.get('page', 1, type=int), 1)
+    all_series = get_results_meta()
+    pages = max((len(all_series) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE, 1)
     time_series = []
-    for name, values in results.items():
-        ts = {
-            'id': name,
-            'values': {
-                'x': [],
-                'y': []
-            }
+    for ts in all_series[(page - 1) * RESULTS_PER_PAGE:page * RESULTS_PER_PAGE]:
+        # long series are charted from their precomputed rollups
+        ts = dict(ts, frequency=resample.choose_frequency(ts.get('count', 0), RESULTS_CHART_POINTS))
+        time_series.append(ts)
+    return render_template('results.html', time_series=time_series, points=RESULTS_CHART_POINTS,
+                           page=page, pages=pages, per_page=RESULTS_PER_PAGE)
+
+
+# Date range and rollup of results query arguments start_day, end_day (YYYY-MM-DD), frequency and aggregation,
+# returns (start, end, frequency, aggregation), raises ValueError for invalid arguments.
+# frequency 'auto' is accepted with auto=True.
+def get_results_range(args, auto=False):
+    start = engine.day_to_timestamp(engine.str_to_day(args['start_day'])) if args.get('start_day') else None
+    end = engine.day_to_timestamp(engine.str_to_day(args['end_day'])) if args.get('end_day') else None
+    frequency = args.get('frequency')
+    aggregation = args.get('aggregation', 'mean')
+    if frequency and frequency not in resample.FREQUENCIES and not (auto and frequency == RESULTS_AUTO_FREQUENCY):
+        raise ValueError('Unknown frequency %s' % frequency)
+    if aggregation not in resample.AGGREGATIONS:
+        raise ValueError('Unknown aggregation %s' % aggregation)
+    return start, end, frequency, aggregation
+
+
+# Returns function reading a series by name within [start, end], daily points or rollup of frequency,
+# None for unknown series. A rollup range starts with the bucket holding start.
+def get_results_reader(frequency, aggregation, start=None, end=None):
+    if frequency and start is not None:
+        start = resample.bucket_starts([start], frequency)[0]
+
+    def read(name):
+        if frequency:
+            series = series_store.get_rollup(name, frequency, aggregation)
+        else:
+            series = series_store.get(name)
+        return series.slice(start, end) if series is not None else None
+
+    return read
+
+
+# results metadata filtered by query arguments name, result_type, model_name and ts_author
+def filter_results_meta(args):
+    filters = [(key, args[key]) for key in ('result_type', 'model_name', 'ts_author') if args.get(key)]
+    if args.get('name'):
+        ts = get_results_meta_by_name().get(args['name'])
+        time_series = [ts] if ts else []
+    else:
+        time_series = get_results_meta()
+    return [ts for ts in time_series if all(ts.get(key) == value for key, value in filters)]
+
+
+# Paginated series with values, filtered by name metadata and date range.
+# Query arguments: name, result_type, model_name, ts_author, start_day, end_day (YYYY-MM-DD),
+# page, per_page, points (target number of points per series) and downsample (lttb, minmax).
+# frequency (week, month, quarter) returns precomputed rollups instead of daily points, one per bucket
+# overlapping the date range, aggregated by aggregation (sum, mean, last, min, max; mean by default),
+# frequency 'auto' picks the finest rollup fitting every series into points.
+@app.route('/results/series')
+def view_results_series():
+    args = request.args
+    try:
+        page = max(int(args.get('page', 1)), 1)
+        per_page = min(max(int(args.get('per_page', RESULTS_PER_PAGE)), 1), RESULTS_MAX_PER_PAGE)
+        points = int(args.get('points', 0))
+        start, end, frequency, aggregation = get_results_range(args, auto=True)
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400
+    method = args.get('downsample', 'lttb')
+    if method not in downsample.METHODS:
+        return json.dumps({'error': 'Unknown downsample method %s' % method}), 400
+
+    time_series = filter_results_meta(args)
+
+    page_series = []
+    for ts in time_series[(page - 1) * per_page:page * per_page]:
+        ts_frequency = frequency
+        if frequency == RESULTS_AUTO_FREQUENCY:
+            ts_frequency = resample.choose_frequency(ts.get('count', 0), points or RESULTS_CHART_POINTS)
+        series = get_results_reader(ts_frequency, aggregation, start, end)(ts['id'])
+        ts = dict(ts)
+        # the summary may list a series whose file is gone, it stays on the page marked as missing
+        ts['missing'] = series is None
+        if series is None:
+            ts.update({'frequency': ts_frequency, 'points': 0, 'values': {'x': [], 'y': []}})
+            page_series.append(ts)
+            continue
+        timestamps, values = series.timestamps, series.values
+        if points:
+            timestamps, values = downsample.downsample(timestamps, values, points, method)
+        ts['frequency'] = ts_frequency
+        ts['points'] = len(series)
+        ts['values'] = {
+            'x': timestamps.tolist(),
+            'y': values_to_list(values)
         }
-        dates = [key for key in values]
-        dates.sort()
-        for date in dates:
-            ts['values']['x'].append(date)
-            ts['values']['y'].append(values[date])
-
-        # Input time series. Examples:
-        # G & A_Exxon_sovcombank: macbook:timeseries
-        # oil_Brent: macbook:timeseries
-        # Income_tax_rate: macbook:timeseries
-        if re.search(':timeseries$', name):
-            attrs = name.split(':')
-            (ts_name, ts_author), rest = attrs[:2], attrs[2:]
-            ts['result_type'] = 'Input time series'
-            ts['ts_name'] = ts_name
-            ts['ts_author'] = ts_author
-
-        # Output time series. Examples:
-        # incomePerDay_exxon, macbook, (output, Exxon_4)
-        # incomePerDay_goodyear, macbook, (output, Goodyear)
-        # gasoline_exxon, macbook, (output, Exxon_4)
-        if re.search('\(output,.*\)$', name):
-            name_wo_braces = re.sub(r'[()]', '', name)
-            attrs = name_wo_braces.split(',')
-            (ts_name, ts_author, _, model_name), rest = attrs[:4], attrs[4:]
-            ts['result_type'] = 'Output time series'
-            ts['ts_name'] = ts_name
-            ts['ts_author'] = ts_author
-            ts['model_name'] = model_name
-
-        # Intermediate input time series. Examples:
-        # gasoline_exxon, Goodyear, macbook, input, source_type: output, Exxon_4, gasoline_exxon, macbook
-        # Income_tax_rate, Exxon_4, macbook, input, source_type: timeseries, Income_tax_rate, macbook
-        # G & A_Exxon, Exxon_4, macbook, input, source_type: timeseries, G & A_Exxon, macbook
-        # oil, Goodyear, macbook, input, source_type: timeseries, oil, macbook
-        # oil, Exxon_4, macbook, input, source_type: timeseries, oil, macbook
-        if re.search('input,source_type:', name):
-            attrs = name.split(',')
-            (ts_name, model_name, ts_author, _), source = attrs[:4], attrs[4:]
-            ts['result_type'] = 'Intermediate input time series'
-            ts['ts_name'] = ts_name
-            ts['ts_author'] = ts_author
-            ts['model_name'] = model_name
-            if re.search('input,source_type:output', name):
-                source_model_name, rest = source[1], source[2:]
-                ts['source_model_name'] = source_model_name
-                ts['source_type'] = 'model'
-            else:
-                ts['source_type'] = 'timeseries'
+        page_series.append(ts)
 
-        time_series.append(ts)
+    return json.dumps({
+        'total': len(time_series),
+        'page': page,
+        'per_page': per_page,
+        'series': page_series
+    })
 
-    time_series.sort(key=lambda ts_item: ts_item['result_type'], reverse=False)
 
-    return render_template('results.html', results=results, time_series=time_series)
+# Streams all series matching the /results/series filters, date range and rollup arguments as a download,
+# format is long (CSV of name, day, value), wide (CSV with a column per series) or columnar (see export.py).
+@app.route('/results/export')
+def view_results_export():
+    args = request.args
+    try:
+        start, end, frequency, aggregation = get_results_range(args)
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400
+    export_format = args.get('format', 'long')
+    if export_format not in export.EXPORTERS:
+        return json.dumps({'error': 'Unknown export format %s' % export_format}), 400
+
+    names = [ts['id'] for ts in filter_results_meta(args)]
+    chunks = export.export(export_format, get_results_reader(frequency, aggregation, start, end), names)
+    mimetype, extension = RESULTS_EXPORT_TYPES[export_format]
+    return Response(chunks, mimetype=mimetype, headers={
+        'Content-Disposition': 'attachment; filename=results_%s.%s' % (export_format, extension)
+    })
 
 
 # TODO: figure out proper validation
@@ -327,28 +715,40 @@ class NoValidationSelectField(SelectField):
         """per_validation is disabled"""
 
 
+# Options of sub form selects are not rendered on the server,
+# the client fills them from /run/form/choices by the name given in data-choices
+MODELS_CHOICES = {'data-choices': 'models'}
+INPUTS_CHOICES = {'data-choices': 'inputs'}
+
+
 class ChangeOneModelForm(FlaskForm):
     def __init__(self, csrf_enabled=False, *args, **kwargs):
         super(ChangeOneModelForm, self).__init__(csrf_enabled=csrf_enabled, *args, **kwargs)
 
-    model_system_name = NoValidationSelectField('Model', [validators.required()], choices=[])
-    input_source_initial = NoValidationSelectField('Initial input', [validators.required()], choices=[])
-    input_source_final = NoValidationSelectField('Final input', [validators.required()], choices=[])
+    model_system_name = NoValidationSelectField('Model', [validators.required()], choices=[],
+                                                render_kw=MODELS_CHOICES)
+    input_source_initial = NoValidationSelectField('Initial input', [validators.required()], choices=[],
+                                                   render_kw=INPUTS_CHOICES)
+    input_source_final = NoValidationSelectField('Final input', [validators.required()], choices=[],
+                                                 render_kw=INPUTS_CHOICES)
 
 
 class ChangeAllModelsForm(FlaskForm):
     def __init__(self, csrf_enabled=False, *args, **kwargs):
         super(ChangeAllModelsForm, self).__init__(csrf_enabled=csrf_enabled, *args, **kwargs)
 
-    input_source_initial = NoValidationSelectField('Initial input', [validators.required()], choices=[])
-    input_source_final = NoValidationSelectField('Final input', [validators.required()], choices=[])
+    input_source_initial = NoValidationSelectField('Initial input', [validators.required()], choices=[],
+                                                   render_kw=INPUTS_CHOICES)
+    input_source_final = NoValidationSelectField('Final input', [validators.required()], choices=[],
+                                                 render_kw=INPUTS_CHOICES)
 
 
 class ChangeInputNewValue(FlaskForm):
     def __init__(self, csrf_enabled=False, *args, **kwargs):
         super(ChangeInputNewValue, self).__init__(csrf_enabled=csrf_enabled, *args, **kwargs)
 
-    input_source_initial = NoValidationSelectField('Initial input', [validators.required()], choices=[])
+    input_source_initial = NoValidationSelectField('Initial input', [validators.required()], choices=[],
+                                                   render_kw=INPUTS_CHOICES)
     start_day = DateField('Start day', [validators.required()], '%Y-%m-%d', default=datetime.today())
     number_of_days = IntegerField('Number of days', [validators.required()])
     new_value = FloatField('Delta', [validators.required()])
@@ -358,7 +758,8 @@ class ChangeInputAddDelta(FlaskForm):
     def __init__(self, csrf_enabled=False, *args, **kwargs):
         super(ChangeInputAddDelta, self).__init__(csrf_enabled=csrf_enabled, *args, **kwargs)
 
-    input_source_initial = NoValidationSelectField('Initial input', [validators.required()], choices=[])
+    input_source_initial = NoValidationSelectField('Initial input', [validators.required()], choices=[],
+                                                   render_kw=INPUTS_CHOICES)
     start_day = DateField('Start day', [validators.required()], '%Y-%m-%d', default=datetime.today())
     number_of_days = IntegerField('Number of days', [validators.required()])
     delta = FloatField('New Value', [validators.required()])
@@ -374,35 +775,36 @@ class RunForm(FlaskForm):
     change_timeseries_value_several_days_add_delta = FieldList(FormField(ChangeInputAddDelta), min_entries=0)
 
 
+RUN_FORM_FIELD_LISTS = {
+    'change_input_series_one_model': ChangeOneModelForm,
+    'change_input_series_all_models': ChangeAllModelsForm,
+    'change_timeseries_value_several_days': ChangeInputNewValue,
+    'change_timeseries_value_several_days_add_delta': ChangeInputAddDelta
+}
+
+
 class ModelAddForm(FlaskForm):
     model_user_name = StringField('Model name', [validators.required()])
     original_file_name = FileField("Model input", validators=[
-        FileRequired(),
-        FileAllowed(['xlsx'], 'Only .xlsx files are allowed as model input')
+        FileAllowed(MODEL_EXTENSIONS, 'Only .xlsx files are allowed as model input')
     ])
+    upload_id = HiddenField('Upload')
+
+    def validate(self):
+        return FlaskForm.validate(self) and \
+            validate_file_or_upload(self.original_file_name, self.upload_id, MODEL_EXTENSIONS)
 
 
 def get_models_choices():
-    models = load_json('models.json')
-    return [
-        (model['model_system_name'], model['model_name_user'] + ':' + model['author'])
-        for model in models
-    ]
+    return model_catalog.get_models_choices()
 
 
 def get_inputs_choices_by_model(name):
-    models = load_json('models.json')
-    model = next(item for item in models if item['model_system_name'] == name)
-    return [(
-        value['series_name_system'],
-        value['series_name_system'] + ':' + value['series_name_user']
-    ) for key, value in model['inputs'].iteritems()]
+    return model_catalog.get_inputs_choices_by_model(name)
 
 
 def get_inputs_choices():
-    models = load_json('models.json')
-    inputs_by_models = [get_inputs_choices_by_model(model['model_system_name']) for model in models]
-    return [item for inputs in inputs_by_models for item in inputs]
+    return model_catalog.get_inputs_choices()
 
 
 # returns list of commands of form data
@@ -496,28 +898,21 @@ def set_form_defaults(form, commands):
 
     for index, command in enumerate(get_command('change_input_series_one_model')):
         sub_form = form.change_input_series_one_model[index]
-        sub_form.model_system_name.choices = get_models_choices()
         sub_form.model_system_name.data = command.get('model_system_name', '')
-        sub_form.input_source_initial.choices = get_inputs_choices()
         sub_form.input_source_initial.data = command.get('input_source_initial', '')
-        sub_form.input_source_final.choices = get_inputs_choices()
         sub_form.input_source_final.data = command.get('input_source_final', '')
     for index, command in enumerate(get_command('change_input_series_all_models')):
         sub_form = form.change_input_series_all_models[index]
-        sub_form.input_source_initial.choices = get_inputs_choices()
         sub_form.input_source_initial.data = command.get('input_source_initial', '')
-        sub_form.input_source_final.choices = get_inputs_choices()
         sub_form.input_source_final.data = command.get('input_source_final', '')
     for index, command in enumerate(get_command('change_timeseries_value_several_days')):
         sub_form = form.change_timeseries_value_several_days[index]
-        sub_form.input_source_initial.choices = get_inputs_choices()
         sub_form.input_source_initial.data = command.get('input_source_initial', '')
         sub_form.start_day.data = str_to_datetime(command.get('start_day', ''))
         sub_form.number_of_days.data = command.get('number_of_days', '')
         sub_form.new_value.data = command.get('new_value', '')
     for index, command in enumerate(get_command('change_timeseries_value_several_days_add_delta')):
         sub_form = form.change_timeseries_value_several_days_add_delta[index]
-        sub_form.input_source_initial.choices = get_inputs_choices()
         sub_form.input_source_initial.data = command.get('input_source_initial', '')
         sub_form.start_day.data = str_to_datetime(command.get('start_day', ''))
         sub_form.number_of_days.data = command.get('number_of_days', '')
@@ -548,10 +943,20 @@ def view_run_submit():
 
     # submitted and valid
     if run_form.validate_on_submit():
-        # TODO: run modeling with commands
+        try:
+            engine.RunPlan(model_catalog, commands)
+        except engine.RunError as e:
+            run_form.exe_models.errors.append(str(e))
+            return json.dumps({
+                'commands': commands,
+                'html': render_template('run_form.html', form=run_form)
+            }), 400
+        job_id = jobs.enqueue(db, commands)
+        history.add(db, get_history_owner(), job_id, commands)
         return json.dumps({
             'commands': commands,
-            'html': render_template('run_success.html', commands=commands)
+            'job_id': job_id,
+            'html': render_template('run_success.html', commands=commands, job_id=job_id)
         })
 
     return json.dumps({
@@ -560,43 +965,172 @@ def view_run_submit():
     }), 400
 
 
+@app.route('/run/jobs/<job_id>')
+def view_run_job(job_id):
+    job = jobs.get_job(db, job_id)
+    if not job:
+        return json.dumps({'error': 'Job not found'}), 404
+    return json.dumps(job)
+
+
+@app.route('/run/jobs/<job_id>/cancel', methods=['POST'])
+def view_run_job_cancel(job_id):
+    if not jobs.get_job(db, job_id):
+        return json.dumps({'error': 'Job not found'}), 404
+    return json.dumps({'cancelled': jobs.cancel(db, job_id)})
+
+
+@app.route('/run/jobs/<job_id>/results')
+def view_run_job_results(job_id):
+    job = jobs.get_job(db, job_id)
+    if not job:
+        return json.dumps({'error': 'Job not found'}), 404
+    if job['status'] != jobs.STATUS_DONE:
+        return json.dumps({'error': 'Job is %s' % job['status']}), 409
+    return json.dumps(jobs.get_job_results(db, job_id))
+
+
+# Compares output series of two finished runs: ?baseline=<job id>&scenario=<job id>,
+# tolerance (absolute delta a point must exceed to count as changed, 0 by default),
+# changed=1 lists changed series only, deltas=1 adds changed points with their deltas.
+@app.route('/run/compare')
+def view_run_compare():
+    args = request.args
+    try:
+        tolerance = float(args.get('tolerance', 0))
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400
+    runs = []
+    for job_id in (args.get('baseline', ''), args.get('scenario', '')):
+        job = jobs.get_job(db, job_id)
+        if not job:
+            return json.dumps({'error': 'Job %s not found' % job_id}), 404
+        if job['status'] != jobs.STATUS_DONE:
+            return json.dumps({'error': 'Job %s is %s' % (job_id, job['status'])}), 409
+        arrays = jobs.get_job_arrays(db, job_id)
+        if arrays is None:
+            return json.dumps({'error': 'Job %s has no output series to compare' % job_id}), 404
+        runs.append(arrays)
+
+    diff = compare.compare(runs[0], runs[1], tolerance, args.get('changed') == '1', args.get('deltas') == '1')
+    diff.update({'baseline': args['baseline'], 'scenario': args['scenario'], 'tolerance': tolerance})
+    return json.dumps(diff)
+
+
+# Batch of runs: JSON body {"commands": [...], "grid": [{"command": index, "field": name, "values": [...]}]},
+# one variant of commands is run for every combination of grid values.
+@app.route('/run/batch', methods=['POST'])
+@login_required
+def view_run_batch():
+    body = request.get_json(silent=True) or {}
+    commands, grid = body.get('commands'), body.get('grid')
+    if not isinstance(commands, list) or not isinstance(grid, list):
+        return json.dumps({'error': 'commands and grid lists are required'}), 400
+    try:
+        variants = jobs.expand_grid(commands, grid)
+        for params, variant in variants:
+            engine.RunPlan(model_catalog, variant)
+    except (engine.RunError, KeyError, TypeError, ValueError) as e:
+        return json.dumps({'error': str(e)}), 400
+    job_id = jobs.enqueue_batch(db, commands, grid)
+    history.add(db, get_history_owner(), job_id, commands)
+    return json.dumps({'job_id': job_id, 'variants': len(variants)})
+
+
+# Streams results of batch variants as newline delimited JSON while they complete,
+# the response ends with {"status"} when the job is finished, or with {"status", "start"} after
+# BATCH_STREAM_TIMEOUT seconds while it is running. ?start= skips variants already received, so clients
+# reconnect with the start given in the last line.
+@app.route('/run/jobs/<job_id>/variants')
+def view_run_job_variants(job_id):
+    if not jobs.get_job(db, job_id):
+        return json.dumps({'error': 'Job not found'}), 404
+    start = request.args.get('start', 0, type=int)
+
+    def generate():
+        sent = start
+        deadline = time.time() + BATCH_STREAM_TIMEOUT
+        while True:
+            job = jobs.get_job(db, job_id)
+            status = job['status'] if job else jobs.STATUS_FAILED
+            variants = jobs.get_job_variants(db, job_id, sent)
+            for variant in variants:
+                yield variant + '\n'
+            sent += len(variants)
+            if status in jobs.FINAL_STATUSES:
+                yield json.dumps({'status': status}) + '\n'
+                return
+            if time.time() >= deadline:
+                yield json.dumps({'status': status, 'start': sent}) + '\n'
+                return
+            time.sleep(BATCH_POLL_INTERVAL)
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+# Choices of sub form selects, versioned by the model catalog.
+# Clients revalidate with the ETag and get 304 until models.json changes.
+@app.route('/run/form/choices')
+def view_run_choices():
+    model_catalog.refresh()
+    response = make_response(json.dumps({
+        'version': model_catalog.version,
+        'models': get_models_choices(),
+        'inputs': get_inputs_choices()
+    }))
+    response.mimetype = 'application/json'
+    response.set_etag(model_catalog.version)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+# renders new entry of a field list with given index, entries are removed on the client
 @app.route('/run/form/add/<field>', methods=['POST'])
 def view_run_add(field):
-    run_form = get_run_form()
-    run_form[field].append_entry()
-    commands = get_commands(run_form)
-    set_form_defaults(run_form, commands)
+    if field not in RUN_FORM_FIELD_LISTS:
+        return json.dumps({'error': 'Unknown field %s' % field}), 404
+    try:
+        index = int(request.form.get('index', 0))
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400
+    sub_form = RUN_FORM_FIELD_LISTS[field](formdata=None, prefix='%s-%s' % (field, index))
+    return render_template('run_form_entry.html', field=field, sub_form=sub_form)
+
+
+# runs are stored per user, anonymous users get a history bound to their session
+def get_history_owner():
+    if current_user.is_authenticated:
+        return 'user:%s' % current_user.user_id
+    if 'history_id' not in session:
+        session['history_id'] = str(uuid.uuid4())
+    return 'session:%s' % session['history_id']
 
-    return json.dumps({
-        'commands': commands,
-        'html': render_template('run_form.html', form=run_form)
-    })
 
+@app.route('/run/history')
+def view_run_history():
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400
+    items, total = history.get_page(db, get_history_owner(), page, RUN_HISTORY_PER_PAGE)
+    for item in items:
+        item['date'] = datetime.fromtimestamp(item['date'] / 1000)
+    pages = max((total + RUN_HISTORY_PER_PAGE - 1) // RUN_HISTORY_PER_PAGE, 1)
+    return render_template('run_history.html', history=items, page=page, pages=pages)
 
-@app.route('/run/form/remove/<field>', methods=['POST'])
-def view_run_remove(field):
-    run_form = get_run_form()
-    run_form[field].pop_entry()
-    commands = get_commands(run_form)
-    set_form_defaults(run_form, commands)
 
-    return json.dumps({
-        'commands': commands,
-        'html': render_template('run_form.html', form=run_form)
-    })
+@app.route('/run/history/<job_id>')
+def view_run_history_item(job_id):
+    commands = history.get_commands(db, get_history_owner(), job_id)
+    if commands is None:
+        return json.dumps({'error': 'Run not found'}), 404
+    return json.dumps({'id': job_id, 'commands': commands})
 
 
-@app.route('/run/form/history', methods=['POST'])
-def view_run_history():
-    history = json.loads(request.data)
-    history = [
-        {
-            'id': item['id'],
-            'date': datetime.fromtimestamp(item['date'] / 1000),
-            'commands': item['commands']
-        } for item in history
-    ]
-    return render_template('run_history.html', history=history)
+@app.route('/run/history/clear', methods=['POST'])
+def view_run_history_clear():
+    history.clear(db, get_history_owner())
+    return json.dumps({'cleared': True})
 
 
 class RegisterForm(FlaskForm):
@@ -689,4 +1223,5 @@ def view_logout():
 
 
 if __name__ == '__main__':
+    db_init()
     app.run()
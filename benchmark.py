@@ -0,0 +1,268 @@
+import argparse
+import itertools
+import json
+import os.path
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from catalog import ModelCatalog
+from series_store import SeriesStore
+import engine
+import redis_db
+import results_summary
+
+# Benchmarks of the hot paths on a synthetic catalog and series, prints JSON results:
+# python benchmark.py --models 200 --depth 10 --fan-in 3 --fan-out 2 --series 1000 --days 3650 > bench.json
+# Redis is replaced by fakeredis (pip install fakeredis), nothing is written to a real Redis.
+
+AUTHOR = 'bench'
+START_DAY = '2015-01-01'
+
+
+# Sums all inputs into every output, stands in for real model logic
+class SumEvaluator(object):
+    version = 'sum-1'
+
+    def __init__(self, output_keys):
+        self.output_keys = output_keys
+
+    def __call__(self, inputs, number_of_days):
+        total = np.zeros(number_of_days)
+        for values in inputs.values():
+            total += np.nan_to_num(values)
+        return dict((key, total) for key in self.output_keys)
+
+
+# Returns models.json data of `models` models split into `depth` layers.
+# Every model reads `fan_in` outputs of random models of the previous layer (timeseries in the first layer)
+# plus one timeseries, and has `fan_out` outputs. Timeseries are picked from `timeseries` sources.
+def generate_catalog(models, depth, fan_in, fan_out, timeseries, seed=0):
+    rng = random.Random(seed)
+    series_ids = itertools.count()
+    layers = [[] for layer in range(depth)]
+    catalog = []
+
+    def timeseries_source():
+        return {
+            'source_type': 'timeseries',
+            'source_author': AUTHOR,
+            'source_series_name_system': 'ts_%s' % rng.randrange(timeseries),
+            'source_model_name_user': 'None'
+        }
+
+    for index in range(models):
+        layer = index * depth // models
+        model = {
+            'model_system_name': 'model_%s' % index,
+            'model_name_user': 'Model_%s' % index,
+            'author': AUTHOR,
+            'inputs': {},
+            'outputs': {}
+        }
+        sources = [timeseries_source()]
+        for number in range(fan_in):
+            if layer and layers[layer - 1]:
+                producer = rng.choice(layers[layer - 1])
+                output = rng.choice(producer['outputs'].values())
+                sources.append({
+                    'source_type': 'output',
+                    'source_author': AUTHOR,
+                    'source_series_name_system': output['series_name_system'],
+                    'source_model_name_user': producer['model_name_user']
+                })
+            else:
+                sources.append(timeseries_source())
+        for number, source in enumerate(sources):
+            series_id = str(next(series_ids))
+            model['inputs']['input_%s' % number] = {
+                'series_id': series_id,
+                'series_type': 'input',
+                'series_name_system': 'series_%s' % series_id,
+                'series_name_user': 'input_%s_%s' % (index, number),
+                'source': source
+            }
+        for number in range(fan_out):
+            series_id = str(next(series_ids))
+            model['outputs']['output_%s' % number] = {
+                'comment': 'no comment',
+                'series_name_system': 'series_%s' % series_id,
+                'series_type': 'output',
+                'series_id': series_id,
+                'source': 'self',
+                'series_name_user': 'output_%s_%s' % (index, number)
+            }
+        layers[layer].append(model)
+        catalog.append(model)
+    return catalog
+
+
+# fills store with `timeseries` random walks of `days` days, named like ingested timeseries
+def generate_series(store, timeseries, days, seed=0):
+    rng = np.random.RandomState(seed)
+    timestamps = engine.get_days(START_DAY, days)
+    for index in range(timeseries):
+        values = 100 + np.cumsum(rng.standard_normal(days))
+        values[rng.random_sample(days) < 0.01] = np.nan
+        store.put(engine.get_timeseries_result_name(get_timeseries(index)), timestamps, values)
+
+
+# timeseries.json entry of a generated timeseries
+def get_timeseries(index):
+    return {'series_name_system': 'ts_%s' % index, 'ts_name': 'ts_%s' % index, 'ts_author': AUTHOR}
+
+
+# calls fn `repeat` times, returns timings in milliseconds
+def measure(fn, repeat):
+    timings = []
+    for index in range(repeat):
+        started = time.time()
+        fn()
+        timings.append((time.time() - started) * 1000)
+    timings.sort()
+    return {
+        'repeat': repeat,
+        'min_ms': timings[0],
+        'median_ms': timings[len(timings) // 2],
+        'mean_ms': sum(timings) / len(timings),
+        'max_ms': timings[-1]
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# imports the app with a fake Redis and points it to the synthetic catalog and series
+def create_app(catalog_path, series_path):
+    import fakeredis
+    redis_db.create_client = lambda *args, **kwargs: fakeredis.FakeRedis()
+    import app
+    app.app.config['WTF_CSRF_ENABLED'] = False
+    app.model_catalog = ModelCatalog(catalog_path)
+    app.series_store = SeriesStore(series_path)
+    results_summary.rebuild(app.db, app.series_store)
+    return app
+
+
+def run_benchmarks(args):
+    path = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        catalog_path = os.path.join(path, 'models.json')
+        models = generate_catalog(args.models, args.depth, args.fan_in, args.fan_out, args.series, args.seed)
+        with open(catalog_path, 'w') as f:
+            json.dump(models, f)
+        with open(os.path.join(path, 'timeseries.json'), 'w') as f:
+            json.dump([get_timeseries(index) for index in range(args.series)], f)
+        store = SeriesStore(os.path.join(path, 'series'))
+        generate_series(store, args.series, args.days, args.seed)
+        for model in models:
+            engine.register_evaluator(model['model_system_name'], SumEvaluator(model['outputs'].keys()))
+
+        app = create_app(catalog_path, store.path)
+        client = app.app.test_client()
+        catalog = app.model_catalog.refresh()
+
+        run_models = [model['model_system_name'] for model in models[-args.run_models:]]
+        commands = [
+            {'command': 'start_day', 'start_day': START_DAY},
+            {'command': 'number_of_days', 'number_of_days': args.run_days},
+            {'command': 'exe_models', 'include': run_models},
+            {
+                'command': 'change_timeseries_value_several_days_add_delta',
+                'input_source_initial': models[-1]['inputs']['input_0']['series_name_system'],
+                'start_day': START_DAY,
+                'number_of_days': args.run_days // 2,
+                'delta': 1.0
+            }
+        ]
+        run_form_data = {
+            'start_day': START_DAY,
+            'number_of_days': str(args.run_days),
+            'exe_models': run_models,
+            'change_timeseries_value_several_days_add_delta-0-input_source_initial':
+                commands[3]['input_source_initial'],
+            'change_timeseries_value_several_days_add_delta-0-start_day': START_DAY,
+            'change_timeseries_value_several_days_add_delta-0-number_of_days': str(args.run_days // 2),
+            'change_timeseries_value_several_days_add_delta-0-delta': '1.0'
+        }
+
+        def get(url):
+            response = client.get(url)
+            assert response.status_code in (200, 304), (url, response.status_code)
+
+        def post(url, **kwargs):
+            response = client.post(url, **kwargs)
+            assert response.status_code == 200, (url, response.status_code)
+            return response
+
+        def run_path():
+            job_id = json.loads(post('/run/form/submit', data=run_form_data).data)['job_id']
+            app.jobs.process(app.db, catalog, store, job_id)
+            assert app.jobs.get_job(app.db, job_id)['status'] == app.jobs.STATUS_DONE
+
+        cases = [
+            ('catalog_reload', lambda: catalog.reload()),
+            ('get_inputs_choices', lambda: app.get_inputs_choices()),
+            ('view_results', lambda: get('/results')),
+            ('view_results_series', lambda: get('/results/series?per_page=20&points=500')),
+            ('run_form_init', lambda: post('/run/form/init', data=json.dumps({'commands': commands}))),
+            ('run_form_choices', lambda: get('/run/form/choices')),
+            ('run_form_add', lambda: post('/run/form/add/change_timeseries_value_several_days',
+                                          data={'index': 1})),
+            ('run_form_submit', lambda: post('/run/form/submit', data=run_form_data)),
+            ('run_plan', lambda: engine.RunPlan(catalog, commands)),
+            ('run', run_path)
+        ]
+        results = {}
+        for name, fn in cases:
+            if args.only and name not in args.only:
+                continue
+            results[name] = measure(fn, args.run_repeat if name == 'run' else args.repeat)
+        return results
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks hot paths on synthetic data')
+    parser.add_argument('--models', type=int, default=100, help='number of models')
+    parser.add_argument('--depth', type=int, default=5, help='length of model chains')
+    parser.add_argument('--fan-in', type=int, default=3, help='inputs taken from upstream models')
+    parser.add_argument('--fan-out', type=int, default=2, help='outputs of every model')
+    parser.add_argument('--series', type=int, default=200, help='number of stored timeseries')
+    parser.add_argument('--days', type=int, default=3650, help='days of every stored timeseries')
+    parser.add_argument('--run-models', type=int, default=20, help='models executed by the run benchmark')
+    parser.add_argument('--run-days', type=int, default=365, help='days of the run benchmark')
+    parser.add_argument('--repeat', type=int, default=20, help='calls of every benchmark')
+    parser.add_argument('--run-repeat', type=int, default=3, help='calls of the run benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='*', help='names of benchmarks to run')
+    parser.add_argument('--output', help='file to write JSON results to instead of stdout')
+    args = parser.parse_args()
+
+    report = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'params': dict((key, value) for key, value in vars(args).items() if key != 'output'),
+        'results': run_benchmarks(args)
+    }
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(report, output, indent=4, sort_keys=True)
+    output.write('\n')
+    if args.output:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+import argparse
+
+import app
+
+# Seeds Redis and the series store, run once per deployment before starting app workers and job workers:
+# python bootstrap.py
+# Running it again only adds what is missing, data of earlier versions (registries kept as lists,
+# plaintext passwords) is upgraded in place. To start over from an empty database:
+# python bootstrap.py --reset
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Seeds shared application state')
+    parser.add_argument('--reset', action='store_true', help='flush the Redis database first, deletes all data')
+    args = parser.parse_args()
+    app.db_init(reset=args.reset)
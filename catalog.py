@@ -0,0 +1,301 @@
+import collections
+import fcntl
+import hashlib
+import itertools
+import json
+import os
+import re
+import threading
+import uuid
+
+import instrumentation
+
+
+# In-process index over models.json and timeseries.json next to it.
+# The files are parsed once and re-parsed only when their inode, mtime or size change
+# (or on explicit reload), so form building never touches the disk per entry.
+#
+# timeseries.json lists stored timeseries that model inputs take as sources:
+# [{"series_name_system": "series_0", "ts_name": "oil_Brent", "ts_author": "macbook"}, ...],
+# it maps source_series_name_system of a timeseries source to the stored series name.
+class ModelCatalog(object):
+    def __init__(self, path, timeseries_path=None):
+        self.path = path
+        self.timeseries_path = timeseries_path or os.path.join(os.path.dirname(path), 'timeseries.json')
+        self.version = None
+        self.models = []
+        self.timeseries = {}
+        self.models_by_name = {}
+        self.inputs_by_name = {}
+        self.models_choices = []
+        self.inputs_choices = []
+        self.inputs_choices_by_model = {}
+        self.producers = {}
+        self.consumers = {}
+        self.upstream = {}
+        self.downstream = {}
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def _get_stamp(self):
+        stamp = []
+        for path in (self.path, self.timeseries_path):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stamp.append(None)
+                continue
+            stamp.append((stat.st_ino, stat.st_mtime, stat.st_size))
+        return tuple(stamp)
+
+    def _load(self, stamp):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        try:
+            with open(self.timeseries_path, 'rb') as f:
+                timeseries_data = f.read()
+        except IOError:
+            timeseries_data = '[]'
+        with instrumentation.phase('load_json'):
+            models = json.loads(data)
+            timeseries = dict((item['series_name_system'], item) for item in json.loads(timeseries_data))
+
+        models_by_name = {}
+        inputs_by_name = {}
+        models_choices = []
+        inputs_choices = []
+        inputs_choices_by_model = {}
+        # lineage: output series_name_system -> (model, output),
+        # source series_name_system -> [(model name, input series_name_system)], model name -> model names
+        producers = {}
+        consumers = {}
+        upstream = {}
+        downstream = {}
+        for model in models:
+            name = model['model_system_name']
+            models_by_name[name] = model
+            models_choices.append((name, model['model_name_user'] + ':' + model['author']))
+            choices = []
+            for key, value in model['inputs'].iteritems():
+                inputs_by_name[value['series_name_system']] = value
+                choices.append((
+                    value['series_name_system'],
+                    value['series_name_system'] + ':' + value['series_name_user']
+                ))
+            inputs_choices_by_model[name] = choices
+            inputs_choices.extend(choices)
+            for value in model['outputs'].itervalues():
+                producers[value['series_name_system']] = (model, value)
+            upstream[name] = set()
+            downstream[name] = set()
+
+        for model in models:
+            name = model['model_system_name']
+            for value in model['inputs'].itervalues():
+                source = value['source']
+                consumers.setdefault(source['source_series_name_system'], []).append(
+                    (name, value['series_name_system'])
+                )
+                if source['source_type'] == 'output' and source['source_series_name_system'] in producers:
+                    producer = producers[source['source_series_name_system']][0]['model_system_name']
+                    if producer != name:
+                        upstream[name].add(producer)
+                        downstream[producer].add(name)
+
+        self.models = models
+        self.timeseries = timeseries
+        self.models_by_name = models_by_name
+        self.inputs_by_name = inputs_by_name
+        self.models_choices = models_choices
+        self.inputs_choices = inputs_choices
+        self.inputs_choices_by_model = inputs_choices_by_model
+        self.producers = producers
+        self.consumers = consumers
+        self.upstream = upstream
+        self.downstream = downstream
+        # content hash, stable across worker processes
+        self.version = hashlib.md5(data + timeseries_data).hexdigest()
+        self._stamp = stamp
+
+    # re-reads models.json if it has changed since the last load
+    def refresh(self):
+        stamp = self._get_stamp()
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp:
+                    self._load(stamp)
+        return self
+
+    # explicit invalidation hook, e.g. after models.json is rewritten in place
+    def reload(self):
+        with self._lock:
+            self._load(self._get_stamp())
+        return self
+
+    def get_models(self):
+        return self.refresh().models
+
+    def get_model(self, name):
+        return self.refresh().models_by_name[name]
+
+    def get_input(self, series_name_system):
+        return self.refresh().inputs_by_name[series_name_system]
+
+    # returns timeseries entry of a timeseries source_series_name_system or None
+    def get_timeseries(self, series_name_system):
+        return self.refresh().timeseries.get(series_name_system)
+
+    def get_models_choices(self):
+        return self.refresh().models_choices
+
+    def get_inputs_choices_by_model(self, name):
+        return self.refresh().inputs_choices_by_model[name]
+
+    def get_inputs_choices(self):
+        return self.refresh().inputs_choices
+
+    # returns {model name: distance} of models reachable from given models by upstream or downstream edges
+    def get_related_models(self, names, direction, depth=1):
+        self.refresh()
+        edges = self.upstream if direction == 'upstream' else self.downstream
+        names = set(names)
+        related = {}
+        queue = collections.deque((name, depth) for name in names)
+        while queue:
+            name, distance = queue.popleft()
+            for other in edges.get(name, ()):
+                if other not in related and other not in names:
+                    related[other] = distance
+                    queue.append((other, distance + 1))
+        return related
+
+    # models feeding given model, directly or through other models
+    def get_upstream_models(self, name):
+        return self.get_related_models([name], 'upstream')
+
+    # models affected by a change of given model
+    def get_downstream_models(self, name):
+        return self.get_related_models([name], 'downstream')
+
+    # returns (model name, input series_name_system) of inputs reading given output or timeseries
+    def get_series_consumers(self, series_name_system):
+        return self.refresh().consumers.get(series_name_system, [])
+
+    # returns model producing given output series, if any
+    def get_series_producer(self, series_name_system):
+        producer = self.refresh().producers.get(series_name_system)
+        return producer[0] if producer else None
+
+    # models affected by a change of given series: its consumers at distance 1 and their downstream models
+    def get_series_downstream_models(self, series_name_system):
+        consumers = set(name for name, input_name in self.get_series_consumers(series_name_system))
+        related = self.get_related_models(consumers, 'downstream', 2)
+        related.update((name, 1) for name in consumers)
+        return related
+
+    # models the series depends on: its producer at distance 1 and the producer's upstream models
+    def get_series_upstream_models(self, series_name_system):
+        producer = self.get_series_producer(series_name_system)
+        if not producer:
+            return {}
+        related = self.get_related_models([producer['model_system_name']], 'upstream', 2)
+        related[producer['model_system_name']] = 1
+        return related
+
+    # Rewrites a catalog file with update(data) under an exclusive lock shared by all processes
+    # and both files, so series ids are allocated once. update changes the loaded list in place
+    # and returns its result.
+    def _update(self, path, update):
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(path, 'rb') as f:
+                        data = json.load(f)
+                except IOError:
+                    data = []
+                result = update(data)
+                tmp_path = '%s.%s.tmp' % (path, uuid.uuid4())
+                with open(tmp_path, 'wb') as f:
+                    json.dump(data, f, indent=2, sort_keys=True)
+                os.rename(tmp_path, path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.reload()
+        return result
+
+    # largest number of series_<number> ids used by models and timeseries
+    def _get_last_series_id(self, models, timeseries):
+        names = [item['series_name_system'] for item in timeseries]
+        for model in models:
+            for value in model['inputs'].values():
+                names.extend([value['series_name_system'], value['source']['source_series_name_system']])
+            names.extend(value['series_name_system'] for value in model['outputs'].values())
+        ids = [int(match.group(1)) for match in (re.match(r'^series_(\d+)$', name) for name in names) if match]
+        return max(ids) if ids else -1
+
+    # registers stored timeseries, returns its entry, an already registered one is returned as is
+    def add_timeseries(self, ts_name, ts_author):
+        def update(timeseries):
+            for item in timeseries:
+                if item['ts_name'] == ts_name and item['ts_author'] == ts_author:
+                    return item
+            with open(self.path, 'rb') as f:
+                models = json.load(f)
+            item = {
+                'series_name_system': 'series_%s' % (self._get_last_series_id(models, timeseries) + 1),
+                'ts_name': ts_name,
+                'ts_author': ts_author
+            }
+            timeseries.append(item)
+            return item
+
+        return self._update(self.timeseries_path, update)
+
+    # Registers model of a compiled workbook, returns its entry. workbook is relative to models.json,
+    # input_sources are {input name: source} and output_names are names of output cells.
+    # Raises ValueError when the author already has a model of the same name.
+    def add_model(self, model_name_user, author, workbook, input_sources, output_names):
+        def update(models):
+            for model in models:
+                if model['model_name_user'] == model_name_user and model['author'] == author:
+                    raise ValueError('Model %s of %s already exists' % (model_name_user, author))
+            try:
+                with open(self.timeseries_path, 'rb') as f:
+                    timeseries = json.load(f)
+            except IOError:
+                timeseries = []
+            series_ids = itertools.count(self._get_last_series_id(models, timeseries) + 1)
+            model_ids = [int(match.group(1)) for match in
+                         (re.match(r'^model_(\d+)$', model['model_system_name']) for model in models) if match]
+            model = {
+                'model_system_name': 'model_%s' % (max(model_ids) + 1 if model_ids else 0),
+                'model_name_user': model_name_user,
+                'author': author,
+                'workbook': workbook,
+                'inputs': {},
+                'outputs': {}
+            }
+            for name, source in sorted(input_sources.items()):
+                series_id = str(next(series_ids))
+                model['inputs'][name] = {
+                    'series_id': series_id,
+                    'series_type': 'input',
+                    'series_name_system': 'series_%s' % series_id,
+                    'series_name_user': name,
+                    'source': source
+                }
+            for name in sorted(output_names):
+                series_id = str(next(series_ids))
+                model['outputs'][name] = {
+                    'series_id': series_id,
+                    'series_type': 'output',
+                    'series_name_system': 'series_%s' % series_id,
+                    'series_name_user': name,
+                    'source': 'self',
+                    'comment': 'no comment'
+                }
+            models.append(model)
+            return model
+
+        return self._update(self.path, update)
@@ -0,0 +1,110 @@
+import numpy as np
+
+from series_store import values_to_list
+
+# Run-to-run comparison of output series.
+# Runs are (days, names, values matrix with a row per name) as kept by jobs.put_job_arrays.
+# Days of both runs are merge-joined once, then deltas and statistics of all common series
+# are computed on the aligned matrices, a column per statistic.
+STATS = ('points', 'changed', 'first_changed', 'max_abs_delta', 'mean_delta',
+         'baseline_total', 'scenario_total', 'relative_total', 'max_abs_relative_delta')
+
+
+# Merge-join of two sorted unique timestamp arrays,
+# returns (union of timestamps, position in a or -1, position in b or -1)
+def merge_join(a, b):
+    days = np.union1d(a, b)
+    return days, get_positions(a, days), get_positions(b, days)
+
+
+def get_positions(timestamps, days):
+    if not len(timestamps):
+        return np.full(len(days), -1, dtype=np.int64)
+    positions = np.searchsorted(timestamps, days)
+    positions[positions == len(timestamps)] = 0
+    return np.where(timestamps[positions] == days, positions, -1)
+
+
+# returns rows of values aligned with days, NaN where the run has no point
+def align(values, positions):
+    aligned = np.full((len(values), len(positions)), np.nan)
+    found = positions >= 0
+    aligned[:, found] = values[:, positions[found]]
+    return aligned
+
+
+# maximum of every row, -inf for rows of no columns
+def row_max(matrix):
+    if not matrix.shape[1]:
+        return np.full(len(matrix), -np.inf)
+    return matrix.max(axis=1)
+
+
+# Compares scenario run against baseline run.
+# Points are compared where both runs have a value, a point is changed when its absolute delta exceeds tolerance.
+# Relative deltas are relative to the baseline value, null where the baseline is 0.
+# Returns {'days', 'series': [{'name', <STATS>}], 'baseline_only', 'scenario_only'},
+# with deltas=True changed series also get 'x' (timestamps) and 'delta', 'relative_delta' lists.
+def compare(baseline, scenario, tolerance=0.0, changed_only=False, deltas=False):
+    baseline_days, baseline_names, baseline_values = baseline
+    scenario_days, scenario_names, scenario_values = scenario
+    baseline_rows = dict((name, row) for row, name in enumerate(baseline_names))
+    scenario_rows = dict((name, row) for row, name in enumerate(scenario_names))
+    names = sorted(set(baseline_rows) & set(scenario_rows))
+
+    days, baseline_positions, scenario_positions = merge_join(baseline_days, scenario_days)
+    base = align(baseline_values[[baseline_rows[name] for name in names]], baseline_positions)
+    other = align(scenario_values[[scenario_rows[name] for name in names]], scenario_positions)
+
+    compared = ~np.isnan(base) & ~np.isnan(other)
+    delta = np.where(compared, other - base, 0.0)
+    abs_delta = np.abs(delta)
+    changed = abs_delta > tolerance
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative = np.where(compared & (base != 0), delta / np.abs(base), np.nan)
+
+    points = compared.sum(axis=1)
+    counted = points > 0
+    changed_count = changed.sum(axis=1)
+    has_changed = changed_count > 0
+    baseline_total = np.where(compared, base, 0.0).sum(axis=1)
+    scenario_total = np.where(compared, other, 0.0).sum(axis=1)
+    first_changed = days[changed.argmax(axis=1)].tolist() if len(days) else [None] * len(names)
+    max_abs_relative = row_max(np.where(np.isnan(relative), -np.inf, np.abs(relative)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats = {
+            'points': points.tolist(),
+            'changed': changed_count.tolist(),
+            'first_changed': [day if row_changed else None for day, row_changed in zip(first_changed, has_changed)],
+            'max_abs_delta': values_to_list(np.where(counted, row_max(abs_delta), np.nan)),
+            'mean_delta': values_to_list(np.where(counted, delta.sum(axis=1) / points, np.nan)),
+            'baseline_total': values_to_list(np.where(counted, baseline_total, np.nan)),
+            'scenario_total': values_to_list(np.where(counted, scenario_total, np.nan)),
+            'relative_total': values_to_list(np.where(
+                counted & (baseline_total != 0), (scenario_total - baseline_total) / np.abs(baseline_total), np.nan)),
+            'max_abs_relative_delta': values_to_list(np.where(np.isinf(max_abs_relative), np.nan, max_abs_relative))
+        }
+
+    series = []
+    for row, name in enumerate(names):
+        if changed_only and not has_changed[row]:
+            continue
+        item = dict((stat, stats[stat][row]) for stat in STATS)
+        item['name'] = name
+        if deltas and has_changed[row]:
+            mask = changed[row]
+            item['x'] = days[mask].tolist()
+            item['delta'] = values_to_list(delta[row, mask])
+            item['relative_delta'] = values_to_list(relative[row, mask])
+        series.append(item)
+
+    return {
+        'days': {
+            'compared': int(np.count_nonzero((baseline_positions >= 0) & (scenario_positions >= 0))),
+            'baseline_only': int(np.count_nonzero(scenario_positions < 0)),
+            'scenario_only': int(np.count_nonzero(baseline_positions < 0))
+        },
+        'series': series,
+        'baseline_only': sorted(set(baseline_rows) - set(scenario_rows)),
+        'scenario_only': sorted(set(scenario_rows) - set(baseline_rows))
+    }
@@ -0,0 +1,65 @@
+import numpy as np
+
+
+# Largest-Triangle-Three-Buckets, keeps the shape of the line with `threshold` points.
+# Null (NaN) points are dropped before downsampling.
+def lttb(timestamps, values, threshold):
+    finite = ~np.isnan(values)
+    if not finite.all():
+        timestamps, values = timestamps[finite], values[finite]
+    count = len(timestamps)
+    if threshold < 3 or count <= threshold:
+        return timestamps, values
+
+    x = np.asarray(timestamps, dtype=np.float64)
+    y = np.asarray(values, dtype=np.float64)
+    # first and last points are always kept, the rest is split into threshold - 2 buckets
+    edges = np.append(np.linspace(1, count - 1, threshold - 1).astype(np.int64), count)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = count - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start, next_end = edges[bucket + 1], edges[bucket + 2]
+        average_x = x[next_start:next_end].mean()
+        average_y = y[next_start:next_end].mean()
+        areas = np.abs(
+            (x[previous] - average_x) * (y[start:end] - y[previous]) -
+            (x[previous] - x[start:end]) * (average_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    return timestamps[selected], values[selected]
+
+
+# Keeps minimum and maximum of every bucket in time order, so spikes survive downsampling.
+# A bucket of nulls keeps its first point to show the gap.
+def min_max(timestamps, values, threshold):
+    count = len(timestamps)
+    if threshold < 2 or count <= threshold:
+        return timestamps, values
+
+    edges = np.linspace(0, count, threshold // 2 + 1).astype(np.int64)
+    selected = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        if start == end:
+            continue
+        bucket = values[start:end]
+        if np.isnan(bucket).all():
+            selected.append(start)
+            continue
+        low, high = start + int(np.nanargmin(bucket)), start + int(np.nanargmax(bucket))
+        selected.extend(sorted(set([low, high])))
+    selected = np.asarray(selected, dtype=np.int64)
+    return timestamps[selected], values[selected]
+
+
+METHODS = {
+    'lttb': lttb,
+    'minmax': min_max
+}
+
+
+def downsample(timestamps, values, threshold, method='lttb'):
+    return METHODS[method](np.asarray(timestamps), np.asarray(values), threshold)
@@ -0,0 +1,466 @@
+import Queue
+import hashlib
+import json
+import multiprocessing
+import traceback
+from datetime import datetime
+
+import numpy as np
+
+import series_names
+
+DAY_MS = 24 * 60 * 60 * 1000
+# seconds a run waits for the next model to finish before it fails, e.g. when a pool process was killed
+MODEL_TIMEOUT = 60 * 60
+EPOCH = datetime(1970, 1, 1)
+INF = float('inf')
+# longest run and longest day range of a value command
+MAX_NUMBER_OF_DAYS = 100 * 366
+
+# model_system_name -> callable(inputs, number_of_days) -> outputs,
+# where inputs and outputs are dicts of float64 arrays (NaN for null) keyed by the model's input/output keys
+evaluators = {}
+
+
+class RunError(Exception):
+    pass
+
+
+def register_evaluator(model_system_name, evaluator):
+    evaluators[model_system_name] = evaluator
+
+
+# identifies evaluator in model cache keys, an evaluator may define its own version
+def get_evaluator_version(model_system_name):
+    evaluator = evaluators.get(model_system_name)
+    if evaluator is None:
+        return None
+    return getattr(evaluator, 'version', None) or id(evaluator)
+
+
+def fingerprint(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True)).hexdigest()
+
+
+def fingerprint_values(values):
+    return hashlib.sha1(np.ascontiguousarray(values, dtype=np.float64).tostring()).hexdigest()
+
+
+def str_to_day(value):
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d')
+
+
+def day_to_timestamp(day):
+    return int((day - EPOCH).total_seconds()) * 1000
+
+
+def get_field_label(command, field):
+    return field if field == command['command'] else '%s of %s' % (field, command['command'])
+
+
+# Checks values of a command before any arithmetic on them, commands come from JSON bodies of any shape
+def check_day(command, field):
+    value = command.get(field)
+    try:
+        if not isinstance(value, basestring):
+            raise ValueError
+        return str_to_day(value)
+    except ValueError:
+        raise RunError('%s should be a day as YYYY-MM-DD' % get_field_label(command, field))
+
+
+def check_number(command, field, minimum=None, maximum=None, integer=False):
+    value = command.get(field)
+    types = (int, long) if integer else (int, long, float)
+    if isinstance(value, bool) or not isinstance(value, types) or value in (INF, -INF) or value != value:
+        raise RunError('%s should be %s' % (get_field_label(command, field), 'an integer' if integer else 'a number'))
+    if minimum is not None and value < minimum or maximum is not None and value > maximum:
+        raise RunError('%s should be from %s to %s' % (get_field_label(command, field), minimum, maximum))
+    return value
+
+
+# returns array of millisecond timestamps of days being modeled
+def get_days(start_day, number_of_days):
+    start = day_to_timestamp(str_to_day(start_day))
+    return start + DAY_MS * np.arange(number_of_days, dtype=np.int64)
+
+
+def get_output_result_name(model, output):
+    return series_names.output_name(output['series_name_user'], model['author'], model['model_name_user'])
+
+
+# timeseries is an entry of catalog timeseries
+def get_timeseries_result_name(timeseries):
+    return series_names.timeseries_name(timeseries['ts_name'], timeseries['ts_author'])
+
+
+def get_input_result_name(model, input_value, source, source_name_user):
+    return series_names.intermediate_input_name(
+        input_value['series_name_user'], model['model_name_user'], model['author'],
+        source_name_user, source['source_author'],
+        source['source_model_name_user'] if source['source_type'] == 'output' else None
+    )
+
+
+class RunPlan(object):
+    def __init__(self, catalog, commands):
+        def get_command(command_name):
+            return [item for item in commands if item['command'] == command_name]
+
+        if not get_command('start_day') or not get_command('number_of_days') or not get_command('exe_models'):
+            raise RunError('start_day, number_of_days and exe_models are required')
+
+        check_day(get_command('start_day')[0], 'start_day')
+        check_number(get_command('number_of_days')[0], 'number_of_days', 1, MAX_NUMBER_OF_DAYS, integer=True)
+        self.start_day = get_command('start_day')[0]['start_day']
+        self.number_of_days = get_command('number_of_days')[0]['number_of_days']
+        self.days = get_days(self.start_day, self.number_of_days)
+        self.catalog = catalog.refresh()
+
+        self.models = {}
+        for name in get_command('exe_models')[0]['include']:
+            if name not in catalog.models_by_name:
+                raise RunError('Unknown model %s' % name)
+            self.models[name] = catalog.models_by_name[name]
+
+        # output series_name_system -> (model, output) for every known model
+        self.producers = catalog.producers
+        # timeseries series_name_system -> stored timeseries entry
+        self.timeseries = catalog.timeseries
+
+        # input series_name_system -> effective source after input swaps and the input it was taken from
+        self.sources = {}
+        self.source_inputs = {}
+        for model in self.models.values():
+            for input_value in model['inputs'].values():
+                self.sources[input_value['series_name_system']] = input_value['source']
+                self.source_inputs[input_value['series_name_system']] = input_value
+
+        def get_input(name):
+            if name not in catalog.inputs_by_name:
+                raise RunError('Unknown input %s' % name)
+            return catalog.inputs_by_name[name]
+
+        for command in get_command('change_input_series_one_model'):
+            if command['model_system_name'] not in catalog.models_by_name:
+                raise RunError('Unknown model %s' % command['model_system_name'])
+            model = catalog.models_by_name[command['model_system_name']]
+            initial = get_input(command['input_source_initial'])
+            final = get_input(command['input_source_final'])
+            if initial['series_name_system'] not in [value['series_name_system'] for value in model['inputs'].values()]:
+                raise RunError('Input %s is not an input of model %s' % (
+                    command['input_source_initial'], command['model_system_name']))
+            # swaps of models outside of the run change nothing
+            if command['model_system_name'] in self.models:
+                self.sources[initial['series_name_system']] = final['source']
+                self.source_inputs[initial['series_name_system']] = final
+
+        for command in get_command('change_input_series_all_models'):
+            initial = get_input(command['input_source_initial'])
+            final = get_input(command['input_source_final'])
+            initial_source = initial['source']['source_series_name_system']
+            for name, source in self.sources.items():
+                if source['source_series_name_system'] == initial_source:
+                    self.sources[name] = final['source']
+                    self.source_inputs[name] = final
+
+        for name, source in self.sources.items():
+            if source['source_type'] == 'output':
+                if source['source_series_name_system'] not in self.producers:
+                    raise RunError('Input %s reads unknown output %s' % (name, source['source_series_name_system']))
+            elif source['source_series_name_system'] not in self.timeseries:
+                raise RunError('Input %s reads unknown timeseries %s' % (name, source['source_series_name_system']))
+
+        # input series_name_system -> list of value commands applied in given order,
+        # along with their day ranges as (start, end) indexes of days
+        self.value_commands = {}
+        self.value_command_ranges = {}
+        for command in commands:
+            if command['command'] in ('change_timeseries_value_several_days',
+                                      'change_timeseries_value_several_days_add_delta'):
+                get_input(command['input_source_initial'])
+                if command['command'] == 'change_timeseries_value_several_days':
+                    check_number(command, 'new_value')
+                else:
+                    check_number(command, 'delta')
+                start = day_to_timestamp(check_day(command, 'start_day'))
+                end = start + check_number(command, 'number_of_days', 0, MAX_NUMBER_OF_DAYS, integer=True) * DAY_MS
+                self.value_commands.setdefault(command['input_source_initial'], []).append(command)
+                self.value_command_ranges.setdefault(command['input_source_initial'], []).append(
+                    tuple(np.searchsorted(self.days, [start, end]))
+                )
+
+        self.upstream = dict((name, set()) for name in self.models)
+        self.downstream = dict((name, set()) for name in self.models)
+        for name, model in self.models.items():
+            for input_value in model['inputs'].values():
+                producer = self.get_producer(self.sources[input_value['series_name_system']])
+                if producer and producer != name:
+                    self.upstream[name].add(producer)
+                    self.downstream[producer].add(name)
+        self.order = self.get_order()
+
+    # returns name of a model of this run producing given source, if any
+    def get_producer(self, source):
+        if source['source_type'] != 'output':
+            return None
+        model, output = self.producers.get(source['source_series_name_system'], (None, None))
+        if model and model['model_system_name'] in self.models:
+            return model['model_system_name']
+        return None
+
+    # topological order of models, fails on cyclic wiring
+    def get_order(self):
+        pending = dict((name, len(deps)) for name, deps in self.upstream.items())
+        ready = sorted(name for name, count in pending.items() if count == 0)
+        order = []
+        while ready:
+            name = ready.pop()
+            order.append(name)
+            for consumer in sorted(self.downstream[name]):
+                pending[consumer] -= 1
+                if pending[consumer] == 0:
+                    ready.append(consumer)
+        if len(order) != len(self.models):
+            cycle = sorted(name for name, count in pending.items() if count > 0)
+            raise RunError('Models have cyclic dependencies: %s' % ', '.join(cycle))
+        return order
+
+    def get_source_result_name(self, source):
+        if source['source_type'] == 'output':
+            model, output = self.producers[source['source_series_name_system']]
+            return get_output_result_name(model, output)
+        return get_timeseries_result_name(self.timeseries[source['source_series_name_system']])
+
+    # Name of the source in intermediate input names: name of the output for model outputs,
+    # name of the input the timeseries was wired to for timeseries (e.g. oil for oil_Brent).
+    def get_source_name_user(self, input_name):
+        source = self.sources[input_name]
+        if source['source_type'] == 'output':
+            model, output = self.producers[source['source_series_name_system']]
+            return output['series_name_user']
+        return self.source_inputs[input_name]['series_name_user']
+
+    # Applies all value commands of the input in one pass over its values.
+    # Commands only fill their day ranges of new value and delta arrays,
+    # a new value resets deltas of preceding commands in its range, nulls stay nulls under a delta.
+    def apply_value_commands(self, name, values):
+        values = np.asarray(values, dtype=np.float64)
+        commands = self.value_commands.get(name)
+        if not commands:
+            return values
+        is_set = np.zeros(len(values), dtype=bool)
+        new_values = np.zeros(len(values))
+        deltas = np.zeros(len(values))
+        for command, (start, end) in zip(commands, self.value_command_ranges[name]):
+            if command['command'] == 'change_timeseries_value_several_days':
+                is_set[start:end] = True
+                new_values[start:end] = command['new_value']
+                deltas[start:end] = 0
+            else:
+                deltas[start:end] += command['delta']
+        return np.where(is_set, new_values, values) + deltas
+
+    # Returns cache key of the model run. Outputs of upstream models are fingerprinted by keys of their runs,
+    # so the key covers the model, days, contents of input sources and value commands on the inputs.
+    def get_model_key(self, name, fingerprints, load_series):
+        model = self.models[name]
+        key_parts = [name, model, self.start_day, self.number_of_days, get_evaluator_version(name)]
+        for key, input_value in sorted(model['inputs'].items()):
+            input_name = input_value['series_name_system']
+            source = self.sources[input_name]
+            if self.get_producer(source):
+                source_fingerprint = fingerprints[source['source_series_name_system']]
+            else:
+                source_fingerprint = fingerprint_values(load_series(self.get_source_result_name(source), self.days))
+            key_parts.append([key, source_fingerprint, self.value_commands.get(input_name, [])])
+        return fingerprint(key_parts)
+
+    # returns model inputs keyed by input key, outputs of upstream models are taken from series
+    def get_inputs(self, name, series, load_series):
+        model = self.models[name]
+        inputs = {}
+        for key, input_value in model['inputs'].items():
+            input_name = input_value['series_name_system']
+            source = self.sources[input_name]
+            if self.get_producer(source):
+                values = series[source['source_series_name_system']]
+            else:
+                values = load_series(self.get_source_result_name(source), self.days)
+            inputs[key] = self.apply_value_commands(input_name, values)
+        return inputs
+
+    # returns computed inputs and outputs of models keyed by result name, values are aligned with days
+    def get_results(self, model_inputs, series):
+        results = {}
+        for name, inputs in model_inputs.items():
+            model = self.models[name]
+            for key, input_value in model['inputs'].items():
+                input_name = input_value['series_name_system']
+                result_name = get_input_result_name(model, input_value, self.sources[input_name],
+                                                    self.get_source_name_user(input_name))
+                results[result_name] = inputs[key]
+            for output in model['outputs'].values():
+                results[get_output_result_name(model, output)] = series[output['series_name_system']]
+        return results
+
+
+# executes one model, runs in a pool process
+def run_model(model, inputs, number_of_days):
+    evaluator = evaluators.get(model['model_system_name'])
+    if evaluator is None:
+        raise RunError('Model %s has no evaluator' % model['model_system_name'])
+    outputs = evaluator(inputs, number_of_days)
+    missing = sorted(set(model['outputs']) - set(outputs))
+    if missing:
+        raise RunError('Model %s did not compute outputs %s' % (model['model_system_name'], ', '.join(missing)))
+    return dict(
+        (output['series_name_system'], np.asarray(outputs[key], dtype=np.float64))
+        for key, output in model['outputs'].items()
+    )
+
+
+def run_model_safe(model, inputs, number_of_days):
+    try:
+        return run_model(model, inputs, number_of_days), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+# returns load_series reading every stored series only once for given days
+def memoize_load_series(load_series):
+    loaded = {}
+
+    def load(name, days):
+        key = (name, int(days[0]), len(days))
+        if key not in loaded:
+            loaded[key] = load_series(name, days)
+        return loaded[key]
+
+    return load
+
+
+# Runs models of the plan in a process pool.
+# A model is submitted as soon as all its upstream models are done,
+# so run time follows the critical path of the model graph.
+# load_series(result_name, days) returns values array of a stored series aligned with days,
+# progress(models_done, models_total) is called after each model, an exception raised from it aborts the run.
+# With cache (see ResultCache) models whose inputs did not change since a previous run are not recomputed,
+# the pool is started only if some model has to be computed.
+def run(plan, load_series, processes=None, progress=None, cache=None, timeout=MODEL_TIMEOUT):
+    results = []
+    run_plans([plan], load_series, processes, progress, cache, lambda index, plan_results: results.append(plan_results),
+              timeout)
+    return results[0]
+
+
+# Runs several plans sharing one process pool.
+# Every model run is identified by its cache key, so a model run with the same inputs in several plans
+# (e.g. upstream of a changed input) is computed once and its outputs are shared.
+# on_plan_done(plan_index, results) is called as soon as all models of a plan are done.
+# The run fails when no model finishes within timeout seconds.
+def run_plans(plans, load_series, processes=None, progress=None, cache=None, on_plan_done=None,
+              timeout=MODEL_TIMEOUT):
+    # models without evaluator would only produce nulls, which must never be stored over computed series
+    missing = sorted(set(name for plan in plans for name in plan.models if name not in evaluators))
+    if missing:
+        raise RunError('Models have no evaluator: %s' % ', '.join(missing))
+    load_series = memoize_load_series(load_series)
+
+    # model runs of all plans: key -> (plan index, model name) and keys of upstream model runs
+    tasks = {}
+    upstream = {}
+    downstream = {}
+    plan_keys = []
+    for index, plan in enumerate(plans):
+        keys = {}
+        fingerprints = {}
+        for name in plan.order:
+            key = keys[name] = plan.get_model_key(name, fingerprints, load_series)
+            for output in plan.models[name]['outputs'].values():
+                fingerprints[output['series_name_system']] = fingerprint([key, output['series_name_system']])
+            if key not in tasks:
+                tasks[key] = (index, name)
+                upstream[key] = set(keys[producer] for producer in plan.upstream[name])
+                downstream.setdefault(key, set())
+                for producer_key in upstream[key]:
+                    downstream[producer_key].add(key)
+        plan_keys.append(keys)
+
+    outputs = {}
+    inputs = {}
+    cached = set()
+    pending = dict((key, set(deps)) for key, deps in upstream.items())
+    plans_pending = [set(keys.values()) for keys in plan_keys]
+    done = Queue.Queue()
+    pools = []
+
+    def submit(key):
+        index, name = tasks[key]
+        plan = plans[index]
+        series = {}
+        for producer in plan.upstream[name]:
+            series.update(outputs[plan_keys[index][producer]])
+        inputs[key] = plan.get_inputs(name, series, load_series)
+        task_outputs = cache.get(key) if cache is not None else None
+        if task_outputs is not None:
+            cached.add(key)
+            done.put((key, (task_outputs, None)))
+            return
+        if not pools:
+            pools.append(multiprocessing.Pool(processes))
+        pools[0].apply_async(
+            run_model_safe,
+            (plan.models[name], inputs[key], plan.number_of_days),
+            callback=lambda result: done.put((key, result))
+        )
+
+    def get_plan_results(index):
+        plan, keys = plans[index], plan_keys[index]
+        series = {}
+        for key in keys.values():
+            series.update(outputs[key])
+        return plan.get_results(dict((name, inputs[key]) for name, key in keys.items()), series)
+
+    try:
+        # plans without models are done right away
+        for index, keys in enumerate(plans_pending):
+            if not keys and on_plan_done:
+                on_plan_done(index, {})
+        running = 0
+        for key, deps in pending.items():
+            if not deps:
+                submit(key)
+                running += 1
+        while running:
+            try:
+                key, (task_outputs, error) = done.get(timeout=timeout)
+            except Queue.Empty:
+                raise RunError('No model finished in %s seconds, %s models are still running' % (timeout, running))
+            running -= 1
+            if error:
+                raise RunError('Model %s failed:\n%s' % (tasks[key][1], error))
+            if cache is not None and key not in cached:
+                cache.put(key, task_outputs, sum(values.nbytes for values in task_outputs.values()))
+            outputs[key] = task_outputs
+            if progress:
+                progress(len(outputs), len(tasks))
+            for index, keys in enumerate(plans_pending):
+                if key in keys:
+                    keys.discard(key)
+                    if not keys and on_plan_done:
+                        on_plan_done(index, get_plan_results(index))
+            for consumer in downstream[key]:
+                pending[consumer].discard(key)
+                if not pending[consumer]:
+                    submit(consumer)
+                    running += 1
+        for pool in pools:
+            pool.close()
+    except Exception:
+        for pool in pools:
+            pool.terminate()
+        raise
+    finally:
+        for pool in pools:
+            pool.join()
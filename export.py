@@ -0,0 +1,134 @@
+import csv
+import io
+import itertools
+import json
+import struct
+
+import numpy as np
+
+from engine import DAY_MS
+from series_store import values_to_list
+
+# Bulk export of result series as streams of byte chunks, memory use does not depend on the size of the export:
+# series are read from the memory-mapped store CHUNK_POINTS points (or WIDE_CHUNK_DAYS days) at a time.
+CHUNK_POINTS = 64 * 1024
+WIDE_CHUNK_DAYS = 1000
+
+# Columnar format: header (magic, format version), then row groups, then footer.
+# A row group holds up to CHUNK_POINTS points of one series: int64 millisecond timestamps, then float64 values
+# (NaN for null). The footer is JSON {"columns": [...], "row_groups": [{"name", "offset", "count"}]}
+# followed by its uint64 length and the magic, so readers find row groups from the end of the file.
+COLUMNAR_MAGIC = 'ECCX'
+COLUMNAR_VERSION = 1
+COLUMNAR_HEADER = struct.Struct('<4sI')
+COLUMNAR_FOOTER = struct.Struct('<Q4s')
+
+
+def encode(name):
+    return name.encode('utf-8') if isinstance(name, unicode) else name
+
+
+def to_days(timestamps):
+    return np.asarray(timestamps, dtype=np.int64).astype('datetime64[ms]').astype('datetime64[D]').astype(str)
+
+
+def write_rows(rows):
+    buffer = io.BytesIO()
+    csv.writer(buffer, lineterminator='\n').writerows(rows)
+    return buffer.getvalue()
+
+
+# returns series sliced to [start, end], None means unbounded
+def get_slice(get_series, name, start, end):
+    series = get_series(name)
+    if series is None:
+        return None
+    return series.slice(start, end)
+
+
+# CSV with a row per point: name, day, value
+def export_long(get_series, names, start=None, end=None):
+    yield write_rows([['name', 'day', 'value']])
+    for name in names:
+        series = get_slice(get_series, name, start, end)
+        if series is None:
+            continue
+        for left in range(0, len(series), CHUNK_POINTS):
+            right = left + CHUNK_POINTS
+            yield write_rows(itertools.izip(
+                itertools.repeat(encode(name)),
+                to_days(series.timestamps[left:right]),
+                values_to_list(series.values[left:right])
+            ))
+
+
+# CSV with a row per day and a column per series, days without a point in any series are skipped
+def export_wide(get_series, names, start=None, end=None):
+    yield write_rows([['day'] + [encode(name) for name in names]])
+    all_series = [get_slice(get_series, name, start, end) for name in names]
+    bounds = [(int(series.timestamps[0]), int(series.timestamps[-1]))
+              for series in all_series if series is not None and len(series)]
+    if not bounds:
+        return
+    first, last = min(bound[0] for bound in bounds), max(bound[1] for bound in bounds)
+    for window_start in xrange(first, last + 1, WIDE_CHUNK_DAYS * DAY_MS):
+        window = [
+            series.slice(window_start, window_start + WIDE_CHUNK_DAYS * DAY_MS - 1) if series is not None else None
+            for series in all_series
+        ]
+        timestamps = reduce(np.union1d, [series.timestamps for series in window if series is not None],
+                            np.empty(0, dtype=np.int64))
+        if not len(timestamps):
+            continue
+        columns = [to_days(timestamps)]
+        for series in window:
+            columns.append(values_to_list(series.values_at(timestamps)) if series is not None
+                           else [None] * len(timestamps))
+        yield write_rows(itertools.izip(*columns))
+
+
+# columnar binary with a row group per CHUNK_POINTS points of a series, row groups are indexed in the footer
+def export_columnar(get_series, names, start=None, end=None):
+    yield COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION)
+    offset = COLUMNAR_HEADER.size
+    row_groups = []
+    for name in names:
+        series = get_slice(get_series, name, start, end)
+        if series is None:
+            continue
+        for left in range(0, len(series), CHUNK_POINTS):
+            timestamps = np.ascontiguousarray(series.timestamps[left:left + CHUNK_POINTS], dtype='<i8')
+            values = np.ascontiguousarray(series.values[left:left + CHUNK_POINTS], dtype='<f8')
+            row_groups.append({'name': name, 'offset': offset, 'count': len(timestamps)})
+            yield timestamps.tostring() + values.tostring()
+            offset += 16 * len(timestamps)
+    footer = json.dumps({'columns': ['timestamp', 'value'], 'row_groups': row_groups})
+    yield footer + COLUMNAR_FOOTER.pack(len(footer), COLUMNAR_MAGIC)
+
+
+# reads columnar export from a seekable file, yields (name, timestamps, values) row groups
+def read_columnar(f):
+    magic, version = COLUMNAR_HEADER.unpack(f.read(COLUMNAR_HEADER.size))
+    if magic != COLUMNAR_MAGIC or version != COLUMNAR_VERSION:
+        raise ValueError('Not a columnar export')
+    f.seek(-COLUMNAR_FOOTER.size, io.SEEK_END)
+    length, magic = COLUMNAR_FOOTER.unpack(f.read(COLUMNAR_FOOTER.size))
+    f.seek(-COLUMNAR_FOOTER.size - length, io.SEEK_END)
+    footer = json.loads(f.read(length))
+    for row_group in footer['row_groups']:
+        f.seek(row_group['offset'])
+        count = row_group['count']
+        yield (row_group['name'], np.frombuffer(f.read(8 * count), dtype='<i8'),
+               np.frombuffer(f.read(8 * count), dtype='<f8'))
+
+
+EXPORTERS = {
+    'long': export_long,
+    'wide': export_wide,
+    'columnar': export_columnar
+}
+
+
+# returns generator of byte chunks of the export of named series in export_format
+def export(export_format, get_series, names, start=None, end=None):
+    return EXPORTERS[export_format](get_series, names, start, end)
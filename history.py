@@ -0,0 +1,55 @@
+import json
+import time
+
+# most recent runs kept per owner
+MAX_ITEMS = 1000
+
+
+def history_key(owner):
+    return 'run:history:%s' % owner
+
+
+def item_key(owner, job_id):
+    return 'run:history:%s:%s' % (owner, job_id)
+
+
+# History of runs is a sorted set of job ids scored by run time in milliseconds,
+# commands of every run are kept in a separate key.
+def add(db, owner, job_id, commands, timestamp=None):
+    timestamp = timestamp or int(time.time() * 1000)
+    pipe = db.pipeline()
+    pipe.set(item_key(owner, job_id), json.dumps(commands))
+    pipe.zadd(history_key(owner), job_id, timestamp)
+    pipe.zrange(history_key(owner), 0, -MAX_ITEMS - 1)
+    pipe.zremrangebyrank(history_key(owner), 0, -MAX_ITEMS - 1)
+    evicted = pipe.execute()[2]
+    if evicted:
+        db.delete(*[item_key(owner, evicted_id) for evicted_id in evicted])
+
+
+# returns page of most recent runs as (items, total), items are dicts with id, date (ms) and commands
+def get_page(db, owner, page, per_page):
+    pipe = db.pipeline(transaction=False)
+    pipe.zrevrange(history_key(owner), (page - 1) * per_page, page * per_page - 1, withscores=True)
+    pipe.zcard(history_key(owner))
+    window, total = pipe.execute()
+    if not window:
+        return [], total
+    commands = db.mget([item_key(owner, job_id) for job_id, _ in window])
+    items = [
+        {'id': job_id, 'date': int(score), 'commands': json.loads(item_commands)}
+        for (job_id, score), item_commands in zip(window, commands) if item_commands
+    ]
+    return items, total
+
+
+def get_commands(db, owner, job_id):
+    commands = db.get(item_key(owner, job_id))
+    if commands is None:
+        return None
+    return json.loads(commands)
+
+
+def clear(db, owner):
+    job_ids = db.zrange(history_key(owner), 0, -1)
+    db.delete(history_key(owner), *[item_key(owner, job_id) for job_id in job_ids])
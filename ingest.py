@@ -0,0 +1,127 @@
+import array
+import resource
+import time
+from datetime import datetime
+
+import numpy as np
+import openpyxl
+import xlrd
+
+from engine import EPOCH
+
+# rows between progress reports
+PROGRESS_ROWS = 10000
+# number of invalid rows listed in the error message
+MAX_ERRORS = 10
+
+
+class IngestError(Exception):
+    pass
+
+
+# Yields rows of the first sheet as lists of python values.
+# .xlsx sheets are streamed in read-only mode, xlrd has no streaming mode, so an .xls sheet is loaded whole.
+def read_rows(path):
+    if path.lower().endswith('.xls'):
+        book = xlrd.open_workbook(path, on_demand=True)
+        try:
+            sheet = book.sheet_by_index(0)
+            for index in range(sheet.nrows):
+                row = []
+                for cell in sheet.row(index):
+                    if cell.ctype == xlrd.XL_CELL_DATE:
+                        row.append(xlrd.xldate_as_datetime(cell.value, book.datemode))
+                    elif cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK, xlrd.XL_CELL_ERROR):
+                        row.append(None)
+                    else:
+                        row.append(cell.value)
+                yield row
+        finally:
+            book.release_resources()
+    else:
+        book = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            for row in book.worksheets[0].iter_rows():
+                yield [cell.value for cell in row]
+        finally:
+            book.close()
+
+
+# current resident set size of the process in kilobytes, None where /proc is not available
+def get_rss_kb():
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize() // 1024
+
+
+def parse_date(value):
+    if isinstance(value, datetime):
+        day = value
+    elif isinstance(value, basestring):
+        day = datetime.strptime(value.strip()[:10], '%Y-%m-%d')
+    else:
+        raise ValueError('%r is not a date' % (value,))
+    return int((datetime(day.year, day.month, day.day) - EPOCH).total_seconds()) * 1000
+
+
+def parse_value(value):
+    if value is None or value == '' or value == '#N/A':
+        return np.nan
+    if isinstance(value, bool):
+        raise ValueError('%r is not a number' % (value,))
+    return float(value)
+
+
+# Reads a two column sheet (date, value) into the series store.
+# A first row that does not start with a date is treated as header,
+# empty and #N/A values become nulls, any other invalid row fails the whole file.
+# progress(rows_read) is called every PROGRESS_ROWS rows.
+def ingest_timeseries(store, path, name, progress=None):
+    started = time.time()
+    rss_before = get_rss_kb()
+    max_rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timestamps = array.array('d')
+    values = array.array('d')
+    errors = []
+    rows = 0
+    for row in read_rows(path):
+        rows += 1
+        if progress and rows % PROGRESS_ROWS == 0:
+            progress(rows)
+        if not row or all(cell is None for cell in row):
+            continue
+        try:
+            timestamp = parse_date(row[0])
+            value = parse_value(row[1] if len(row) > 1 else None)
+        except (TypeError, ValueError) as e:
+            if rows == 1:
+                continue
+            errors.append('row %s: %s' % (rows, e))
+            if len(errors) >= MAX_ERRORS:
+                break
+            continue
+        timestamps.append(timestamp)
+        values.append(value)
+
+    if errors:
+        raise IngestError('Invalid rows in %s:\n%s' % (path, '\n'.join(errors)))
+    if not timestamps:
+        raise IngestError('No data rows in %s' % path)
+
+    store.merge(name, np.frombuffer(timestamps, dtype=np.float64).astype(np.int64), np.frombuffer(values))
+    seconds = time.time() - started
+    return {
+        'series_name': name,
+        'rows': rows,
+        'points': len(timestamps),
+        'seconds': seconds,
+        'rows_per_sec': rows / seconds if seconds else None,
+        # memory of this ingestion in a long-lived worker: resident size before and after it, and how much
+        # it raised the process peak (ru_maxrss is in kilobytes on Linux), 0 when it stayed under an earlier peak
+        'rss_before_kb': rss_before,
+        'rss_after_kb': get_rss_kb(),
+        'peak_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - max_rss_before
+    }
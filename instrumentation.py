@@ -0,0 +1,211 @@
+import bisect
+import contextlib
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+from flask import g, has_request_context, request
+from jinja2 import Template
+
+# Opt-in request instrumentation, enabled by init_app and instrument_redis:
+# - per request phase timings (Redis, template rendering, JSON loading, password hashing)
+#   in the Server-Timing header and in histograms,
+# - Redis command counts and latency,
+# - cProfile dumps of a sample of slow requests,
+# - /metrics endpoint with all histograms in Prometheus text format.
+# Metrics are kept per process, every worker process exposes its own.
+
+# fraction of requests run under the profiler
+PROFILE_SAMPLE_RATE = 0.01
+# profiled requests taking longer are dumped to PROFILE_DIR as <time>-<endpoint>-<id>.prof
+PROFILE_SLOW_SECONDS = 0.5
+PROFILE_DIR = '/tmp/profiles'
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram(object):
+    def __init__(self, name, documentation, label_names, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [count per bucket (not cumulative) + one for +Inf, sum]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            values = sorted(
+                (label_values, (list(counts[0]), counts[1])) for label_values, counts in self.values.items()
+            )
+        for label_values, (counts, total) in values:
+            labels = ['%s="%s"' % (name, escape_label(value)) for name, value in zip(self.label_names, label_values)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                bucket_labels = ','.join(labels + ['le="%s"' % bound])
+                lines.append('%s_bucket{%s} %s' % (self.name, bucket_labels, cumulative))
+            lines.append('%s_sum{%s} %r' % (self.name, ','.join(labels), total))
+            lines.append('%s_count{%s} %s' % (self.name, ','.join(labels), cumulative))
+        return '\n'.join(lines)
+
+
+def escape_label(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_seconds = Histogram(
+    'http_request_duration_seconds', 'Request duration', ('endpoint', 'method', 'status'))
+phase_seconds = Histogram(
+    'request_phase_duration_seconds', 'Time spent in a phase of request handling', ('phase',))
+template_seconds = Histogram(
+    'template_render_duration_seconds', 'Jinja template rendering duration', ('template',))
+redis_seconds = Histogram(
+    'redis_command_duration_seconds', 'Redis command latency, a pipeline counts as one command', ('command',))
+redis_commands = Histogram(
+    'redis_commands_per_request', 'Redis commands sent by a request', ('endpoint',), COUNT_BUCKETS)
+METRICS = [request_seconds, phase_seconds, template_seconds, redis_seconds, redis_commands]
+
+enabled = False
+
+
+# Times a phase of the current request. Does nothing while instrumentation is disabled,
+# so it can wrap hot code unconditionally.
+@contextlib.contextmanager
+def phase(name):
+    if not enabled:
+        yield
+        return
+    started = time.time()
+    try:
+        yield
+    finally:
+        record_phase(name, time.time() - started)
+
+
+def record_phase(name, seconds):
+    phase_seconds.observe(seconds, name)
+    if has_request_context() and 'phases' in g:
+        g.phases[name] = g.phases.get(name, 0) + seconds
+
+
+# template class rendering through phase, installed by init_app
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        started = time.time()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            seconds = time.time() - started
+            template_seconds.observe(seconds, self.name)
+            record_phase('render', seconds)
+
+
+# counts and times commands of the Redis client and of pipelines created by it
+def instrument_redis(client):
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    def record(command, seconds):
+        redis_seconds.observe(seconds, command)
+        record_phase('redis', seconds)
+        if has_request_context() and 'redis_commands' in g:
+            g.redis_commands += 1
+
+    def timed_execute_command(*args, **options):
+        started = time.time()
+        try:
+            return execute_command(*args, **options)
+        finally:
+            record(str(args[0]).upper(), time.time() - started)
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def timed_execute(*execute_args, **execute_kwargs):
+            started = time.time()
+            try:
+                return execute(*execute_args, **execute_kwargs)
+            finally:
+                record('PIPELINE', time.time() - started)
+
+        pipe.execute = timed_execute
+        return pipe
+
+    client.execute_command = timed_execute_command
+    client.pipeline = timed_pipeline
+    return client
+
+
+def expose_metrics():
+    return '\n'.join(metric.expose() for metric in METRICS) + '\n'
+
+
+# enables instrumentation of app requests, the Redis client is instrumented separately by instrument_redis
+def init_app(app):
+    global enabled
+    enabled = True
+    app.jinja_env.template_class = TimedTemplate
+    sample_rate = app.config.get('PROFILE_SAMPLE_RATE', PROFILE_SAMPLE_RATE)
+    slow_seconds = app.config.get('PROFILE_SLOW_SECONDS', PROFILE_SLOW_SECONDS)
+    profile_dir = app.config.get('PROFILE_DIR', PROFILE_DIR)
+
+    @app.before_request
+    def before_request():
+        g.started = time.time()
+        g.phases = {}
+        g.redis_commands = 0
+        g.profiler = None
+        if sample_rate and random.random() < sample_rate:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def after_request(response):
+        if 'started' not in g:
+            return response
+        seconds = time.time() - g.started
+        endpoint = request.endpoint or 'unknown'
+        request_seconds.observe(seconds, endpoint, request.method, response.status_code)
+        redis_commands.observe(g.redis_commands, endpoint)
+        timings = ['%s;dur=%.3f' % (name, duration * 1000) for name, duration in sorted(g.phases.items())]
+        timings.append('total;dur=%.3f' % (seconds * 1000))
+        response.headers['Server-Timing'] = ', '.join(timings)
+        return response
+
+    # the profiler is stopped on teardown, which also runs for requests failed with an exception,
+    # otherwise it would stay enabled on the thread and profile every later request
+    @app.teardown_request
+    def teardown_request(exception):
+        profiler = g.get('profiler')
+        if not profiler:
+            return
+        profiler.disable()
+        g.profiler = None
+        seconds = time.time() - g.started
+        if seconds >= slow_seconds:
+            if not os.path.isdir(profile_dir):
+                os.makedirs(profile_dir)
+            profiler.dump_stats(os.path.join(profile_dir, '%d-%s-%s.prof' % (
+                g.started, re.sub(r'[^\w.-]', '_', request.endpoint or 'unknown'), uuid.uuid4().hex[:8])))
+
+    @app.route('/metrics')
+    def view_metrics():
+        return expose_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
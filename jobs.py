@@ -0,0 +1,358 @@
+import copy
+import itertools
+import json
+import threading
+import time
+import traceback
+import uuid
+
+import numpy as np
+
+import engine
+import ingest
+import model_compiler
+import results_summary
+import series_names
+from result_cache import ResultCache
+from series_store import values_to_list
+
+QUEUE_KEY = 'jobs:queue'
+# ids of workers that may hold jobs in their processing lists
+WORKERS_KEY = 'jobs:workers'
+# seconds a worker is considered alive since its last heartbeat, heartbeats are sent every WORKER_HEARTBEAT
+WORKER_TTL = 30
+WORKER_HEARTBEAT = 5
+REAPER_LOCK_KEY = 'jobs:reaper'
+# times a job is put back to the queue after its worker died before it is failed
+MAX_ATTEMPTS = 3
+# bytes of model outputs cached by a worker between runs
+RESULT_CACHE_SIZE = 256 * 1024 * 1024
+# seconds a finished job and its results are kept
+JOB_TTL = 24 * 60 * 60
+# variants of a batch job expanded from its grid
+BATCH_MAX_VARIANTS = 1000
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled'
+FINAL_STATUSES = (STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED)
+
+KIND_RUN = 'run'
+KIND_INGEST_TIMESERIES = 'ingest_timeseries'
+KIND_BATCH = 'batch'
+
+
+class JobCancelled(engine.RunError):
+    pass
+
+
+def job_key(job_id):
+    return 'job:%s' % job_id
+
+
+# Jobs taken by a worker are moved atomically from the queue to its processing list and removed when done,
+# so a job of a dead worker (whose alive key has expired) is still found there and requeued.
+def worker_processing_key(worker_id):
+    return 'jobs:worker:%s:processing' % worker_id
+
+
+def worker_alive_key(worker_id):
+    return 'jobs:worker:%s:alive' % worker_id
+
+
+def job_results_key(job_id):
+    return 'job:%s:results' % job_id
+
+
+# output series of a run as binary columns: names (JSON list), days (int64) and values (float64 matrix, a row per name)
+def job_arrays_key(job_id):
+    return 'job:%s:arrays' % job_id
+
+
+# list of results of batch variants in order of completion
+def job_variants_key(job_id):
+    return 'job:%s:variants' % job_id
+
+
+# Expands base commands into variants, one per combination of grid values.
+# grid is a list of axes {"command": index of base command, "field": command field, "values": [value, ...]},
+# returns list of (params, commands) where params are {"<index>.<field>": value} of the variant.
+def expand_grid(commands, grid):
+    axes = []
+    for axis in grid:
+        index, field, values = axis.get('command'), axis.get('field'), axis.get('values')
+        if not isinstance(index, int) or not 0 <= index < len(commands):
+            raise engine.RunError('Grid command should be an index of base commands')
+        if field not in commands[index] or field == 'command':
+            raise engine.RunError('Command %s has no field %s' % (commands[index]['command'], field))
+        if not isinstance(values, list) or not values:
+            raise engine.RunError('Grid values of %s.%s should be a non-empty list' % (index, field))
+        axes.append((index, field, values))
+
+    number_of_variants = 1
+    for index, field, values in axes:
+        number_of_variants *= len(values)
+    if number_of_variants > BATCH_MAX_VARIANTS:
+        raise engine.RunError('Grid has %s variants, at most %s are allowed' % (number_of_variants, BATCH_MAX_VARIANTS))
+
+    variants = []
+    for combination in itertools.product(*[values for index, field, values in axes]):
+        variant = copy.deepcopy(commands)
+        params = {}
+        for (index, field, values), value in zip(axes, combination):
+            variant[index][field] = value
+            params['%s.%s' % (index, field)] = value
+        variants.append((params, variant))
+    return variants
+
+
+# runs modeling with commands and stores produced series, on_run_done(days, {result name: values}) gets the arrays,
+# returns {'days': [timestamp, ...], 'series': {result name: [value, ...]}}
+def run_modeling(catalog, store, commands, progress=None, cache=None, on_run_done=None):
+    plan = engine.RunPlan(catalog, commands)
+    model_compiler.register_evaluators(catalog, plan.models)
+
+    run_results = engine.run(plan, store.values_at, progress=progress, cache=cache)
+    for name, values in run_results.iteritems():
+        store.merge(name, plan.days, values)
+    if on_run_done:
+        on_run_done(plan.days, run_results)
+    return {
+        'days': plan.days.tolist(),
+        'series': dict((name, values_to_list(values)) for name, values in run_results.iteritems())
+    }
+
+
+# Runs all variants of a batch in one pool, model runs shared by variants are computed once.
+# Results of variants are not stored as series, on_variant_done(variant results) is called
+# as soon as a variant completes with {'index', 'params', 'days', 'series'}.
+def run_batch(catalog, store, commands, grid, on_variant_done, progress=None, cache=None):
+    variants = expand_grid(commands, grid)
+    plans = [engine.RunPlan(catalog, variant) for params, variant in variants]
+    model_compiler.register_evaluators(catalog, set(name for plan in plans for name in plan.models))
+
+    def plan_done(index, run_results):
+        on_variant_done({
+            'index': index,
+            'params': variants[index][0],
+            'days': plans[index].days.tolist(),
+            'series': dict((name, values_to_list(values)) for name, values in run_results.iteritems())
+        })
+
+    engine.run_plans(plans, store.values_at, progress=progress, cache=cache, on_plan_done=plan_done)
+    return {'variants': len(variants)}
+
+
+def enqueue_job(db, kind, **fields):
+    job_id = str(uuid.uuid4())
+    fields.update({
+        'job_id': job_id,
+        'kind': kind,
+        'status': STATUS_QUEUED,
+        'progress': 0,
+        'created': time.time()
+    })
+    pipe = db.pipeline()
+    pipe.hmset(job_key(job_id), fields)
+    pipe.lpush(QUEUE_KEY, job_id)
+    pipe.execute()
+    return job_id
+
+
+def enqueue(db, commands):
+    return enqueue_job(db, KIND_RUN, commands=json.dumps(commands))
+
+
+def enqueue_batch(db, commands, grid):
+    return enqueue_job(db, KIND_BATCH, commands=json.dumps(commands), grid=json.dumps(grid))
+
+
+# file at path should already be on disk, it is parsed into series_name by a worker
+def enqueue_ingestion(db, path, ts_name, ts_author):
+    return enqueue_job(db, KIND_INGEST_TIMESERIES, path=path, ts_name=ts_name, ts_author=ts_author,
+                       series_name=series_names.timeseries_name(ts_name, ts_author))
+
+
+def get_job(db, job_id):
+    job = db.hgetall(job_key(job_id))
+    if not job:
+        return None
+    if 'commands' in job:
+        job['commands'] = json.loads(job['commands'])
+    if 'grid' in job:
+        job['grid'] = json.loads(job['grid'])
+    job['progress'] = float(job['progress'])
+    return job
+
+
+def get_job_results(db, job_id):
+    results = db.get(job_results_key(job_id))
+    if results is None:
+        return None
+    return json.loads(results)
+
+
+# keeps output series of a finished run for comparison, intermediate inputs are left out
+def put_job_arrays(db, job_id, days, run_results):
+    names = sorted(name for name in run_results if series_names.parse(name)['result_type'] == series_names.OUTPUT)
+    values = np.empty((len(names), len(days)), dtype='<f8')
+    for row, name in enumerate(names):
+        values[row] = run_results[name]
+    pipe = db.pipeline()
+    pipe.hmset(job_arrays_key(job_id), {
+        'names': json.dumps(names),
+        'days': np.ascontiguousarray(days, dtype='<i8').tostring(),
+        'values': values.tostring()
+    })
+    pipe.expire(job_arrays_key(job_id), JOB_TTL)
+    pipe.execute()
+
+
+# returns (days, names, values matrix with a row per name) of a finished run or None
+def get_job_arrays(db, job_id):
+    arrays = db.hgetall(job_arrays_key(job_id))
+    if not arrays:
+        return None
+    names = json.loads(arrays['names'])
+    days = np.frombuffer(arrays['days'], dtype='<i8')
+    values = np.frombuffer(arrays['values'], dtype='<f8').reshape(len(names), len(days))
+    return days, names, values
+
+
+# returns results of batch variants completed so far starting from given position, as JSON strings
+def get_job_variants(db, job_id, start=0):
+    return db.lrange(job_variants_key(job_id), start, -1)
+
+
+# marks job to be cancelled, a queued job is skipped, a running one stops at the next progress report
+def cancel(db, job_id):
+    key = job_key(job_id)
+    if db.hget(key, 'status') in FINAL_STATUSES:
+        return False
+    db.hset(key, 'cancel', 1)
+    return True
+
+
+def finish(db, job_id, status, **fields):
+    pipe = db.pipeline()
+    fields.update({'status': status, 'finished': time.time()})
+    pipe.hmset(job_key(job_id), fields)
+    pipe.expire(job_key(job_id), JOB_TTL)
+    pipe.execute()
+
+
+def process(db, catalog, store, job_id, cache=None):
+    job = get_job(db, job_id)
+    if not job or job['status'] in FINAL_STATUSES:
+        return
+    if job.get('cancel'):
+        finish(db, job_id, STATUS_CANCELLED)
+        return
+    db.hmset(job_key(job_id), {'status': STATUS_RUNNING, 'started': time.time()})
+
+    def check_cancelled():
+        if db.hget(job_key(job_id), 'cancel'):
+            raise JobCancelled('Job %s is cancelled' % job_id)
+
+    def progress(models_done, models_total):
+        check_cancelled()
+        db.hset(job_key(job_id), 'progress', float(models_done) / models_total)
+
+    def ingest_progress(rows):
+        check_cancelled()
+        db.hset(job_key(job_id), 'rows', rows)
+
+    def variant_done(variant):
+        pipe = db.pipeline()
+        pipe.rpush(job_variants_key(job_id), json.dumps(variant))
+        pipe.expire(job_variants_key(job_id), JOB_TTL)
+        pipe.execute()
+
+    def run_done(days, run_results):
+        put_job_arrays(db, job_id, days, run_results)
+
+    try:
+        if job['kind'] == KIND_INGEST_TIMESERIES:
+            results = ingest.ingest_timeseries(store, job['path'], job['series_name'], ingest_progress)
+            results_summary.update(db, store, [job['series_name']])
+            # the ingested timeseries can be wired to model inputs by its series_name_system
+            timeseries = catalog.add_timeseries(job['ts_name'], job['ts_author'])
+            results['series_name_system'] = timeseries['series_name_system']
+        elif job['kind'] == KIND_BATCH:
+            results = run_batch(catalog, store, job['commands'], job['grid'], variant_done, progress, cache)
+        else:
+            results = run_modeling(catalog, store, job['commands'], progress, cache, run_done)
+            results_summary.update(db, store, results['series'].keys())
+    except JobCancelled:
+        finish(db, job_id, STATUS_CANCELLED)
+    except (engine.RunError, ingest.IngestError) as e:
+        finish(db, job_id, STATUS_FAILED, error=str(e))
+    except Exception:
+        finish(db, job_id, STATUS_FAILED, error=traceback.format_exc())
+    else:
+        db.setex(job_results_key(job_id), json.dumps(results), JOB_TTL)
+        finish(db, job_id, STATUS_DONE, progress=1)
+
+
+# Puts jobs of dead workers back to the queue, a job is failed once it was taken MAX_ATTEMPTS times.
+# One worker reaps at a time. Returns ids of requeued jobs.
+def requeue_stale(db):
+    if not db.set(REAPER_LOCK_KEY, 1, nx=True, ex=WORKER_TTL):
+        return []
+    requeued = []
+    try:
+        for worker_id in db.smembers(WORKERS_KEY):
+            if db.exists(worker_alive_key(worker_id)):
+                continue
+            processing_key = worker_processing_key(worker_id)
+            while True:
+                job_id = db.lindex(processing_key, -1)
+                if job_id is None:
+                    break
+                job = get_job(db, job_id)
+                if job and job['status'] not in FINAL_STATUSES and int(job.get('attempts', 0)) < MAX_ATTEMPTS:
+                    db.hset(job_key(job_id), 'status', STATUS_QUEUED)
+                    db.rpoplpush(processing_key, QUEUE_KEY)
+                    requeued.append(job_id)
+                    continue
+                if job and job['status'] not in FINAL_STATUSES:
+                    finish(db, job_id, STATUS_FAILED,
+                           error='Worker died while processing the job %s times' % MAX_ATTEMPTS)
+                db.rpop(processing_key)
+            db.srem(WORKERS_KEY, worker_id)
+    finally:
+        db.delete(REAPER_LOCK_KEY)
+    return requeued
+
+
+# Consumes jobs queue forever, one job at a time.
+# A heartbeat thread keeps the worker alive key while the process lives, jobs of dead workers are
+# requeued by the other workers.
+def work(db, catalog, store):
+    cache = ResultCache(RESULT_CACHE_SIZE)
+    worker_id = str(uuid.uuid4())
+    stopped = threading.Event()
+
+    def heartbeat():
+        while not stopped.is_set():
+            db.setex(worker_alive_key(worker_id), 1, WORKER_TTL)
+            stopped.wait(WORKER_HEARTBEAT)
+
+    db.setex(worker_alive_key(worker_id), 1, WORKER_TTL)
+    db.sadd(WORKERS_KEY, worker_id)
+    thread = threading.Thread(target=heartbeat)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            requeue_stale(db)
+            job_id = db.brpoplpush(QUEUE_KEY, worker_processing_key(worker_id), timeout=WORKER_HEARTBEAT)
+            if job_id:
+                db.hincrby(job_key(job_id), 'attempts', 1)
+                process(db, catalog, store, job_id, cache)
+                db.lrem(worker_processing_key(worker_id), job_id)
+    finally:
+        stopped.set()
+        db.delete(worker_alive_key(worker_id))
@@ -0,0 +1,462 @@
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+import openpyxl
+from openpyxl.formula import Tokenizer
+from openpyxl.formula.tokenizer import Token, TokenizerError
+from openpyxl.utils.cell import range_boundaries, get_column_letter
+
+import engine
+
+# Compiles .xlsx model workbooks into evaluators running all days of a model in one array pass.
+#
+# A workbook describes one day of the model. Inputs and outputs are single cells named either by
+# workbook defined names or by a text label in column A next to the cell in column B of any sheet.
+# Named cells with formulas are outputs, other named cells are inputs, their values are defaults
+# for inputs the model does not provide. Names match input and output keys of the model in models.json.
+# A workbook added on the models page becomes a model of models.json with these inputs and outputs.
+#
+# Formulas are parsed once, cells the outputs depend on are ordered by their dependency graph and
+# emitted as Python source where every input cell is an array of all days, so each formula is
+# evaluated once per run as a NumPy expression. The source is cached on disk by the workbook hash.
+
+# bump to invalidate compiled artifacts when generated code changes
+COMPILER_VERSION = 2
+# folder of compiled artifacts next to models.json
+CACHE_FOLDER = 'compiled'
+
+# operator -> (precedence, python expression of operands)
+INFIX_OPERATORS = {
+    '=': (1, '(%s == %s)'),
+    '<>': (1, '(%s != %s)'),
+    '<': (1, '(%s < %s)'),
+    '>': (1, '(%s > %s)'),
+    '<=': (1, '(%s <= %s)'),
+    '>=': (1, '(%s >= %s)'),
+    '+': (3, '(%s + %s)'),
+    '-': (3, '(%s - %s)'),
+    '*': (4, '(%s * %s)'),
+    '/': (4, 'xl_div(%s, %s)'),
+    '^': (5, 'np.power(%s, %s)')
+}
+
+FUNCTIONS = {
+    'SUM': 'xl_sum',
+    'AVERAGE': 'xl_average',
+    'MIN': 'xl_min',
+    'MAX': 'xl_max',
+    'IF': 'xl_if',
+    'AND': 'xl_and',
+    'OR': 'xl_or',
+    'NOT': 'np.logical_not',
+    'ABS': 'np.abs',
+    'ROUND': 'xl_round',
+    'EXP': 'np.exp',
+    'LN': 'np.log',
+    'LOG10': 'np.log10',
+    'SQRT': 'np.sqrt',
+    'POWER': 'np.power',
+    'MOD': 'np.mod'
+}
+
+
+class CompileError(engine.RunError):
+    pass
+
+
+def xl_values(args):
+    values = []
+    for arg in args:
+        if isinstance(arg, list):
+            values.extend(arg)
+        else:
+            values.append(arg)
+    return values
+
+
+def xl_sum(*args):
+    total = 0.0
+    for value in xl_values(args):
+        total = total + value
+    return total
+
+
+def xl_average(*args):
+    values = xl_values(args)
+    return xl_sum(*values) / float(len(values))
+
+
+def xl_min(*args):
+    return reduce(np.minimum, xl_values(args))
+
+
+def xl_max(*args):
+    return reduce(np.maximum, xl_values(args))
+
+
+def xl_if(condition, value_if_true=True, value_if_false=False):
+    return np.where(condition, value_if_true, value_if_false)
+
+
+def xl_and(*args):
+    return reduce(np.logical_and, xl_values(args))
+
+
+def xl_or(*args):
+    return reduce(np.logical_or, xl_values(args))
+
+
+# rounds half away from zero like Excel does
+def xl_round(value, digits=0):
+    scale = 10.0 ** digits
+    return np.sign(value) * np.floor(np.abs(value) * scale + 0.5) / scale
+
+
+# division by zero gives null instead of #DIV/0!
+def xl_div(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(np.asarray(b) == 0, np.nan, np.true_divide(a, b))
+
+
+def xl_input(inputs, name, default):
+    if name in inputs:
+        return np.asarray(inputs[name], dtype=np.float64)
+    return default
+
+
+def xl_result(value, number_of_days):
+    return np.broadcast_to(np.asarray(value, dtype=np.float64), (number_of_days,)).copy()
+
+
+RUNTIME = dict((name, value) for name, value in globals().items() if name.startswith('xl_'))
+RUNTIME['np'] = np
+
+
+def get_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# splits reference like 'Sheet 1'!$A$1:$B$2 into sheet title (or None) and cell range
+def split_reference(reference):
+    if '!' in reference:
+        sheet, cells = reference.rsplit('!', 1)
+        sheet = sheet.strip("'").replace("''", "'")
+    else:
+        sheet, cells = None, reference
+    return sheet, cells.replace('$', '')
+
+
+def get_cells(cells):
+    min_col, min_row, max_col, max_row = range_boundaries(cells)
+    return [
+        '%s%s' % (get_column_letter(column), row)
+        for row in range(min_row, max_row + 1) for column in range(min_col, max_col + 1)
+    ]
+
+
+def is_formula(value):
+    return isinstance(value, basestring) and value.startswith('=')
+
+
+# Parses formula tokens into a Python expression, resolve(sheet, cells) returns expression of referenced cells.
+# Returns (expression, is_range), ranges are only accepted as function arguments.
+class FormulaParser(object):
+    def __init__(self, formula, resolve):
+        self.formula = formula
+        self.resolve = resolve
+        tokenizer = Tokenizer(formula)
+        self.tokens = [token for token in tokenizer.items if token.type != Token.WSPACE]
+        self.position = 0
+
+    def error(self, message):
+        return CompileError('%s in formula %s' % (message, self.formula))
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise self.error('Unexpected end')
+        self.position += 1
+        return token
+
+    def parse(self):
+        expression = self.parse_value()
+        if self.peek() is not None:
+            raise self.error('Unexpected %s' % self.peek().value)
+        return expression
+
+    def parse_value(self):
+        expression, is_range = self.parse_infix(1)
+        if is_range:
+            raise self.error('Range outside of a function')
+        return expression
+
+    def parse_infix(self, min_precedence):
+        left = self.parse_prefix()
+        while True:
+            token = self.peek()
+            if token is None or token.type != Token.OP_IN:
+                return left
+            if token.value not in INFIX_OPERATORS:
+                raise self.error('Unsupported operator %s' % token.value)
+            precedence, operator = INFIX_OPERATORS[token.value]
+            if precedence < min_precedence:
+                return left
+            self.next()
+            right = self.parse_infix(precedence + 1)
+            if left[1] or right[1]:
+                raise self.error('Range outside of a function')
+            left = (operator % (left[0], right[0]), False)
+
+    def parse_prefix(self):
+        token = self.peek()
+        if token is not None and token.type == Token.OP_PRE:
+            self.next()
+            operand, is_range = self.parse_prefix()
+            if is_range:
+                raise self.error('Range outside of a function')
+            return ('(%s%s)' % (token.value, operand), False)
+        return self.parse_postfix()
+
+    def parse_postfix(self):
+        expression = self.parse_primary()
+        while self.peek() is not None and self.peek().type == Token.OP_POST:
+            self.next()
+            expression = ('(%s / 100.0)' % expression[0], False)
+        return expression
+
+    def parse_primary(self):
+        token = self.next()
+        if token.type == Token.OPERAND:
+            if token.subtype == Token.NUMBER:
+                return repr(float(token.value)), False
+            if token.subtype == Token.LOGICAL:
+                return repr(token.value.upper() == 'TRUE'), False
+            if token.subtype == Token.TEXT:
+                return repr(token.value[1:-1].replace('""', '"')), False
+            if token.subtype == Token.RANGE:
+                return self.resolve(*split_reference(token.value))
+            raise self.error('Unsupported value %s' % token.value)
+        if token.type == Token.FUNC and token.subtype == Token.OPEN:
+            name = token.value[:-1].upper()
+            if name not in FUNCTIONS:
+                raise self.error('Unsupported function %s' % name)
+            args = []
+            if self.peek() is not None and self.peek().type == Token.FUNC and self.peek().subtype == Token.CLOSE:
+                self.next()
+                return '%s()' % FUNCTIONS[name], False
+            while True:
+                args.append(self.parse_infix(1)[0])
+                token = self.next()
+                if token.type == Token.FUNC and token.subtype == Token.CLOSE:
+                    return '%s(%s)' % (FUNCTIONS[name], ', '.join(args)), False
+                if token.type != Token.SEP or token.subtype != Token.ARG:
+                    raise self.error('Unexpected %s' % token.value)
+        if token.type == Token.PAREN and token.subtype == Token.OPEN:
+            expression = self.parse_value()
+            token = self.next()
+            if token.type != Token.PAREN or token.subtype != Token.CLOSE:
+                raise self.error('Unexpected %s' % token.value)
+            return '(%s)' % expression, False
+        raise self.error('Unexpected %s' % token.value)
+
+
+# returns {name: (sheet title, cell)} of named single cells, defined names take precedence over labels
+def get_named_cells(workbook):
+    names = {}
+    for sheet in workbook.worksheets:
+        for label, cell in sheet.iter_rows(min_col=1, max_col=2):
+            if isinstance(label.value, basestring) and label.value.strip() and not is_formula(label.value):
+                names[label.value.strip()] = (sheet.title, cell.coordinate)
+    for defined_name in workbook.defined_names.definedName:
+        try:
+            destinations = list(defined_name.destinations)
+        except Exception:
+            continue
+        if len(destinations) == 1 and ':' not in destinations[0][1]:
+            names[defined_name.name] = (destinations[0][0], destinations[0][1].replace('$', '').upper())
+    return names
+
+
+# Parses the workbook and returns compiled artifact: inputs and outputs as {name: 'Sheet!A1'}
+# and source of evaluate(inputs, number_of_days) function.
+def compile_workbook(path):
+    filename = os.path.basename(path)
+    try:
+        workbook = openpyxl.load_workbook(path)
+    except Exception as e:
+        raise CompileError('Cannot read workbook %s: %s' % (filename, e))
+    # malformed formulas and coordinates surface as errors of openpyxl, too deep formula chains as RuntimeError
+    try:
+        return compile_cells(workbook, filename)
+    except CompileError:
+        raise
+    except (TokenizerError, ValueError, KeyError, IndexError, RuntimeError) as e:
+        raise CompileError('Cannot compile workbook %s: %s' % (filename, e))
+
+
+def compile_cells(workbook, filename):
+    sheets = dict((sheet.title, sheet) for sheet in workbook.worksheets)
+    named_cells = get_named_cells(workbook)
+    # names are case insensitive in formulas
+    names = dict((name.lower(), cell) for name, cell in named_cells.items())
+
+    def get_value(cell):
+        sheet, coordinate = cell
+        if sheet not in sheets:
+            raise CompileError('Unknown sheet %s' % sheet)
+        if not re.match(r'^[A-Z]{1,3}[0-9]+$', coordinate):
+            raise CompileError('Invalid cell %s!%s' % cell)
+        return sheets[sheet][coordinate].value
+
+    inputs = {}
+    outputs = {}
+    for name, cell in named_cells.items():
+        if is_formula(get_value(cell)):
+            outputs[name] = cell
+        else:
+            inputs[name] = cell
+    if not outputs:
+        raise CompileError('Workbook %s has no named formula cells to use as outputs' % filename)
+    input_names = dict((cell, name) for name, cell in inputs.items())
+
+    variables = {}
+    visiting = set()
+    lines = []
+
+    def literal(value):
+        if value is None:
+            return '0.0'
+        if isinstance(value, bool):
+            return repr(value)
+        if isinstance(value, (int, long, float)):
+            return repr(float(value))
+        if isinstance(value, basestring):
+            return repr(value)
+        raise CompileError('Unsupported value %r' % (value,))
+
+    def visit(cell):
+        if cell in variables:
+            return variables[cell]
+        if cell in visiting:
+            raise CompileError('Circular reference at %s!%s' % cell)
+        visiting.add(cell)
+        sheet, coordinate = cell
+        value = get_value(cell)
+        if cell in input_names:
+            expression = 'xl_input(inputs, %r, %s)' % (input_names[cell], literal(value))
+        elif is_formula(value):
+            def resolve(reference_sheet, cells):
+                if reference_sheet is None and cells.lower() in names:
+                    return visit(names[cells.lower()]), False
+                cells = cells.upper()
+                if not re.match(r'^[A-Z]+[0-9]+(:[A-Z]+[0-9]+)?$', cells):
+                    raise CompileError('Unknown name %s in %s!%s' % (cells, sheet, coordinate))
+                referenced = [visit((reference_sheet or sheet, item)) for item in get_cells(cells)]
+                if ':' in cells:
+                    return '[%s]' % ', '.join(referenced), True
+                return referenced[0], False
+
+            expression = FormulaParser(value, resolve).parse()
+        else:
+            expression = literal(value)
+        variable = 'c%s' % len(variables)
+        lines.append('    %s = %s  # %r' % (variable, expression, '%s!%s' % cell))
+        variables[cell] = variable
+        visiting.remove(cell)
+        return variable
+
+    results = []
+    for name, cell in sorted(outputs.items()):
+        results.append('%r: xl_result(%s, number_of_days)' % (name, visit(cell)))
+    source = 'def evaluate(inputs, number_of_days):\n%s\n    return {%s}\n' % ('\n'.join(lines), ', '.join(results))
+    return {
+        'compiler_version': COMPILER_VERSION,
+        'inputs': dict((name, '%s!%s' % cell) for name, cell in inputs.items()),
+        'outputs': dict((name, '%s!%s' % cell) for name, cell in outputs.items()),
+        'source': source
+    }
+
+
+# Evaluator of a compiled workbook, versioned by the workbook hash so cached model results
+# are invalidated when the workbook changes
+class CompiledModel(object):
+    def __init__(self, digest, artifact):
+        self.digest = digest
+        self.version = '%s-%s' % (COMPILER_VERSION, digest)
+        self.inputs = artifact['inputs']
+        self.outputs = artifact['outputs']
+        self.source = artifact['source']
+        namespace = dict(RUNTIME)
+        exec(compile(self.source, '<workbook %s>' % digest, 'exec'), namespace)
+        self.evaluate = namespace['evaluate']
+
+    def __call__(self, inputs, number_of_days):
+        return self.evaluate(inputs, number_of_days)
+
+
+# returns CompiledModel of the workbook, compiled artifacts are kept in cache_folder as <sha1 of file>.json
+def load(path, cache_folder):
+    digest = get_digest(path)
+    artifact_path = os.path.join(cache_folder, '%s.json' % digest)
+    if os.path.exists(artifact_path):
+        with open(artifact_path) as f:
+            artifact = json.load(f)
+        if artifact.get('compiler_version') == COMPILER_VERSION:
+            return CompiledModel(digest, artifact)
+
+    artifact = compile_workbook(path)
+    if not os.path.isdir(cache_folder):
+        os.makedirs(cache_folder)
+    tmp_path = '%s.%s.tmp' % (artifact_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(artifact, f)
+    os.rename(tmp_path, artifact_path)
+    return CompiledModel(digest, artifact)
+
+
+# inputs and outputs of the model should be named cells of its workbook,
+# unknown names would silently run on defaults and produce nulls
+def check_names(model, evaluator):
+    for kind, names, cells in (('input', model['inputs'], evaluator.inputs),
+                               ('output', model['outputs'], evaluator.outputs)):
+        unknown = sorted(set(names) - set(cells))
+        if unknown:
+            raise CompileError('Workbook of model %s has no %s cells named %s' % (
+                model['model_system_name'], kind, ', '.join(unknown)))
+
+
+# model name -> (workbook path, mtime, CompiledModel) of registered evaluators
+registered = {}
+
+
+# Registers evaluators of given catalog models having a "workbook" path relative to models.json,
+# so a broken workbook only fails runs of its own model. Workbooks are only rehashed when their mtime changes.
+def register_evaluators(catalog, names):
+    folder = os.path.dirname(os.path.abspath(catalog.path))
+    cache_folder = os.path.join(folder, CACHE_FOLDER)
+    for name in sorted(names):
+        model = catalog.get_model(name)
+        if not model.get('workbook'):
+            continue
+        path = os.path.join(folder, model['workbook'])
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            raise CompileError('Workbook %s of model %s not found' % (model['workbook'], name))
+        current = registered.get(name)
+        if current and current[:2] == (path, mtime):
+            continue
+        evaluator = load(path, cache_folder)
+        check_names(model, evaluator)
+        registered[name] = (path, mtime, evaluator)
+        engine.register_evaluator(name, evaluator)
@@ -0,0 +1,32 @@
+import os
+
+import redis
+from werkzeug.local import LocalProxy
+
+REDIS_URL = 'redis://localhost:6379/0'
+REDIS_MAX_CONNECTIONS = 50
+
+
+# Redis client backed by an explicit connection pool, configured by REDIS_URL and REDIS_MAX_CONNECTIONS
+# (given or taken from the environment). Connections are opened lazily and reused across requests.
+def create_client(url=None, max_connections=None):
+    url = url or os.environ.get('REDIS_URL', REDIS_URL)
+    max_connections = max_connections or int(os.environ.get('REDIS_MAX_CONNECTIONS', REDIS_MAX_CONNECTIONS))
+    pool = redis.ConnectionPool.from_url(url, max_connections=max_connections)
+    return redis.Redis(connection_pool=pool)
+
+
+# Proxy creating the client on first use, so importing a module holding it does no Redis work.
+# on_create(client) is called once with the created client.
+def create_lazy_client(url=None, max_connections=None, on_create=None):
+    clients = []
+
+    def get_client():
+        if not clients:
+            client = create_client(url, max_connections)
+            if on_create:
+                on_create(client)
+            clients.append(client)
+        return clients[0]
+
+    return LocalProxy(get_client)
@@ -0,0 +1,67 @@
+import numpy as np
+
+from engine import DAY_MS
+
+# Rollups of daily series into calendar buckets, every bucket is keyed by its first day (UTC).
+# Nulls (NaN) are skipped by all aggregations, a bucket of nulls only aggregates to null:
+# sum and mean of non-null values, last non-null value, min and max.
+FREQUENCIES = ('week', 'month', 'quarter')
+AGGREGATIONS = ('sum', 'mean', 'last', 'min', 'max')
+# average bucket length in days
+FREQUENCY_DAYS = {'week': 7, 'month': 30.44, 'quarter': 91.31}
+
+
+# returns millisecond timestamps of bucket starts, weeks start on Monday
+def bucket_starts(timestamps, frequency):
+    days = np.asarray(timestamps, dtype=np.int64) // DAY_MS
+    if frequency == 'week':
+        # 1970-01-01 is Thursday
+        days = days - (days + 3) % 7
+    elif frequency in ('month', 'quarter'):
+        months = days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+        if frequency == 'quarter':
+            months -= months % 3
+        days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+    else:
+        raise ValueError('Unknown frequency %s' % frequency)
+    return days * DAY_MS
+
+
+# Aggregates sorted series into buckets of frequency in one pass per aggregation,
+# returns (bucket timestamps, {aggregation: values})
+def rollup(timestamps, values, frequency):
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values):
+        return np.empty(0, dtype=np.int64), dict((name, np.empty(0)) for name in AGGREGATIONS)
+
+    starts = bucket_starts(timestamps, frequency)
+    index = np.concatenate([[0], np.flatnonzero(np.diff(starts)) + 1])
+    finite = ~np.isnan(values)
+    counts = np.add.reduceat(finite.astype(np.int64), index)
+    sums = np.add.reduceat(np.where(finite, values, 0.0), index)
+    empty = counts == 0
+    # position of the last non-null value of every bucket, -1 for buckets of nulls
+    last = np.maximum.reduceat(np.where(finite, np.arange(len(values)), -1), index)
+    return starts[index], {
+        'sum': np.where(empty, np.nan, sums),
+        'mean': np.where(empty, np.nan, sums / np.maximum(counts, 1)),
+        'last': np.where(last >= 0, values[last], np.nan),
+        'min': np.fmin.reduceat(values, index),
+        'max': np.fmax.reduceat(values, index)
+    }
+
+
+def resample(timestamps, values, frequency, aggregation='mean'):
+    buckets, aggregates = rollup(timestamps, values, frequency)
+    return buckets, aggregates[aggregation]
+
+
+# returns the finest frequency rolling number_of_days up to at most points buckets,
+# None when daily points fit or no frequency is coarse enough
+def choose_frequency(number_of_days, points):
+    if number_of_days <= points:
+        return None
+    for frequency in FREQUENCIES:
+        if number_of_days / FREQUENCY_DAYS[frequency] <= points:
+            return frequency
+    return None
@@ -0,0 +1,39 @@
+from collections import OrderedDict
+
+
+# In-process LRU cache of model outputs, bounded by the total size of cached values in bytes
+class ResultCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        item = self.items.pop(key, None)
+        if item is None:
+            self.misses += 1
+            return None
+        self.items[key] = item
+        self.hits += 1
+        return item[0]
+
+    def put(self, key, value, size):
+        if size > self.max_size:
+            return
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self.items[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, old_size) = self.items.popitem(last=False)
+            self.size -= old_size
+
+    def clear(self):
+        self.items.clear()
+        self.size = 0
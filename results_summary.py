@@ -0,0 +1,95 @@
+import json
+import threading
+import uuid
+from datetime import datetime
+
+import numpy as np
+
+import series_names
+
+SUMMARY_KEY = 'results:summary'
+VERSION_KEY = 'results:summary:version'
+
+# last read summary of this process, reused until the version changes
+cache = {'version': None, 'items': [], 'by_name': {}}
+cache_lock = threading.Lock()
+
+
+def timestamp_to_str(timestamp):
+    return datetime.utcfromtimestamp(timestamp / 1000).strftime('%Y-%m-%d')
+
+
+def get_stats(series):
+    values = series.values
+    finite = values[~np.isnan(values)]
+    stats = {
+        'count': len(values),
+        'nulls': len(values) - len(finite),
+        'min': None,
+        'max': None,
+        'last': None,
+        'start_day': timestamp_to_str(int(series.timestamps[0])) if len(series) else None,
+        'end_day': timestamp_to_str(int(series.timestamps[-1])) if len(series) else None
+    }
+    if len(finite):
+        stats.update({'min': float(finite.min()), 'max': float(finite.max()), 'last': float(finite[-1])})
+    return stats
+
+
+# name metadata and value stats of a stored series
+def get_meta(name, series):
+    meta = {'id': name}
+    meta.update(series_names.parse(name))
+    meta.update(get_stats(series))
+    return meta
+
+
+# Summary of stored series is a hash of series name -> JSON metadata, refreshed for given names
+# whenever they are written, so reading it never touches the series themselves.
+def update(db, store, names):
+    pipe = db.pipeline()
+    for name in names:
+        if name in store:
+            pipe.hset(SUMMARY_KEY, name, json.dumps(get_meta(name, store.get(name))))
+        else:
+            pipe.hdel(SUMMARY_KEY, name)
+    pipe.incr(VERSION_KEY)
+    pipe.execute()
+
+
+# Recomputes summary of all stored series into a temporary key renamed over the summary,
+# so readers see the old summary until the new one is complete.
+def rebuild(db, store):
+    building_key = '%s:building:%s' % (SUMMARY_KEY, uuid.uuid4())
+    pipe = db.pipeline()
+    for name in store.names():
+        pipe.hset(building_key, name, json.dumps(get_meta(name, store.get(name))))
+    pipe.execute()
+    pipe = db.pipeline()
+    if db.exists(building_key):
+        pipe.rename(building_key, SUMMARY_KEY)
+    else:
+        pipe.delete(SUMMARY_KEY)
+    pipe.incr(VERSION_KEY)
+    pipe.execute()
+
+
+def refresh(db):
+    version = db.get(VERSION_KEY)
+    if version is None or version != cache['version']:
+        with cache_lock:
+            if version is None or version != cache['version']:
+                items = [json.loads(value) for value in db.hgetall(SUMMARY_KEY).values()]
+                items.sort(key=lambda ts: (ts['result_type'], ts['id']))
+                cache.update({'version': version, 'items': items, 'by_name': dict((ts['id'], ts) for ts in items)})
+    return cache
+
+
+# returns metadata of all series sorted for grouping by result type, callers must not modify it
+def get(db):
+    return refresh(db)['items']
+
+
+# returns {series name: metadata}, callers must not modify it
+def get_by_name(db):
+    return refresh(db)['by_name']
@@ -0,0 +1,92 @@
+# Naming conventions of stored time series.
+#
+# Input time series. Examples:
+# G & A_Exxon_sovcombank: macbook:timeseries
+# oil_Brent: macbook:timeseries
+# Income_tax_rate: macbook:timeseries
+#
+# Output time series. Examples:
+# incomePerDay_exxon, macbook, (output, Exxon_4)
+# incomePerDay_goodyear, macbook, (output, Goodyear)
+# gasoline_exxon, macbook, (output, Exxon_4)
+#
+# Intermediate input time series. Examples:
+# gasoline_exxon, Goodyear, macbook, input, source_type: output, Exxon_4, gasoline_exxon, macbook
+# Income_tax_rate, Exxon_4, macbook, input, source_type: timeseries, Income_tax_rate, macbook
+# G & A_Exxon, Exxon_4, macbook, input, source_type: timeseries, G & A_Exxon, macbook
+# oil, Goodyear, macbook, input, source_type: timeseries, oil, macbook
+# oil, Exxon_4, macbook, input, source_type: timeseries, oil, macbook
+
+INPUT = 'Input time series'
+OUTPUT = 'Output time series'
+INTERMEDIATE_INPUT = 'Intermediate input time series'
+OTHER = 'Other time series'
+
+# parsed names are memoized, the cache is dropped as a whole once it grows over the limit
+CACHE_SIZE = 100000
+cache = {}
+
+
+def timeseries_name(ts_name, ts_author):
+    return '%s:%s:timeseries' % (ts_name, ts_author)
+
+
+def output_name(ts_name, ts_author, model_name):
+    return '%s,%s,(output,%s)' % (ts_name, ts_author, model_name)
+
+
+# source_model_name is given for inputs taking output of another model
+def intermediate_input_name(ts_name, model_name, ts_author, source_name, source_author, source_model_name=None):
+    if source_model_name:
+        attrs = [ts_name, model_name, ts_author, 'input', 'source_type:output', source_model_name]
+    else:
+        attrs = [ts_name, model_name, ts_author, 'input', 'source_type:timeseries']
+    return ','.join(attrs + [source_name, source_author])
+
+
+def parse_name(name):
+    attrs = name.split(',')
+
+    if len(attrs) > 4 and attrs[3] == 'input' and attrs[4].startswith('source_type:'):
+        meta = {
+            'result_type': INTERMEDIATE_INPUT,
+            'ts_name': attrs[0],
+            'model_name': attrs[1],
+            'ts_author': attrs[2]
+        }
+        if attrs[4] == 'source_type:output' and len(attrs) > 5:
+            meta['source_model_name'] = attrs[5]
+            meta['source_type'] = 'model'
+        else:
+            meta['source_type'] = 'timeseries'
+        return meta
+
+    if len(attrs) > 3 and attrs[2].startswith('(output') and name.endswith(')'):
+        attrs = [attr.replace('(', '').replace(')', '') for attr in attrs]
+        return {
+            'result_type': OUTPUT,
+            'ts_name': attrs[0],
+            'ts_author': attrs[1],
+            'model_name': attrs[3]
+        }
+
+    if name.endswith(':timeseries'):
+        attrs = name.split(':')
+        if len(attrs) > 2:
+            return {
+                'result_type': INPUT,
+                'ts_name': attrs[0],
+                'ts_author': attrs[1]
+            }
+
+    return {'result_type': OTHER, 'ts_name': name}
+
+
+# returns memoized metadata of series name, callers must not modify it
+def parse(name):
+    meta = cache.get(name)
+    if meta is None:
+        if len(cache) >= CACHE_SIZE:
+            cache.clear()
+        meta = cache[name] = parse_name(name)
+    return meta
@@ -0,0 +1,203 @@
+import os
+import struct
+import urllib
+import uuid
+
+import numpy as np
+
+import resample
+
+# Every series is kept in its own file:
+# 16 bytes header (magic, format version, number of points),
+# then int64 millisecond timestamps (sorted), then float64 values (NaN for null).
+# Both columns are memory-mapped on read, a write replaces the file atomically.
+MAGIC = 'ECTS'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sIQ')
+SUFFIX = '.ts'
+# Weekly, monthly and quarterly rollups of every series are computed on write and kept next to it,
+# in ROLLUP_FOLDER/<frequency>/: the same header with ROLLUP_MAGIC, then int64 bucket start timestamps,
+# then a float64 column per aggregation in resample.AGGREGATIONS order.
+ROLLUP_MAGIC = 'ECRU'
+ROLLUP_FOLDER = 'rollups'
+
+
+class Series(object):
+    def __init__(self, timestamps, values):
+        self.timestamps = timestamps
+        self.values = values
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    # returns points within [start, end] millisecond timestamps, None means unbounded
+    def slice(self, start=None, end=None):
+        left = 0 if start is None else np.searchsorted(self.timestamps, start, 'left')
+        right = len(self.timestamps) if end is None else np.searchsorted(self.timestamps, end, 'right')
+        return Series(self.timestamps[left:right], self.values[left:right])
+
+    # returns values aligned with given sorted timestamps, NaN where there is no point
+    def values_at(self, timestamps):
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        result = np.full(len(timestamps), np.nan)
+        if not len(self.timestamps):
+            return result
+        index = np.searchsorted(self.timestamps, timestamps)
+        index[index == len(self.timestamps)] = 0
+        found = self.timestamps[index] == timestamps
+        result[found] = self.values[index[found]]
+        return result
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+# converts {timestamp: value} dict of results.json to a sorted series
+def series_from_dict(values):
+    timestamps = np.fromiter((int(key) for key in values), dtype=np.int64, count=len(values))
+    data = np.fromiter((to_float(value) for value in values.itervalues()), dtype=np.float64, count=len(values))
+    order = np.argsort(timestamps, kind='mergesort')
+    return Series(timestamps[order], data[order])
+
+
+# converts values array to a list with None for nulls, as used in JSON payloads
+def values_to_list(values):
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(np.isnan(values), None, values).tolist()
+
+
+# writes columns of equal length after the header to a temporary file, then replaces path with it
+def write_file(path, magic, columns):
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(magic, FORMAT_VERSION, len(columns[0])))
+        for column in columns:
+            f.write(column.tostring())
+    os.rename(tmp_path, path)
+
+
+class SeriesStore(object):
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get_path(self, name):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        return os.path.join(self.path, urllib.quote(name, safe='') + SUFFIX)
+
+    def get_rollup_path(self, name, frequency):
+        return os.path.join(self.path, ROLLUP_FOLDER, frequency, os.path.basename(self.get_path(name)))
+
+    def names(self):
+        return sorted(
+            urllib.unquote(filename[:-len(SUFFIX)]).decode('utf-8')
+            for filename in os.listdir(self.path) if filename.endswith(SUFFIX)
+        )
+
+    def __contains__(self, name):
+        return os.path.exists(self.get_path(name))
+
+    def is_empty(self):
+        return not any(filename.endswith(SUFFIX) for filename in os.listdir(self.path))
+
+    # returns memory-mapped series or None if there is no such series
+    def get(self, name):
+        path = self.get_path(name)
+        try:
+            with open(path, 'rb') as f:
+                magic, version, count = HEADER.unpack(f.read(HEADER.size))
+        except IOError:
+            return None
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError('%s is not a series file' % path)
+        if not count:
+            return Series(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+        timestamps = np.memmap(path, dtype='<i8', mode='r', offset=HEADER.size, shape=(count,))
+        values = np.memmap(path, dtype='<f8', mode='r', offset=HEADER.size + 8 * count, shape=(count,))
+        return Series(timestamps, values)
+
+    # returns memory-mapped rollup of the series by frequency and aggregation or None if there is no such series,
+    # rollups missing for series written before they were introduced are computed on first read
+    def get_rollup(self, name, frequency, aggregation):
+        if frequency not in resample.FREQUENCIES:
+            raise ValueError('Unknown frequency %s' % frequency)
+        if aggregation not in resample.AGGREGATIONS:
+            raise ValueError('Unknown aggregation %s' % aggregation)
+        path = self.get_rollup_path(name, frequency)
+        try:
+            with open(path, 'rb') as f:
+                magic, version, count = HEADER.unpack(f.read(HEADER.size))
+        except IOError:
+            series = self.get(name)
+            if series is None:
+                return None
+            self.put_rollups(name, series.timestamps, series.values)
+            return self.get_rollup(name, frequency, aggregation)
+        if magic != ROLLUP_MAGIC or version != FORMAT_VERSION:
+            raise ValueError('%s is not a rollup file' % path)
+        if not count:
+            return Series(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+        timestamps = np.memmap(path, dtype='<i8', mode='r', offset=HEADER.size, shape=(count,))
+        column = 1 + resample.AGGREGATIONS.index(aggregation)
+        values = np.memmap(path, dtype='<f8', mode='r', offset=HEADER.size + 8 * count * column, shape=(count,))
+        return Series(timestamps, values)
+
+    # returns values of the series aligned with given timestamps, NaN where there is no point
+    def values_at(self, name, timestamps):
+        series = self.get(name)
+        if series is None:
+            return np.full(len(timestamps), np.nan)
+        return series.values_at(timestamps)
+
+    # replaces series and its rollups, timestamps should be sorted and unique
+    def put(self, name, timestamps, values):
+        timestamps = np.ascontiguousarray(timestamps, dtype='<i8')
+        values = np.ascontiguousarray(values, dtype='<f8')
+        write_file(self.get_path(name), MAGIC, [timestamps, values])
+        self.put_rollups(name, timestamps, values)
+
+    def put_rollups(self, name, timestamps, values):
+        for frequency in resample.FREQUENCIES:
+            buckets, aggregates = resample.rollup(timestamps, values, frequency)
+            columns = [np.ascontiguousarray(buckets, dtype='<i8')]
+            columns.extend(np.ascontiguousarray(aggregates[aggregation], dtype='<f8')
+                           for aggregation in resample.AGGREGATIONS)
+            path = self.get_rollup_path(name, frequency)
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    # created by a concurrent writer
+                    pass
+            write_file(path, ROLLUP_MAGIC, columns)
+
+    # adds points to the series, new values win over existing ones with the same timestamps
+    def merge(self, name, timestamps, values):
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        series = self.get(name)
+        if series is not None and len(series):
+            timestamps = np.concatenate([timestamps, series.timestamps])
+            values = np.concatenate([values, series.values])
+        timestamps, index = np.unique(timestamps, return_index=True)
+        self.put(name, timestamps, values[index])
+
+    def delete(self, name):
+        paths = [self.get_path(name)] + [self.get_rollup_path(name, frequency) for frequency in resample.FREQUENCIES]
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # imports series of results.json format: {name: {timestamp: value}}
+    def import_results(self, results):
+        for name, values in results.iteritems():
+            series = series_from_dict(values)
+            self.put(name, series.timestamps, series.values)
@@ -1,11 +1,20 @@
 $(function () {
-    $('#ts_entity').on('change', function (e) {
-        if (e.target.value == 'new') {
-            $('#ts_entity_new_row').show();
-        } else {
-            $('#ts_entity_new_row').hide();
-        }
-    }).change()
+    var entitySearchTimeout;
+    $('#ts_entity').on('input', function (e) {
+        clearTimeout(entitySearchTimeout);
+        entitySearchTimeout = setTimeout(function () {
+            $.get({
+                url: '/timeseries/entities/' + $('#ts_type').val(),
+                data: {prefix: e.target.value},
+                success: function (response) {
+                    var $list = $('#ts_entity_list').empty();
+                    JSON.parse(response).forEach(function (entity) {
+                        $('<option>').attr('value', entity).appendTo($list);
+                    });
+                }
+            })
+        }, 200)
+    })
     $('#ts_index').on('change', function (e) {
         if (e.target.value == 'new') {
             $('#ts_index_new_row').show();
@@ -0,0 +1,88 @@
+// Chunked resumable upload of the file chosen in a form with data-upload-field attribute,
+// the attribute names the hidden field receiving upload_id. Sessions are remembered per file
+// in localStorage, so an upload interrupted by a network error or a page reload continues
+// from the offset stored on the server.
+$(function () {
+    var RETRIES = 5;
+
+    function sessionKey(file) {
+        return 'upload:' + [file.name, file.size, file.lastModified].join(':');
+    }
+
+    function createUpload(file) {
+        var uploadId = window.localStorage && localStorage.getItem(sessionKey(file));
+        var created = function () {
+            return $.ajax({
+                url: '/uploads',
+                method: 'POST',
+                contentType: 'application/json',
+                data: JSON.stringify({filename: file.name, size: file.size})
+            }).then(function (response) {
+                var upload = JSON.parse(response);
+                if (window.localStorage) {
+                    localStorage.setItem(sessionKey(file), upload.upload_id);
+                }
+                return upload;
+            });
+        };
+        if (!uploadId) {
+            return created();
+        }
+        return $.get('/uploads/' + uploadId).then(function (response) {
+            return JSON.parse(response);
+        }, created);
+    }
+
+    function sendChunks(file, upload, onProgress, retries) {
+        onProgress(upload.offset / (file.size || 1));
+        if (upload.complete) {
+            return $.Deferred().resolve(upload).promise();
+        }
+        var chunk = file.slice(upload.offset, upload.offset + upload.chunk_size);
+        return $.ajax({
+            url: '/uploads/' + upload.upload_id + '?offset=' + upload.offset,
+            method: 'PUT',
+            contentType: 'application/octet-stream',
+            processData: false,
+            data: chunk
+        }).then(function (response) {
+            return sendChunks(file, JSON.parse(response), onProgress, RETRIES);
+        }, function () {
+            if (!retries) {
+                return $.Deferred().reject().promise();
+            }
+            // resume from the offset the server has stored
+            return $.get('/uploads/' + upload.upload_id).then(function (response) {
+                return sendChunks(file, JSON.parse(response), onProgress, retries - 1);
+            });
+        });
+    }
+
+    $('form[data-upload-field]').on('submit', function (e) {
+        var form = this;
+        var $uploadId = $(form).find('[name="' + $(form).data('upload-field') + '"]');
+        var $file = $(form).find('input[type=file]');
+        var file = $file[0].files[0];
+        if (!file || $uploadId.val()) {
+            return;
+        }
+        e.preventDefault();
+        var $progress = $(form).find('.upload-progress').show().find('.progress-bar');
+        createUpload(file).then(function (upload) {
+            return sendChunks(file, upload, function (done) {
+                $progress.css('width', Math.round(done * 100) + '%');
+            }, RETRIES);
+        }).then(function (upload) {
+            if (window.localStorage) {
+                localStorage.removeItem(sessionKey(file));
+            }
+            $uploadId.val(upload.upload_id);
+            // the file is on the server already, do not post it again
+            $file.prop('disabled', true);
+            form.submit();
+        }, function () {
+            $(form).find('.upload-progress').hide();
+            alert('Upload failed, submit the form again to resume');
+        });
+    });
+});
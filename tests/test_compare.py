@@ -0,0 +1,90 @@
+import unittest
+
+import numpy as np
+
+import compare
+
+nan = np.nan
+
+
+def get_run(days, series):
+    names = sorted(series)
+    return np.array(days, dtype=np.int64), names, np.array([series[name] for name in names], dtype=np.float64)
+
+
+def get_series(result, name):
+    return [item for item in result['series'] if item['name'] == name][0]
+
+
+class MergeJoinTest(unittest.TestCase):
+    def test_positions_of_days_in_both_runs(self):
+        days, a, b = compare.merge_join(np.array([1, 2, 4]), np.array([2, 3, 4, 5]))
+        self.assertEqual(days.tolist(), [1, 2, 3, 4, 5])
+        self.assertEqual(a.tolist(), [0, 1, -1, 2, -1])
+        self.assertEqual(b.tolist(), [-1, 0, 1, 2, 3])
+
+    def test_empty_run(self):
+        days, a, b = compare.merge_join(np.array([], dtype=np.int64), np.array([7]))
+        self.assertEqual(a.tolist(), [-1])
+        self.assertEqual(b.tolist(), [0])
+
+
+class CompareTest(unittest.TestCase):
+    def setUp(self):
+        self.baseline = get_run([1, 2, 3, 4], {
+            'a': [1.0, 2.0, 3.0, 4.0],
+            'b': [0.0, 0.0, nan, 5.0],
+            'only_baseline': [1.0, 1.0, 1.0, 1.0]
+        })
+        self.scenario = get_run([2, 3, 4, 5], {
+            'a': [2.0, 4.0, 4.0, 100.0],
+            'b': [1.0, nan, nan, 5.0],
+            'only_scenario': [1.0, 1.0, 1.0, 1.0]
+        })
+
+    def test_days_and_names(self):
+        result = compare.compare(self.baseline, self.scenario)
+        self.assertEqual(result['days'], {'compared': 3, 'baseline_only': 1, 'scenario_only': 1})
+        self.assertEqual(result['baseline_only'], ['only_baseline'])
+        self.assertEqual(result['scenario_only'], ['only_scenario'])
+        self.assertEqual([item['name'] for item in result['series']], ['a', 'b'])
+
+    def test_statistics_over_common_points(self):
+        a = get_series(compare.compare(self.baseline, self.scenario), 'a')
+        self.assertEqual(a['points'], 3)
+        self.assertEqual(a['changed'], 1)
+        self.assertEqual(a['first_changed'], 3)
+        self.assertEqual(a['max_abs_delta'], 1.0)
+        self.assertAlmostEqual(a['mean_delta'], 1.0 / 3)
+        self.assertEqual(a['baseline_total'], 9.0)
+        self.assertEqual(a['scenario_total'], 10.0)
+        self.assertAlmostEqual(a['relative_total'], 1.0 / 9)
+        self.assertAlmostEqual(a['max_abs_relative_delta'], 1.0 / 3)
+
+    def test_nulls_and_zero_baseline(self):
+        b = get_series(compare.compare(self.baseline, self.scenario, deltas=True), 'b')
+        self.assertEqual(b['points'], 1)
+        self.assertEqual(b['changed'], 1)
+        self.assertEqual(b['baseline_total'], 0.0)
+        self.assertIsNone(b['relative_total'])
+        self.assertIsNone(b['max_abs_relative_delta'])
+        self.assertEqual(b['x'], [2])
+        self.assertEqual(b['delta'], [1.0])
+        self.assertEqual(b['relative_delta'], [None])
+
+    def test_tolerance_and_changed_only(self):
+        result = compare.compare(self.baseline, self.scenario, tolerance=1.0, changed_only=True)
+        self.assertEqual(result['series'], [])
+
+    def test_series_without_common_points(self):
+        scenario = get_run([9], {'a': [1.0]})
+        a = get_series(compare.compare(self.baseline, scenario, deltas=True), 'a')
+        self.assertEqual(a['points'], 0)
+        self.assertIsNone(a['first_changed'])
+        self.assertIsNone(a['max_abs_delta'])
+        self.assertIsNone(a['mean_delta'])
+        self.assertNotIn('delta', a)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,336 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import engine
+from catalog import ModelCatalog
+from result_cache import ResultCache
+
+START_DAY = '2018-01-01'
+
+
+def get_input(series_id, name, source_type, source, source_model=None):
+    return {
+        'series_id': str(series_id),
+        'series_type': 'input',
+        'series_name_system': 'series_%s' % series_id,
+        'series_name_user': name,
+        'source': {
+            'source_type': source_type,
+            'source_author': 'tester',
+            'source_series_name_system': source,
+            'source_model_name_user': source_model or 'None'
+        }
+    }
+
+
+def get_output(series_id, name):
+    return {
+        'series_id': str(series_id),
+        'series_type': 'output',
+        'series_name_system': 'series_%s' % series_id,
+        'series_name_user': name,
+        'source': 'self',
+        'comment': 'no comment'
+    }
+
+
+def get_model(name, model_name_user, inputs, outputs):
+    return {
+        'model_system_name': name,
+        'model_name_user': model_name_user,
+        'author': 'tester',
+        'inputs': dict((value['series_name_user'], value) for value in inputs),
+        'outputs': dict((value['series_name_user'], value) for value in outputs)
+    }
+
+
+# Chain of models: oil timeseries -> model_0 (fuel) -> model_1 (cost) -> model_2 (profit),
+# model_3 reads the oil timeseries only.
+MODELS = [
+    get_model('model_2', 'Profit', [get_input(8, 'cost', 'output', 'series_7', 'Cost')], [get_output(9, 'profit')]),
+    get_model('model_0', 'Fuel', [get_input(3, 'oil', 'timeseries', 'series_0')], [get_output(4, 'fuel')]),
+    get_model('model_1', 'Cost', [get_input(5, 'fuel', 'output', 'series_4', 'Fuel'),
+                                  get_input(6, 'rate', 'timeseries', 'series_1')], [get_output(7, 'cost')]),
+    get_model('model_3', 'Other', [get_input(10, 'oil', 'timeseries', 'series_0')], [get_output(11, 'other')])
+]
+TIMESERIES = [
+    {'series_name_system': 'series_0', 'ts_name': 'oil_Brent', 'ts_author': 'tester'},
+    {'series_name_system': 'series_1', 'ts_name': 'rate', 'ts_author': 'tester'},
+    {'series_name_system': 'series_2', 'ts_name': 'gas', 'ts_author': 'tester'}
+]
+STORED = {
+    'oil_Brent:tester:timeseries': [10.0, 20.0, np.nan, 40.0],
+    'rate:tester:timeseries': [1.0, 1.0, 2.0, 2.0],
+    'gas:tester:timeseries': [5.0, 5.0, 5.0, 5.0]
+}
+
+
+# evaluators run in pool processes, so they are module level functions
+def evaluate_fuel(inputs, number_of_days):
+    return {'fuel': inputs['oil'] * 2}
+
+
+def evaluate_cost(inputs, number_of_days):
+    return {'cost': inputs['fuel'] * inputs['rate']}
+
+
+def evaluate_cost_with_fee(inputs, number_of_days):
+    return {'cost': inputs['fuel'] * inputs['rate'] + 1}
+
+
+def evaluate_profit(inputs, number_of_days):
+    return {'profit': 100 - inputs['cost']}
+
+
+def load_series(name, days):
+    return np.asarray(STORED[name][:len(days)], dtype=np.float64)
+
+
+def get_commands(include, *commands):
+    return [
+        {'command': 'start_day', 'start_day': START_DAY},
+        {'command': 'number_of_days', 'number_of_days': 4},
+        {'command': 'exe_models', 'include': include}
+    ] + list(commands)
+
+
+class EngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.write_models(MODELS)
+        with open(os.path.join(self.folder, 'timeseries.json'), 'w') as f:
+            json.dump(TIMESERIES, f)
+        self.catalog = ModelCatalog(os.path.join(self.folder, 'models.json'))
+        engine.register_evaluator('model_0', evaluate_fuel)
+        engine.register_evaluator('model_1', evaluate_cost)
+        engine.register_evaluator('model_2', evaluate_profit)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        engine.evaluators.clear()
+
+    def write_models(self, models):
+        with open(os.path.join(self.folder, 'models.json'), 'w') as f:
+            json.dump(models, f)
+
+    def get_plan(self, include, *commands):
+        return engine.RunPlan(self.catalog, get_commands(include, *commands))
+
+
+class RunPlanOrderTest(EngineTestCase):
+    def test_models_follow_their_upstream_models(self):
+        plan = self.get_plan(['model_2', 'model_1', 'model_0', 'model_3'])
+        order = plan.order
+        self.assertEqual(sorted(order), ['model_0', 'model_1', 'model_2', 'model_3'])
+        self.assertLess(order.index('model_0'), order.index('model_1'))
+        self.assertLess(order.index('model_1'), order.index('model_2'))
+
+    def test_models_outside_of_the_run_are_not_dependencies(self):
+        plan = self.get_plan(['model_2', 'model_0'])
+        self.assertEqual(plan.upstream, {'model_0': set(), 'model_2': set()})
+
+    def test_cyclic_wiring_fails(self):
+        models = [dict(model) for model in MODELS]
+        models[1] = get_model('model_0', 'Fuel', [get_input(3, 'oil', 'output', 'series_9', 'Profit')],
+                              [get_output(4, 'fuel')])
+        self.write_models(models)
+        with self.assertRaisesRegexp(engine.RunError, 'cyclic'):
+            self.get_plan(['model_0', 'model_1', 'model_2'])
+
+    def test_unknown_model_fails(self):
+        with self.assertRaisesRegexp(engine.RunError, 'Unknown model model_9'):
+            self.get_plan(['model_9'])
+
+    def test_required_commands(self):
+        with self.assertRaises(engine.RunError):
+            engine.RunPlan(self.catalog, get_commands(['model_0'])[1:])
+
+
+class CommandValuesTest(EngineTestCase):
+    def assertRunError(self, message, commands):
+        with self.assertRaisesRegexp(engine.RunError, message):
+            engine.RunPlan(self.catalog, commands)
+
+    def test_run_days(self):
+        commands = get_commands(['model_0'])
+        for value in ['12', 0, -1, 1.5, True, engine.MAX_NUMBER_OF_DAYS + 1]:
+            commands[1]['number_of_days'] = value
+            self.assertRunError('^number_of_days should be', commands)
+        commands[1]['number_of_days'] = 4
+        for value in [5, '2018-13-01', None]:
+            commands[0]['start_day'] = value
+            self.assertRunError('^start_day should be a day', commands)
+
+    def test_value_commands(self):
+        command = {'command': 'change_timeseries_value_several_days_add_delta', 'input_source_initial': 'series_3',
+                   'start_day': '2018-01-02', 'number_of_days': 2, 'delta': 1.0}
+        for field, value in [('delta', 'abc'), ('delta', float('nan')), ('delta', None), ('number_of_days', '12'),
+                             ('number_of_days', -1), ('start_day', 20180102)]:
+            commands = get_commands(['model_0'], dict(command, **{field: value}))
+            self.assertRunError('^%s of change_timeseries_value_several_days_add_delta should be' % field, commands)
+        commands = get_commands(['model_0'], {
+            'command': 'change_timeseries_value_several_days', 'input_source_initial': 'series_3',
+            'start_day': '2018-01-02', 'number_of_days': 2, 'new_value': '1'
+        })
+        self.assertRunError('new_value of change_timeseries_value_several_days should be a number', commands)
+
+
+class InputSwapTest(EngineTestCase):
+    def test_one_model_swap_changes_only_that_model(self):
+        plan = self.get_plan(['model_0', 'model_3'], {
+            'command': 'change_input_series_one_model',
+            'model_system_name': 'model_0',
+            'input_source_initial': 'series_3',
+            'input_source_final': 'series_6'
+        })
+        self.assertEqual(plan.sources['series_3']['source_series_name_system'], 'series_1')
+        self.assertEqual(plan.sources['series_10']['source_series_name_system'], 'series_0')
+
+    def test_one_model_swap_of_foreign_input_fails(self):
+        with self.assertRaisesRegexp(engine.RunError, 'not an input of model model_3'):
+            self.get_plan(['model_0', 'model_3'], {
+                'command': 'change_input_series_one_model',
+                'model_system_name': 'model_3',
+                'input_source_initial': 'series_3',
+                'input_source_final': 'series_6'
+            })
+
+    def test_all_models_swap_changes_every_reader_of_the_source(self):
+        plan = self.get_plan(['model_0', 'model_3'], {
+            'command': 'change_input_series_all_models',
+            'input_source_initial': 'series_3',
+            'input_source_final': 'series_6'
+        })
+        self.assertEqual(plan.sources['series_3']['source_series_name_system'], 'series_1')
+        self.assertEqual(plan.sources['series_10']['source_series_name_system'], 'series_1')
+
+    def test_unknown_input_fails(self):
+        with self.assertRaisesRegexp(engine.RunError, 'Unknown input series_99'):
+            self.get_plan(['model_0'], {
+                'command': 'change_input_series_all_models',
+                'input_source_initial': 'series_99',
+                'input_source_final': 'series_6'
+            })
+
+
+class ValueCommandsTest(EngineTestCase):
+    def apply(self, *commands):
+        plan = self.get_plan(['model_0'], *commands)
+        return plan.apply_value_commands('series_3', [10.0, 20.0, np.nan, 40.0])
+
+    def test_new_value_replaces_values_of_its_days(self):
+        values = self.apply({'command': 'change_timeseries_value_several_days', 'input_source_initial': 'series_3',
+                             'start_day': '2018-01-02', 'number_of_days': 2, 'new_value': 7.0})
+        np.testing.assert_array_equal(values, [10.0, 7.0, 7.0, 40.0])
+
+    def test_delta_is_added_and_keeps_nulls(self):
+        values = self.apply({'command': 'change_timeseries_value_several_days_add_delta',
+                             'input_source_initial': 'series_3', 'start_day': '2018-01-02', 'number_of_days': 3,
+                             'delta': 1.5})
+        np.testing.assert_array_equal(values, [10.0, 21.5, np.nan, 41.5])
+
+    def test_commands_apply_in_given_order(self):
+        delta = {'command': 'change_timeseries_value_several_days_add_delta', 'input_source_initial': 'series_3',
+                 'start_day': '2018-01-01', 'number_of_days': 4, 'delta': 1.0}
+        new_value = {'command': 'change_timeseries_value_several_days', 'input_source_initial': 'series_3',
+                     'start_day': '2018-01-01', 'number_of_days': 2, 'new_value': 0.0}
+        np.testing.assert_array_equal(self.apply(delta, new_value, delta), [1.0, 1.0, np.nan, 42.0])
+        np.testing.assert_array_equal(self.apply(new_value, delta), [1.0, 1.0, np.nan, 41.0])
+
+    def test_days_outside_of_the_run_are_ignored(self):
+        values = self.apply({'command': 'change_timeseries_value_several_days', 'input_source_initial': 'series_3',
+                             'start_day': '2017-12-30', 'number_of_days': 3, 'new_value': 7.0},
+                            {'command': 'change_timeseries_value_several_days_add_delta',
+                             'input_source_initial': 'series_3', 'start_day': '2018-01-04', 'number_of_days': 10,
+                             'delta': 1.0})
+        np.testing.assert_array_equal(values, [7.0, 20.0, np.nan, 41.0])
+
+    def test_commands_change_inputs_of_the_run(self):
+        plan = self.get_plan(['model_0'], {
+            'command': 'change_timeseries_value_several_days', 'input_source_initial': 'series_3',
+            'start_day': '2018-01-03', 'number_of_days': 1, 'new_value': 30.0
+        })
+        results = engine.run(plan, load_series, processes=1)
+        np.testing.assert_array_equal(results['fuel,tester,(output,Fuel)'], [20.0, 40.0, 60.0, 80.0])
+
+
+class RunTest(EngineTestCase):
+    def test_outputs_flow_downstream(self):
+        plan = self.get_plan(['model_0', 'model_1', 'model_2'])
+        results = engine.run(plan, load_series, processes=1)
+        profit = results['profit,tester,(output,Profit)']
+        np.testing.assert_array_equal(profit, [80.0, 60.0, np.nan, -60.0])
+        oil = [name for name in results if name.startswith('oil,Fuel,')]
+        self.assertEqual(oil, ['oil,Fuel,tester,input,source_type:timeseries,oil,tester'])
+
+    def test_models_without_evaluator_fail(self):
+        with self.assertRaisesRegexp(engine.RunError, 'Models have no evaluator: model_3'):
+            engine.run(self.get_plan(['model_0', 'model_3']), load_series, processes=1)
+
+    def test_missing_outputs_fail(self):
+        engine.register_evaluator('model_3', evaluate_fuel)
+        with self.assertRaisesRegexp(engine.RunError, 'Model model_3 did not compute outputs other'):
+            engine.run(self.get_plan(['model_3']), load_series, processes=1)
+
+
+class ResultCacheTest(EngineTestCase):
+    def setUp(self):
+        super(ResultCacheTest, self).setUp()
+        self.cache = ResultCache(1024 * 1024)
+        self.stored = dict(STORED)
+
+    def load_series(self, name, days):
+        return np.asarray(self.stored[name][:len(days)], dtype=np.float64)
+
+    # runs the model chain, returns (cache hits, misses) of the run
+    def run_chain(self, *commands):
+        hits, misses = self.cache.hits, self.cache.misses
+        plan = self.get_plan(['model_0', 'model_1', 'model_2'], *commands)
+        self.results = engine.run(plan, self.load_series, processes=1, cache=self.cache)
+        return self.cache.hits - hits, self.cache.misses - misses
+
+    def test_identical_inputs_hit(self):
+        self.assertEqual(self.run_chain(), (0, 3))
+        first = self.results
+        self.assertEqual(self.run_chain(), (3, 0))
+        self.assertEqual(sorted(self.results), sorted(first))
+        for name in first:
+            np.testing.assert_array_equal(self.results[name], first[name])
+
+    def test_changed_series_recomputes_downstream_models(self):
+        self.run_chain()
+        self.stored['rate:tester:timeseries'] = [2.0, 2.0, 2.0, 2.0]
+        self.assertEqual(self.run_chain(), (1, 2))
+        np.testing.assert_array_equal(self.results['profit,tester,(output,Profit)'], [60.0, 20.0, np.nan, -60.0])
+        self.stored['oil_Brent:tester:timeseries'] = [1.0, 2.0, 3.0, 4.0]
+        self.assertEqual(self.run_chain(), (0, 3))
+
+    def test_value_commands_recompute_downstream_models(self):
+        self.run_chain()
+        command = {'command': 'change_timeseries_value_several_days_add_delta', 'input_source_initial': 'series_6',
+                   'start_day': '2018-01-01', 'number_of_days': 1, 'delta': 1.0}
+        self.assertEqual(self.run_chain(command), (1, 2))
+        self.assertEqual(self.run_chain(command), (3, 0))
+
+    def test_changed_evaluator_recomputes_downstream_models(self):
+        self.run_chain()
+        engine.register_evaluator('model_1', evaluate_cost_with_fee)
+        self.assertEqual(self.run_chain(), (1, 2))
+        np.testing.assert_array_equal(self.results['cost,tester,(output,Cost)'], [21.0, 41.0, np.nan, 161.0])
+
+    def test_changed_days_recompute_all_models(self):
+        self.run_chain()
+        commands = get_commands(['model_0', 'model_1', 'model_2'])
+        commands[1]['number_of_days'] = 3
+        hits = self.cache.hits
+        engine.run(engine.RunPlan(self.catalog, commands), self.load_series, processes=1, cache=self.cache)
+        self.assertEqual(self.cache.hits, hits)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import csv
+import io
+import unittest
+
+import numpy as np
+
+import engine
+import export
+from series_store import Series
+
+nan = np.nan
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        days = engine.get_days('2018-01-01', 5)
+        self.series = {
+            'a': Series(days[[0, 1, 3]], np.array([1.0, nan, 3.5])),
+            'b': Series(days[[1, 2]], np.array([2.0, 4.0]))
+        }
+        self.days = days
+
+    def export(self, export_format, names, start=None, end=None):
+        return ''.join(export.export(export_format, self.series.get, names, start, end))
+
+    def read_csv(self, data):
+        return list(csv.reader(io.BytesIO(data)))
+
+    def test_long(self):
+        rows = self.read_csv(self.export('long', ['a', 'missing', 'b']))
+        self.assertEqual(rows, [
+            ['name', 'day', 'value'],
+            ['a', '2018-01-01', '1.0'], ['a', '2018-01-02', ''], ['a', '2018-01-04', '3.5'],
+            ['b', '2018-01-02', '2.0'], ['b', '2018-01-03', '4.0']
+        ])
+
+    def test_wide_skips_days_without_points(self):
+        rows = self.read_csv(self.export('wide', ['a', 'b', 'missing']))
+        self.assertEqual(rows, [
+            ['day', 'a', 'b', 'missing'],
+            ['2018-01-01', '1.0', '', ''],
+            ['2018-01-02', '', '2.0', ''],
+            ['2018-01-03', '', '4.0', ''],
+            ['2018-01-04', '3.5', '', '']
+        ])
+
+    def test_range(self):
+        rows = self.read_csv(self.export('long', ['a', 'b'], self.days[1], self.days[2]))
+        self.assertEqual(rows[1:], [['a', '2018-01-02', ''], ['b', '2018-01-02', '2.0'], ['b', '2018-01-03', '4.0']])
+
+    def test_columnar_round_trip(self):
+        data = self.export('columnar', ['a', 'missing', 'b'])
+        row_groups = list(export.read_columnar(io.BytesIO(data)))
+        self.assertEqual([name for name, timestamps, values in row_groups], ['a', 'b'])
+        for name, timestamps, values in row_groups:
+            np.testing.assert_array_equal(timestamps, self.series[name].timestamps)
+            np.testing.assert_array_equal(values, self.series[name].values)
+
+    def test_columnar_row_groups_are_chunked(self):
+        days = engine.get_days('2000-01-01', 2 * export.CHUNK_POINTS + 1)
+        self.series['long'] = Series(days, np.arange(len(days), dtype=np.float64))
+        row_groups = list(export.read_columnar(io.BytesIO(self.export('columnar', ['long']))))
+        self.assertEqual([len(timestamps) for name, timestamps, values in row_groups],
+                         [export.CHUNK_POINTS, export.CHUNK_POINTS, 1])
+        np.testing.assert_array_equal(np.concatenate([values for name, timestamps, values in row_groups]),
+                                      self.series['long'].values)
+
+    def test_read_columnar_rejects_other_files(self):
+        with self.assertRaises(ValueError):
+            list(export.read_columnar(io.BytesIO('name,day,value\n')))
+
+
+if __name__ == '__main__':
+    unittest.main()
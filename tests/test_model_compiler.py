@@ -0,0 +1,175 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import openpyxl
+from openpyxl.workbook.defined_name import DefinedName
+
+import engine
+import model_compiler
+from catalog import ModelCatalog
+from model_compiler import CompileError
+
+
+class ModelCompilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    # saves a workbook of (label, value) rows in columns A and B, returns its path
+    def save(self, rows, title='Model', defined_names=None):
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.title = title
+        for row in rows:
+            sheet.append(list(row))
+        for name, reference in (defined_names or {}).items():
+            workbook.defined_names.append(DefinedName(name, attr_text=reference))
+        path = os.path.join(self.folder, 'model%s.xlsx' % len(os.listdir(self.folder)))
+        workbook.save(path)
+        return path
+
+    def compile(self, rows, **kwargs):
+        return model_compiler.load(self.save(rows, **kwargs), os.path.join(self.folder, 'compiled'))
+
+    def evaluate(self, formula, inputs=None, **kwargs):
+        model = self.compile([('x', 2), ('y', 4), ('result', formula)], **kwargs)
+        return model(inputs or {}, 3)['result']
+
+
+class CompileTest(ModelCompilerTestCase):
+    def test_named_cells_are_inputs_and_formulas_are_outputs(self):
+        model = self.compile([('oil', 50), ('rate', 0.5), ('cost', '=oil*rate')])
+        self.assertEqual(model.inputs, {'oil': 'Model!B1', 'rate': 'Model!B2'})
+        self.assertEqual(model.outputs, {'cost': 'Model!B3'})
+
+    def test_inputs_are_arrays_of_all_days(self):
+        model = self.compile([('oil', 50), ('rate', 0.5), ('cost', '=oil*rate')])
+        outputs = model({'oil': np.array([10.0, np.nan, 30.0])}, 3)
+        np.testing.assert_array_equal(outputs['cost'], [5.0, np.nan, 15.0])
+
+    def test_missing_inputs_take_workbook_values(self):
+        model = self.compile([('oil', 50), ('rate', 0.5), ('cost', '=oil*rate')])
+        np.testing.assert_array_equal(model({}, 2)['cost'], [25.0, 25.0])
+
+    def test_defined_names_take_precedence_over_labels(self):
+        model = self.compile([('oil', 50), ('cost', '=margin+oil')], defined_names={'margin': 'Model!$C$1'})
+        self.assertEqual(model.inputs, {'oil': 'Model!B1', 'margin': 'Model!C1'})
+
+    def test_operator_precedence(self):
+        np.testing.assert_array_equal(self.evaluate('=1+x*y^2-8/x'), [29.0] * 3)
+        np.testing.assert_array_equal(self.evaluate('=-x^2'), [4.0] * 3)
+        np.testing.assert_array_equal(self.evaluate('=(1+x)*y'), [12.0] * 3)
+        np.testing.assert_array_equal(self.evaluate('=50%*y'), [2.0] * 3)
+
+    def test_functions(self):
+        np.testing.assert_array_equal(self.evaluate('=SUM(B1:B2, 1)'), [7.0] * 3)
+        np.testing.assert_array_equal(self.evaluate('=IF(x>y, 1, MAX(x, y))'), [4.0] * 3)
+        np.testing.assert_array_equal(self.evaluate('=ROUND(x/4) + ROUND(-x/4)'), [0.0] * 3)
+        np.testing.assert_array_equal(self.evaluate('=ROUND(2.5) + ROUND(-2.5)'), [0.0] * 3)
+        np.testing.assert_array_equal(self.evaluate('=ROUND(2.5)'), [3.0] * 3)
+
+    def test_division_by_zero_is_null(self):
+        values = self.evaluate('=y/x', {'x': np.array([2.0, 0.0, 4.0])})
+        np.testing.assert_array_equal(values, [2.0, np.nan, 1.0])
+
+    def test_compiled_artifact_is_reused(self):
+        path = self.save([('oil', 50), ('cost', '=oil*2')])
+        cache_folder = os.path.join(self.folder, 'compiled')
+        first = model_compiler.load(path, cache_folder)
+        self.assertEqual(os.listdir(cache_folder), ['%s.json' % first.digest])
+        second = model_compiler.load(path, cache_folder)
+        self.assertEqual(first.version, second.version)
+        self.assertEqual(first.source, second.source)
+
+    def test_sheet_titles_are_not_code(self):
+        model = self.compile([('oil', 50), ('cost', '=oil*2')], title="M\nraise SystemExit")
+        np.testing.assert_array_equal(model({}, 1)['cost'], [100.0])
+
+
+class CompileErrorTest(ModelCompilerTestCase):
+    def assertCompileError(self, rows, message, **kwargs):
+        with self.assertRaisesRegexp(CompileError, message):
+            self.compile(rows, **kwargs)
+
+    def test_unsupported_function(self):
+        self.assertCompileError([('x', 1), ('y', '=VLOOKUP(x, B1:B1, 1)')], 'Unsupported function VLOOKUP')
+
+    def test_circular_reference(self):
+        self.assertCompileError([('x', '=y+1'), ('y', '=x+1')], 'Circular reference')
+
+    def test_range_outside_of_function(self):
+        self.assertCompileError([('x', 1), ('z', 2), ('y', '=B1:B2+1')], 'Range outside of a function')
+
+    def test_unknown_name(self):
+        self.assertCompileError([('x', 1), ('y', '=x+unknown')], 'Unknown name UNKNOWN')
+
+    def test_unbalanced_formula(self):
+        self.assertCompileError([('x', 1), ('y', '=x+(')], 'Unexpected end')
+
+    def test_no_outputs(self):
+        self.assertCompileError([('x', 1)], 'no named formula cells')
+
+    def test_invalid_defined_name(self):
+        self.assertCompileError([('x', 1), ('y', '=x+1')], 'Invalid cell', defined_names={'z': 'Model!$ZZZZZ$1'})
+
+    def test_too_deep_formula_chain(self):
+        rows = [('start', 1)] + [('x%s' % row, '=B%s+1' % row) for row in range(1, 3000)]
+        self.assertCompileError(rows, 'recursion')
+
+    def test_unreadable_workbook(self):
+        path = os.path.join(self.folder, 'broken.xlsx')
+        with open(path, 'wb') as f:
+            f.write('not a workbook')
+        with self.assertRaisesRegexp(CompileError, 'Cannot read workbook broken.xlsx'):
+            model_compiler.load(path, os.path.join(self.folder, 'compiled'))
+
+
+class CheckNamesTest(ModelCompilerTestCase):
+    def test_model_names_should_be_workbook_cells(self):
+        evaluator = self.compile([('oil', 50), ('cost', '=oil*2')])
+        model = {'model_system_name': 'model_0', 'inputs': {'oil': {}}, 'outputs': {'cost': {}}}
+        model_compiler.check_names(model, evaluator)
+        model['outputs']['profit'] = {}
+        with self.assertRaisesRegexp(CompileError, 'no output cells named profit'):
+            model_compiler.check_names(model, evaluator)
+
+
+class RegisterEvaluatorsTest(ModelCompilerTestCase):
+    def setUp(self):
+        super(RegisterEvaluatorsTest, self).setUp()
+        good = self.save([('oil', 50), ('cost', '=oil*2')])
+        broken = os.path.join(self.folder, 'broken.xlsx')
+        with open(broken, 'wb') as f:
+            f.write('not a workbook')
+        models = [
+            {'model_system_name': 'model_0', 'model_name_user': 'Good', 'author': 'tester',
+             'workbook': os.path.basename(good), 'inputs': {}, 'outputs': {}},
+            {'model_system_name': 'model_1', 'model_name_user': 'Broken', 'author': 'tester',
+             'workbook': 'broken.xlsx', 'inputs': {}, 'outputs': {}}
+        ]
+        with open(os.path.join(self.folder, 'models.json'), 'w') as f:
+            json.dump(models, f)
+        self.catalog = ModelCatalog(os.path.join(self.folder, 'models.json'))
+
+    def tearDown(self):
+        super(RegisterEvaluatorsTest, self).tearDown()
+        engine.evaluators.clear()
+        model_compiler.registered.clear()
+
+    def test_only_given_models_are_compiled(self):
+        model_compiler.register_evaluators(self.catalog, ['model_0'])
+        self.assertEqual(sorted(engine.evaluators), ['model_0'])
+
+    def test_broken_workbook_fails_its_model(self):
+        with self.assertRaisesRegexp(CompileError, 'broken.xlsx'):
+            model_compiler.register_evaluators(self.catalog, ['model_0', 'model_1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
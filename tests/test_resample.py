@@ -0,0 +1,84 @@
+import unittest
+
+import numpy as np
+
+import engine
+import resample
+
+
+def get_timestamps(*days):
+    return [engine.day_to_timestamp(engine.str_to_day(day)) for day in days]
+
+
+def to_day(timestamps):
+    return np.asarray(timestamps, dtype=np.int64).astype('datetime64[ms]').astype('datetime64[D]').astype(str).tolist()
+
+
+class BucketStartsTest(unittest.TestCase):
+    def test_weeks_start_on_monday(self):
+        # 2018-01-01 is Monday
+        starts = resample.bucket_starts(engine.get_days('2017-12-30', 10), 'week')
+        self.assertEqual(to_day(starts), ['2017-12-25'] * 2 + ['2018-01-01'] * 7 + ['2018-01-08'])
+
+    def test_months_and_quarters(self):
+        days = get_timestamps('2018-01-31', '2018-02-01', '2018-06-30')
+        self.assertEqual(to_day(resample.bucket_starts(days, 'month')), ['2018-01-01', '2018-02-01', '2018-06-01'])
+        self.assertEqual(to_day(resample.bucket_starts(days, 'quarter')), ['2018-01-01', '2018-01-01', '2018-04-01'])
+
+    def test_unknown_frequency(self):
+        with self.assertRaises(ValueError):
+            resample.bucket_starts(engine.get_days('2018-01-01', 1), 'year')
+
+
+class RollupTest(unittest.TestCase):
+    def rollup(self, values, start_day='2018-01-01'):
+        return resample.rollup(engine.get_days(start_day, len(values)), values, 'week')
+
+    def test_aggregations(self):
+        buckets, aggregates = self.rollup([1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 10.0])
+        self.assertEqual(to_day(buckets), ['2018-01-01', '2018-01-08'])
+        np.testing.assert_array_equal(aggregates['sum'], [28.0, 10.0])
+        np.testing.assert_array_equal(aggregates['mean'], [4.0, 10.0])
+        np.testing.assert_array_equal(aggregates['last'], [7.0, 10.0])
+        np.testing.assert_array_equal(aggregates['min'], [1.0, 10.0])
+        np.testing.assert_array_equal(aggregates['max'], [7.0, 10.0])
+
+    def test_nulls_are_skipped(self):
+        buckets, aggregates = self.rollup([np.nan, 2.0, np.nan, 4.0, np.nan, np.nan, np.nan])
+        self.assertEqual(aggregates['sum'].tolist(), [6.0])
+        self.assertEqual(aggregates['mean'].tolist(), [3.0])
+        self.assertEqual(aggregates['last'].tolist(), [4.0])
+        self.assertEqual(aggregates['min'].tolist(), [2.0])
+        self.assertEqual(aggregates['max'].tolist(), [4.0])
+
+    def test_bucket_of_nulls_is_null(self):
+        buckets, aggregates = self.rollup([1.0] * 7 + [np.nan] * 7 + [3.0])
+        for aggregation in resample.AGGREGATIONS:
+            values = aggregates[aggregation]
+            self.assertEqual(len(values), 3)
+            self.assertTrue(np.isnan(values[1]), aggregation)
+            self.assertFalse(np.isnan(values[0]) or np.isnan(values[2]), aggregation)
+
+    def test_gaps_between_days(self):
+        timestamps = engine.get_days('2018-01-01', 60)[[0, 40, 41]]
+        buckets, values = resample.resample(timestamps, [1.0, 2.0, 3.0], 'month', 'sum')
+        self.assertEqual(to_day(buckets), ['2018-01-01', '2018-02-01'])
+        np.testing.assert_array_equal(values, [1.0, 5.0])
+
+    def test_empty_series(self):
+        buckets, aggregates = self.rollup([])
+        self.assertEqual(len(buckets), 0)
+        self.assertEqual(sorted(aggregates), sorted(resample.AGGREGATIONS))
+
+
+class ChooseFrequencyTest(unittest.TestCase):
+    def test_finest_frequency_within_points(self):
+        self.assertIsNone(resample.choose_frequency(300, 300))
+        self.assertEqual(resample.choose_frequency(301, 300), 'week')
+        self.assertEqual(resample.choose_frequency(3650, 300), 'month')
+        self.assertEqual(resample.choose_frequency(3650, 100), 'quarter')
+        self.assertIsNone(resample.choose_frequency(36500, 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zlib
+
+import uploads
+from uploads import UploadConflict, UploadError
+
+
+# In-memory stand-in for the few Redis commands uploads use, keys expire only when a test deletes them
+class FakeRedis(object):
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def hmset(self, key, mapping):
+        self.data.setdefault(key, {}).update((field, str(value)) for field, value in mapping.items())
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def expire(self, key, seconds):
+        pass
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = str(value)
+        return True
+
+    def exists(self, key):
+        return key in self.data
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def zadd(self, key, member, score):
+        self.data.setdefault(key, {})[member] = score
+
+    def zrem(self, key, member):
+        self.data.get(key, {}).pop(member, None)
+
+    def zrangebyscore(self, key, minimum, maximum):
+        items = self.data.get(key, {})
+        return sorted(member for member, score in items.items() if minimum <= score <= maximum)
+
+
+class FakePipeline(object):
+    def __init__(self, db):
+        self.db = db
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.db, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+DATA = os.urandom(1000)
+
+
+class UploadsTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = FakeRedis()
+        self.upload = uploads.create(self.db, self.folder, 'owner', 'data.xlsx', len(DATA))
+        self.upload_id = self.upload['upload_id']
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def append(self, offset, data, checksum=None):
+        return uploads.append(self.db, self.upload_id, offset, io.BytesIO(data), len(data), checksum)
+
+    def get(self):
+        return uploads.get(self.db, self.upload_id)
+
+    def assertStored(self, data):
+        upload = self.get()
+        self.assertEqual(upload['offset'], len(data))
+        self.assertEqual(upload['checksum'], zlib.crc32(data) & 0xffffffff)
+        with open(upload['path'], 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_create(self):
+        self.assertEqual(uploads.describe(self.upload), {
+            'upload_id': self.upload_id,
+            'filename': 'data.xlsx',
+            'size': len(DATA),
+            'offset': 0,
+            'checksum': '00000000',
+            'complete': False,
+            'chunk_size': uploads.CHUNK_SIZE
+        })
+        with self.assertRaisesRegexp(UploadError, 'Only .xls, .xlsx files'):
+            uploads.create(self.db, self.folder, 'owner', 'data.exe', 1)
+        with self.assertRaisesRegexp(UploadError, 'negative'):
+            uploads.create(self.db, self.folder, 'owner', 'data.xlsx', -1)
+
+    def test_chunks_resume_from_stored_offset(self):
+        self.append(0, DATA[:300])
+        self.assertStored(DATA[:300])
+        upload = self.append(self.get()['offset'], DATA[300:])
+        self.assertTrue(upload['complete'])
+        self.assertStored(DATA)
+        self.assertEqual(uploads.check(self.db, self.upload_id, 'owner')['path'], upload['path'])
+
+    def test_out_of_order_chunk_conflicts(self):
+        self.append(0, DATA[:300])
+        with self.assertRaisesRegexp(UploadConflict, 'continues at offset 300'):
+            self.append(600, DATA[600:])
+        self.assertStored(DATA[:300])
+
+    def test_duplicate_chunk_conflicts(self):
+        self.append(0, DATA[:300])
+        with self.assertRaises(UploadConflict):
+            self.append(0, DATA[:300])
+        self.append(300, DATA[300:])
+        self.assertStored(DATA)
+
+    def test_interrupted_chunk_is_overwritten(self):
+        self.append(0, DATA[:300])
+        with self.assertRaisesRegexp(UploadError, 'incomplete'):
+            uploads.append(self.db, self.upload_id, 300, io.BytesIO(DATA[300:400]), 700)
+        self.assertEqual(self.get()['offset'], 300)
+        self.append(300, DATA[300:])
+        self.assertStored(DATA)
+
+    def test_bad_checksum_is_rejected(self):
+        self.append(0, DATA[:300], zlib.crc32(DATA[:300]) & 0xffffffff)
+        corrupted = b'\0' + DATA[301:600]
+        with self.assertRaisesRegexp(UploadError, 'checksum'):
+            self.append(300, corrupted, zlib.crc32(DATA[300:600]) & 0xffffffff)
+        self.assertEqual(self.get()['offset'], 300)
+        self.append(300, DATA[300:], zlib.crc32(DATA[300:]) & 0xffffffff)
+        self.assertStored(DATA)
+
+    def test_oversized_chunks_are_rejected(self):
+        with self.assertRaisesRegexp(UploadError, 'after the end'):
+            self.append(0, DATA + b'x')
+        self.assertEqual(self.get()['offset'], 0)
+
+    def test_incomplete_upload_cannot_be_claimed(self):
+        self.append(0, DATA[:300])
+        with self.assertRaisesRegexp(UploadError, 'not complete'):
+            uploads.claim(self.db, self.upload_id, 'owner')
+
+    def test_upload_is_claimed_once_by_its_owner(self):
+        self.append(0, DATA)
+        with self.assertRaisesRegexp(UploadError, 'Unknown upload'):
+            uploads.claim(self.db, self.upload_id, 'other')
+        path = uploads.claim(self.db, self.upload_id, 'owner')
+        with self.assertRaisesRegexp(UploadError, 'Unknown upload'):
+            uploads.claim(self.db, self.upload_id, 'owner')
+        self.assertTrue(os.path.exists(path))
+
+    def test_expired_upload_is_rejected(self):
+        self.append(0, DATA[:300])
+        self.db.delete(uploads.upload_key(self.upload_id))
+        with self.assertRaisesRegexp(UploadError, 'Unknown upload'):
+            self.append(300, DATA[300:])
+        with self.assertRaisesRegexp(UploadError, 'Unknown upload'):
+            uploads.check(self.db, self.upload_id, 'owner')
+
+    def test_files_of_expired_uploads_are_removed(self):
+        claimed = uploads.create(self.db, self.folder, 'owner', 'claimed.xlsx', 0)
+        uploads.claim(self.db, claimed['upload_id'], 'owner')
+        self.db.delete(uploads.upload_key(self.upload_id))
+        self.db.zadd(uploads.EXPIRY_KEY, self.upload['path'], time.time() - 1)
+        active = uploads.create(self.db, self.folder, 'owner', 'active.xlsx', 1)
+        self.assertFalse(os.path.exists(self.upload['path']))
+        self.assertTrue(os.path.exists(claimed['path']))
+        self.assertTrue(os.path.exists(active['path']))
+
+
+if __name__ == '__main__':
+    unittest.main()
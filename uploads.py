@@ -0,0 +1,190 @@
+import os
+import time
+import uuid
+import zlib
+
+from werkzeug.utils import secure_filename
+
+# Resumable chunked uploads.
+# An upload session is created with the file name and size, then chunks are PUT at the offset the server
+# has received so far. Every chunk is streamed straight into the final file under the upload folder
+# while a running CRC32 of the file is kept with the session, so an interrupted upload resumes
+# from the last stored offset. A complete upload is claimed once by the form it was made for.
+# Files of sessions that expire unclaimed are removed by cleanup, which finds them by expiry time
+# in the EXPIRY_KEY sorted set of file paths.
+
+# chunk size suggested to clients
+CHUNK_SIZE = 4 * 1024 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+# bytes read from the request stream at once
+READ_SIZE = 64 * 1024
+# seconds an unfinished upload session is kept since its last chunk
+UPLOAD_TTL = 24 * 60 * 60
+# seconds a chunk may take before its session lock expires
+LOCK_TTL = 60
+EXTENSIONS = ('xls', 'xlsx')
+EXPIRY_KEY = 'uploads:expiry'
+
+
+class UploadError(Exception):
+    pass
+
+
+# chunk does not start at the received offset, the client should resume from the current offset
+class UploadConflict(UploadError):
+    pass
+
+
+def upload_key(upload_id):
+    return 'upload:%s' % upload_id
+
+
+def upload_lock_key(upload_id):
+    return 'upload:%s:lock' % upload_id
+
+
+def get_extension(filename):
+    return filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+
+
+# removes files of upload sessions expired before they were claimed
+def cleanup(db):
+    for path in db.zrangebyscore(EXPIRY_KEY, 0, time.time()):
+        upload_id = os.path.basename(path).split('_', 1)[0]
+        if db.exists(upload_key(upload_id)):
+            continue
+        if os.path.exists(path):
+            os.remove(path)
+        db.zrem(EXPIRY_KEY, path)
+
+
+def create(db, folder, owner, filename, size):
+    cleanup(db)
+    filename = secure_filename(filename or '')
+    if get_extension(filename) not in EXTENSIONS:
+        raise UploadError('Only %s files can be uploaded' % ', '.join('.' + ext for ext in EXTENSIONS))
+    if size < 0:
+        raise UploadError('Size should not be negative')
+
+    upload_id = str(uuid.uuid4())
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    path = os.path.join(folder, '%s_%s' % (upload_id, filename))
+    open(path, 'wb').close()
+    pipe = db.pipeline()
+    pipe.hmset(upload_key(upload_id), {
+        'upload_id': upload_id,
+        'owner': owner,
+        'filename': filename,
+        'path': path,
+        'size': size,
+        'offset': 0,
+        'checksum': 0,
+        'created': time.time()
+    })
+    pipe.expire(upload_key(upload_id), UPLOAD_TTL)
+    pipe.zadd(EXPIRY_KEY, path, time.time() + UPLOAD_TTL)
+    pipe.execute()
+    return get_existing(db, upload_id)
+
+
+def get(db, upload_id):
+    upload = db.hgetall(upload_key(upload_id))
+    if not upload:
+        return None
+    for key in ('size', 'offset', 'checksum'):
+        upload[key] = int(upload[key])
+    upload['complete'] = upload['offset'] == upload['size']
+    return upload
+
+
+# returns upload or raises UploadError when the session has expired or was claimed
+def get_existing(db, upload_id):
+    upload = get(db, upload_id)
+    if not upload:
+        raise UploadError('Unknown upload %s' % upload_id)
+    return upload
+
+
+# public state of an upload, checksum is CRC32 of the received bytes as 8 hex digits
+def describe(upload):
+    return {
+        'upload_id': upload['upload_id'],
+        'filename': upload['filename'],
+        'size': upload['size'],
+        'offset': upload['offset'],
+        'checksum': '%08x' % upload['checksum'],
+        'complete': upload['complete'],
+        'chunk_size': CHUNK_SIZE
+    }
+
+
+# Writes length bytes read from stream at offset. The file is truncated to the offset first,
+# so bytes of a chunk interrupted before the session was updated are overwritten.
+# With checksum (CRC32 of the chunk) a chunk corrupted on the way is rejected and the offset stays.
+def append(db, upload_id, offset, stream, length, checksum=None):
+    if length > MAX_CHUNK_SIZE:
+        raise UploadError('Chunk should not exceed %s bytes' % MAX_CHUNK_SIZE)
+    if not db.set(upload_lock_key(upload_id), 1, nx=True, ex=LOCK_TTL):
+        raise UploadConflict('Another chunk of upload %s is being written' % upload_id)
+    try:
+        upload = get_existing(db, upload_id)
+        if offset != upload['offset']:
+            raise UploadConflict('Upload %s continues at offset %s' % (upload_id, upload['offset']))
+        if offset + length > upload['size']:
+            raise UploadError('Chunk ends after the end of the file')
+
+        file_checksum = upload['checksum']
+        chunk_checksum = 0
+        received = 0
+        with open(upload['path'], 'r+b') as f:
+            f.seek(offset)
+            f.truncate()
+            while received < length:
+                block = stream.read(min(READ_SIZE, length - received))
+                if not block:
+                    break
+                file_checksum = zlib.crc32(block, file_checksum) & 0xffffffff
+                chunk_checksum = zlib.crc32(block, chunk_checksum) & 0xffffffff
+                f.write(block)
+                received += len(block)
+        if received != length:
+            raise UploadError('Chunk is incomplete, received %s of %s bytes' % (received, length))
+        if checksum is not None and checksum != chunk_checksum:
+            raise UploadError('Chunk checksum %08x does not match %08x' % (chunk_checksum, checksum))
+
+        pipe = db.pipeline()
+        pipe.hmset(upload_key(upload_id), {'offset': offset + length, 'checksum': file_checksum})
+        pipe.expire(upload_key(upload_id), UPLOAD_TTL)
+        pipe.zadd(EXPIRY_KEY, upload['path'], time.time() + UPLOAD_TTL)
+        pipe.execute()
+        upload.update({
+            'offset': offset + length,
+            'checksum': file_checksum,
+            'complete': offset + length == upload['size']
+        })
+        return upload
+    finally:
+        db.delete(upload_lock_key(upload_id))
+
+
+# returns complete upload of owner or raises UploadError, the file stays where it was written
+def check(db, upload_id, owner, extensions=EXTENSIONS):
+    upload = get(db, upload_id)
+    if not upload or upload['owner'] != owner:
+        raise UploadError('Unknown upload %s' % upload_id)
+    if not upload['complete']:
+        raise UploadError('Upload %s is not complete' % upload_id)
+    if get_extension(upload['filename']) not in extensions:
+        raise UploadError('Only %s files are allowed' % ', '.join('.' + ext for ext in extensions))
+    return upload
+
+
+# hands complete upload over, returns path of its file, the session is closed
+def claim(db, upload_id, owner, extensions=EXTENSIONS):
+    upload = check(db, upload_id, owner, extensions)
+    pipe = db.pipeline()
+    pipe.delete(upload_key(upload_id))
+    pipe.zrem(EXPIRY_KEY, upload['path'])
+    pipe.execute()
+    return upload['path']
@@ -0,0 +1,17 @@
+import os.path
+
+from catalog import ModelCatalog
+from series_store import SeriesStore
+import jobs
+import redis_db
+
+# Run worker, start as many processes as needed:
+# python worker.py
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+if __name__ == '__main__':
+    db = redis_db.create_client()
+    model_catalog = ModelCatalog(os.path.join(STATIC_FOLDER, 'models.json'))
+    series_store = SeriesStore(os.path.join(STATIC_FOLDER, 'series'))
+    jobs.work(db, model_catalog, series_store)